@@ -0,0 +1,124 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from typing import Dict, Optional, Set
+
+import telebot
+from telebot.async_telebot import AsyncTeleBot
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+# Commands that call the model or render plots and documents
+SLOW_COMMANDS = {'plot', 'tree'}
+# Commands that don't touch the dialog state, so they don't have to wait for earlier updates of their chat
+STATELESS_COMMANDS = {'random', 'last', 'search'}
+
+
+class AsyncRuntime(AsyncTeleBot):
+    """
+    Receives updates with the async bot and runs the handlers registered on the sync bot in bounded executors:
+    text messages and slow commands (model, plots) on the slow executor, everything else on the fast one, so quick
+    commands and buttons stay responsive while notes are being classified.
+    The updates of a chat are handled one at a time in the order they arrived, except for the stateless commands.
+    At most max_in_flight updates are dispatched at a time; while they are all taken, no new updates are fetched, so
+    the backlog waits at Telegram instead of in memory.
+    """
+    def __init__(
+            self,
+            sync_bot: telebot.TeleBot,
+            token: str,
+            fast_workers: int = 4,
+            slow_workers: int = 2,
+            max_in_flight: int = 100,
+    ):
+        super().__init__(token)
+        self.sync_bot = sync_bot
+        # handlers run inline in the executor thread that processes the update
+        self.sync_bot.threaded = False
+        self.fast_executor = ThreadPoolExecutor(fast_workers, thread_name_prefix="fast-handler")
+        self.slow_executor = ThreadPoolExecutor(slow_workers, thread_name_prefix="slow-handler")
+        self.chat_lanes: Dict[int, asyncio.Lock] = {}
+        self.chat_lane_users: Dict[int, int] = {}
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        # the event loop keeps only weak references to tasks, running ones have to be referenced here
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def get_updates(self, *args, **kwargs):
+        # backpressure: wait for a free slot before fetching more updates
+        async with self.in_flight:
+            pass
+        return await super().get_updates(*args, **kwargs)
+
+    async def process_new_updates(self, updates):
+        # Tasks are created in arrival order and take their chat lane before their first await,
+        # and asyncio.Lock wakes up its waiters in FIFO order, which keeps the per-chat order;
+        # the semaphore also wakes up its waiters in FIFO order
+        for update in updates:
+            await self.in_flight.acquire()
+            task = asyncio.create_task(self.dispatch(update))
+            self.tasks.add(task)
+            task.add_done_callback(self.on_task_done)
+
+    def on_task_done(self, task: asyncio.Task) -> None:
+        self.tasks.discard(task)
+        self.in_flight.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Dispatching an update failed: {task.exception()!r}")
+
+    async def dispatch(self, update: telebot.types.Update) -> None:
+        chat_id = get_chat_id(update)
+        command = get_command(update)
+        executor = self.slow_executor if is_slow(update, command) else self.fast_executor
+        if chat_id is None or command in STATELESS_COMMANDS:
+            await self.run_handlers(executor, update)
+            return
+        lane = self.chat_lanes.setdefault(chat_id, asyncio.Lock())
+        self.chat_lane_users[chat_id] = self.chat_lane_users.get(chat_id, 0) + 1
+        try:
+            async with lane:
+                await self.run_handlers(executor, update)
+        finally:
+            self.chat_lane_users[chat_id] -= 1
+            if not self.chat_lane_users[chat_id]:
+                del self.chat_lane_users[chat_id]
+                del self.chat_lanes[chat_id]
+
+    async def run_handlers(self, executor: ThreadPoolExecutor, update: telebot.types.Update) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(executor, self.sync_bot.process_new_updates, [update])
+        except Exception as e:
+            logger.error(f"Handler for update {update.update_id} failed: {e}")
+
+    def shutdown(self) -> None:
+        self.fast_executor.shutdown(wait=False)
+        self.slow_executor.shutdown(wait=False)
+
+
+def get_chat_id(update: telebot.types.Update) -> Optional[int]:
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return None
+
+
+def get_command(update: telebot.types.Update) -> Optional[str]:
+    if update.message is None or not update.message.text:
+        return None
+    return telebot.util.extract_command(update.message.text)
+
+
+def is_slow(update: telebot.types.Update, command: Optional[str]) -> bool:
+    if command is not None:
+        return command in SLOW_COMMANDS
+    # plain text messages are classified or answered by the model
+    return update.message is not None
+
+
+def run(sync_bot: telebot.TeleBot, token: str, fast_workers: int = 4, slow_workers: int = 2) -> None:
+    runtime = AsyncRuntime(sync_bot, token, fast_workers=fast_workers, slow_workers=slow_workers)
+    try:
+        asyncio.run(runtime.polling(non_stop=True, interval=0))
+    finally:
+        runtime.shutdown()
@@ -5,52 +5,136 @@ if platform.system() != 'Darwin':
     import sys
     sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
+import argparse
+from dataclasses import replace
+import functools
+import io
+import logging
 from os import environ
-from typing import Optional
+from pathlib import Path
+import re
+import time
+from urllib.parse import urlsplit
 
 from dotenv import load_dotenv
-import streamlit as st
 import telebot
 
 from categories_to_html import CategoryTree
-from db_action_handler import DBActionHandler
+from chat_state import create_chat_state_store
+from classification_queue import ClassificationJob, ClassificationQueue
+from db_action_handler import DBActionHandler, PENDING_LABEL, UNCLASSIFIED_LABEL
 from db_entities import Thought
-from rag import RAG
+from lazy_resource import LazyResourceRegistry, log_phase
+from metrics import MetricsServer, metrics
+from outbox import Outbox
+from user_directory import Account, UserDirectory
 
+startup_started_at = time.monotonic()
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
 
 load_dotenv()
 TOKEN = environ.get('TOKEN')
 ADMIN_USERNAME = environ.get('ADMIN_USERNAME')
+# /random prefers urgent and old notes if set to 1
+RANDOM_NOTE_WEIGHTED = environ.get('RANDOM_NOTE_WEIGHTED', '0') == '1'
+SEARCH_RESULTS_LIMIT = int(environ.get('SEARCH_RESULTS_LIMIT', 10))
 
-bot = telebot.TeleBot(TOKEN)
+# Handlers run on a pool of worker threads; dialog state lives in the per-chat state store
+bot = telebot.TeleBot(TOKEN, num_threads=int(environ.get('BOT_WORKERS', 4)))
 action_handler = DBActionHandler()
-
-"""Global variables"""
-category_editing = False
-editing_message_id: Optional[int] = None
-candidate_categories = ["AI Progress", "Chores", "Beauty > Hair and skin care", "Note", "Plan"]  # default categories
-query_mode = False
+chat_states = create_chat_state_store()
+# All output goes through the outbox, which applies Telegram's rate limits and merges repeated edits
+outbox = Outbox(bot)
+# Every handler looks up the sender here instead of querying the user table
+users = UserDirectory(action_handler.get_user)
 
 default_prompt = "Please use /new command to add new thought to your pull " \
                  "or /random to get a random thought from your pull."
 default_keyboard = telebot.types.ReplyKeyboardRemove(selective=False)
 
 
-@st.cache_resource
-def load_rag():
-    return RAG()
+def load_rag(user_id: int):
+    # imported here because LangChain and torch take a long time to import
+    from rag import RAG
+    return RAG(user_id=user_id)
 
 
-@st.cache_resource
-def load_category_tree():
+def load_category_tree(user_id: int):
     category_tree = CategoryTree()
-    categories = action_handler.get_all_categories()
+    categories = action_handler.get_all_categories(user_id)
     category_tree.parse_categories(categories)
     return category_tree
 
 
-rag = load_rag()
-tree = load_category_tree()
+# One RAG (example store and vector indexes) and one category tree per user, built on the user's first request;
+# the admin's are built in the background after polling starts
+max_loaded_users = int(environ.get('MAX_LOADED_USERS', 32))
+rags = LazyResourceRegistry("RAG", load_rag, max_size=max_loaded_users)
+trees = LazyResourceRegistry("category tree", load_category_tree, max_size=max_loaded_users)
+log_phase("setup", startup_started_at)
+
+
+class StreamingReply:
+    """
+    A message that is progressively edited while an answer is being generated.
+    Edits are throttled to stay within Telegram's rate limits for editing messages.
+    """
+    MAX_MESSAGE_LENGTH = 4096
+
+    def __init__(self, chat_id: int, placeholder: str, min_edit_interval: float = 1.5):
+        self.chat_id = chat_id
+        self.min_edit_interval = min_edit_interval
+        self.message = outbox.send_message(chat_id, placeholder, reply_markup=default_keyboard).result()
+        self.shown_text = placeholder
+        self.last_edit_at = time.monotonic()
+
+    def update(self, text: str) -> None:
+        if time.monotonic() - self.last_edit_at >= self.min_edit_interval:
+            self._edit(text)
+
+    def finish(self, text: str, fallback: str = "Sorry, there is no answer.") -> None:
+        # the placeholder is always replaced, by the fallback if the answer is empty
+        self._edit(text if text.strip() else fallback)
+
+    def _edit(self, text: str) -> None:
+        text = text[:self.MAX_MESSAGE_LENGTH]
+        if not text.strip() or text == self.shown_text:
+            return
+        outbox.edit_message_text(text, self.chat_id, self.message.message_id)
+        self.shown_text = text
+        self.last_edit_at = time.monotonic()
+
+
+def strip_note_ids(answer: str) -> str:
+    # the LLM refers to notes by the "[id]" they are given in the prompt, the user doesn't need to see the ids
+    return re.sub(r"\[\d+\]\s*", "", answer)
+
+
+def authorized(handler):
+    """Passes the account of the sender to the handler, or tells the sender that they have no access."""
+    @functools.wraps(handler)
+    def wrapper(update):
+        user = update.from_user
+        account = users.get(user.username)
+        if account is None:
+            outbox.send_message(
+                user.id,
+                f"You are not authorized to use this bot. Please contact @{ADMIN_USERNAME} to get access.",
+            )
+            return
+        return handler(update, account)
+    return wrapper
+
+
+def instrumented(handler):
+    """Records the latency of every call of the handler, and counts the calls that raise."""
+    @functools.wraps(handler)
+    def wrapper(update):
+        with metrics.timer("handler_seconds", handler=handler.__name__):
+            return handler(update)
+    return wrapper
 
 
 def get_response_buttons(note_status):
@@ -70,119 +154,187 @@ def get_response_buttons(note_status):
 
 
 @bot.message_handler(commands=['random'])
-def send_random_note(message):
-    user = message.from_user
-    # TODO move checking to decorator
-    if user.username == ADMIN_USERNAME:
-        random_note = action_handler.get_random_note()
-        bot.send_message(
-            user.id,
-            f"Random thought from your pull: \n{random_note}",  # TODO format the message
-            reply_markup=get_response_buttons(random_note.status),
-        )
-    else:
-        bot.send_message(
-            user.id,
-            f"You are not authorized to use this bot. Please contact @{ADMIN_USERNAME} to get access.",
-        )
+@instrumented
+@authorized
+def send_random_note(message, account: Account):
+    random_note = action_handler.get_random_note(account.id, weighted=RANDOM_NOTE_WEIGHTED)
+    if random_note is None:
+        outbox.send_message(message.from_user.id, "There are no open notes in your pull.")
+        return
+    outbox.send_message(
+        message.from_user.id,
+        f"Random thought from your pull: \n{random_note}",  # TODO format the message
+        reply_markup=get_response_buttons(random_note.status),
+    )
 
 
 @bot.message_handler(commands=['last'])  # TODO add to bot commands
-def send_last_n_notes(message):
-    user = message.from_user
-    if user.username == ADMIN_USERNAME:
-        n = 5
-        thoughts = action_handler.show_last_n(n)
-        for thought in thoughts:
-            bot.send_message(
-                user.id,
-                thought.note_text,
-                reply_markup=get_response_buttons(thought.status),
-            )
-    else:
-        bot.send_message(
-            user.id,
-            f"You are not authorized to use this bot. Please contact @{ADMIN_USERNAME} to get access.",
+@instrumented
+@authorized
+def send_last_n_notes(message, account: Account):
+    n = 5
+    thoughts = action_handler.show_last_n(n, account.id)
+    for thought in thoughts:
+        outbox.send_message(
+            message.from_user.id,
+            thought.note_text,
+            reply_markup=get_response_buttons(thought.status),
         )
 
 
 @bot.message_handler(commands=['new'])
-def add_new_note(message):
+@instrumented
+@authorized
+def add_new_note(message, account: Account):
     # Invites to send a new note and sets category_editing to False
-    global category_editing
-    category_editing = False
-    user = message.from_user
-    if user.username == ADMIN_USERNAME:
-        bot.send_message(
-            user.id,
-            f"Please send me a new note to save.",
-            reply_markup=default_keyboard,
-        )
-    else:
-        bot.send_message(
-            user.id,
-            f"You are not authorized to use this bot. Please contact @{ADMIN_USERNAME} to get access.",
-        )
+    chat_states.update(message.chat.id, category_editing=False)
+    outbox.send_message(
+        message.from_user.id,
+        f"Please send me a new note to save.",
+        reply_markup=default_keyboard,
+    )
 
 
 @bot.message_handler(commands=['plot'])
-def send_plots(message):
-    user = message.from_user
-    if user.username == ADMIN_USERNAME:
-        plot_filename = action_handler.send_plots()
-        bot.send_photo(
-            user.id,
-            open(plot_filename, 'rb'),
+@instrumented
+@authorized
+def send_plots(message, account: Account):
+    png = action_handler.get_plot_image(account.id)
+    if png is None:
+        outbox.send_message(
+            message.from_user.id, "Sorry, the plot could not be drawn. Please try again later.",
             reply_markup=default_keyboard,
         )
-    else:
-        bot.send_message(
-            user.id,
-            f"You are not authorized to use this bot. Please contact @{ADMIN_USERNAME} to get access.",
-        )
+        return
+    outbox.send_photo(message.from_user.id, io.BytesIO(png), reply_markup=default_keyboard)
 
 
 @bot.message_handler(commands=['tree'])
-def show_tree(message):
-    user = message.from_user
-    if user.username == ADMIN_USERNAME:
-        html_output = tree.generate_html_with_todos()
-        with open('output_collapsible.html', mode='w', encoding='utf-8') as file:
-            file.write(html_output)
-        bot.send_document(
-            user.id,
-            open('output_collapsible.html', 'rb'),
-            reply_markup=default_keyboard,
-        )
-    else:
-        bot.send_message(
-            user.id,
-            f"You are not authorized to use this bot. Please contact @{ADMIN_USERNAME} to get access.",
-        )
+@instrumented
+@authorized
+def show_tree(message, account: Account):
+    outbox.send_document(
+        message.from_user.id,
+        io.BytesIO(trees.get(account.id).get_html_document()),
+        visible_file_name='output_collapsible.html',
+        reply_markup=default_keyboard,
+    )
 
 
 @bot.message_handler(commands=['query'])
-def perform_query(message):
-    global category_editing
-    global query_mode
-    category_editing = False
-    query_mode = True
-    user = message.from_user
-    if user.username == ADMIN_USERNAME:
-        bot.send_message(
-            user.id,
-            f"Write a query to your notes.",
-            reply_markup=default_keyboard,
-        )
+@instrumented
+@authorized
+def perform_query(message, account: Account):
+    chat_states.update(message.chat.id, category_editing=False, query_mode=True)
+    outbox.send_message(
+        message.from_user.id,
+        f"Write a query to your notes.",
+        reply_markup=default_keyboard,
+    )
+
+
+@bot.message_handler(commands=['search'])
+@instrumented
+@authorized
+def search_notes(message, account: Account):
+    # /search <words>, a full-text search that answers right away, unlike /query it doesn't ask the LLM
+    text = telebot.util.extract_arguments(message.text).strip()
+    if not text:
+        outbox.send_message(message.from_user.id, "Usage: /search <words>")
+        return
+    notes = action_handler.search_notes(text, SEARCH_RESULTS_LIMIT, account.id)
+    if not notes:
+        outbox.send_message(message.from_user.id, f'No notes found for "{text}".', reply_markup=default_keyboard)
+        return
+    results = "\n".join(f"{i}. {note.note_text} ({note.label}, {note.status})" for i, note in enumerate(notes, 1))
+    # long notes can add up to more than fits in one Telegram message, split between the results where possible
+    for part in telebot.util.smart_split(results, telebot.util.MAX_MESSAGE_LENGTH):
+        outbox.send_message(message.from_user.id, part, reply_markup=default_keyboard)
+
+
+@bot.message_handler(commands=['retry'])
+@instrumented
+@authorized
+def retry_classification(message, account: Account):
+    # queues the notes whose classification failed again
+    notes = action_handler.filter_notes(label=UNCLASSIFIED_LABEL, user_id=account.id)
+    for note in notes:
+        classification_queue.enqueue(note.id, message.chat.id, note.note_text)
+    outbox.send_message(
+        message.from_user.id,
+        f"Classifying {len(notes)} notes again." if notes else "There are no unclassified notes.",
+        reply_markup=default_keyboard,
+    )
+
+
+@bot.message_handler(commands=['adduser'])
+@instrumented
+@authorized
+def add_bot_user(message, account: Account):
+    # /adduser <telegram username>, admins only
+    if not account.is_admin:
+        outbox.send_message(message.from_user.id, "Only admins can add users.")
+        return
+    username = telebot.util.extract_arguments(message.text).strip().lstrip('@')
+    if not username:
+        outbox.send_message(message.from_user.id, "Usage: /adduser <telegram username>")
+        return
+    if users.get(username) is None:
+        action_handler.add_user(username, None, None, False)
+        users.invalidate(username)
+    outbox.send_message(message.from_user.id, f"@{username} can use the bot now.")
+
+
+@instrumented
+def classify_note(job: ClassificationJob) -> None:
+    # the note decides whose examples and categories are used
+    user_id = action_handler.get_note_by_id(job.note_id).user_id
+    model_prediction = rags.get(user_id).predict(job.note_text)
+    note = action_handler.set_predicted_label(job.note_id, model_prediction['category'])
+    if note is not None:
+        # offered by "Edit category", only while the user hasn't picked a category
+        chat_states.update(job.chat_id, candidate_categories=list(model_prediction['categories_for_user_selection']))
+        show_note(job.chat_id, note)
     else:
-        bot.send_message(
-            user.id,
-            f"You are not authorized to use this bot. Please contact @{ADMIN_USERNAME} to get access.",
-        )
+        # the category was already set by the user while the note was waiting in the queue
+        note = action_handler.get_note_by_id(job.note_id)
+    trees.get(user_id).add_todo_to_category(note.label, note.note_text)
+    rags.get(user_id).add_note(note.id, note.note_text, note.label)
+
+
+def mark_unclassified(job: ClassificationJob, error: Exception) -> None:
+    # the job ran out of attempts, the note gets a label that the user sees instead of staying Pending
+    note = action_handler.set_predicted_label(job.note_id, UNCLASSIFIED_LABEL)
+    if note is None:
+        return
+    show_note(job.chat_id, note)
+    outbox.send_message(
+        job.chat_id,
+        f'The note "{note.note_text}" could not be classified. '
+        f'Send /retry to try again, or pick a category with "Edit category".',
+        reply_markup=default_keyboard,
+    )
 
 
-def get_note_category(message):
-    return rag.predict(message.text)
+def show_note(chat_id: int, note: Thought) -> None:
+    # edits the reply to the note, if it has been sent already; get_text_messages edits it otherwise
+    if note.message_id is None:
+        return
+    outbox.edit_message_text(
+        format_response_message(note.note_text, note.label, note.urgency, note.eta),
+        chat_id,
+        note.message_id,
+        reply_markup=get_response_buttons(note.status),
+        parse_mode='HTML'
+    )
+
+
+classification_queue = ClassificationQueue(
+    Path(environ.get('CLASSIFICATION_QUEUE_DB', 'classification_queue.sqlite')), classify_note,
+    on_failed=mark_unclassified,
+)
+metrics.register_gauge("queue_depth", outbox.queue_depth, queue="outbox")
+metrics.register_gauge("queue_depth", classification_queue.depth, queue="classification")
 
 
 def format_response_message(note_text, label, urgency, eta=None) -> str:
@@ -200,7 +352,7 @@ def format_response_message(note_text, label, urgency, eta=None) -> str:
     return response_message
 
 
-def handle_note_creation(note_text, label, urgency, eta, message_id, status):
+def handle_note_creation(note_text, label, urgency, eta, message_id, status, user_id):
     note = Thought(
         note_text=note_text,
         label=label,
@@ -210,34 +362,61 @@ def handle_note_creation(note_text, label, urgency, eta, message_id, status):
         date_created=None,
         date_completed=None,
         message_id=message_id,
+        user_id=user_id,
     )
     action_handler.add_thought(note)
+    return note
 
 
 @bot.message_handler(content_types=['text'])
-def get_text_messages(message):
-    global category_editing
-    global candidate_categories
-    global query_mode
+@instrumented
+@authorized
+def get_text_messages(message, account: Account):
     user = message.from_user
+    # The message consumes the pending dialog mode, so a second message can't act on the same mode
+    state, _ = chat_states.transition(
+        message.chat.id, lambda state: replace(state, category_editing=False, editing_message_id=None, query_mode=False)
+    )
 
-    if not category_editing and not query_mode and user.username == ADMIN_USERNAME:
-        model_prediction = get_note_category(message)
-        label = model_prediction['category']
-        candidate_categories = model_prediction['categories_for_user_selection']
+    if not state.category_editing and not state.query_mode:
+        # The note is saved right away and classified by the background queue, see classify_note
         status = "open"
         urgency = 'week'
         eta = 0.5
-        response_message_text: str = format_response_message(message.text, label, urgency, eta)
-        response_message = bot.send_message(user.id, response_message_text, reply_markup=get_response_buttons(status), parse_mode='HTML')
-        handle_note_creation(message.text, label, urgency, eta, response_message.message_id, status)
-        tree.add_todo_to_category(label, message.text)
-    elif category_editing and user.username == ADMIN_USERNAME:
-        global editing_message_id
-        current_category = action_handler.get_note_by_message_id(editing_message_id).label
+        note = handle_note_creation(message.text, PENDING_LABEL, urgency, eta, None, status, account.id)
+        if note.id is None:
+            # the insert failed (and was logged), there is nothing to classify or index
+            outbox.send_message(
+                user.id, "Sorry, the note could not be saved. Please send it again.", reply_markup=default_keyboard
+            )
+            return
+        # queued right after the insert, so the note is classified even if the reply fails or the process stops;
+        # the job finds the reply through the note's message_id
+        classification_queue.enqueue(note.id, user.id, message.text)
+        response_message_text: str = format_response_message(message.text, PENDING_LABEL, urgency, eta)
+        response_message = outbox.send_message(
+            user.id, response_message_text, reply_markup=get_response_buttons(status), parse_mode='HTML'
+        ).result()
+        action_handler.update_note_message_id(note.id, response_message.message_id)
+        # a job that finished before the message id was saved couldn't edit the reply
+        note = action_handler.get_note_by_id(note.id)
+        if note is not None and note.label != PENDING_LABEL:
+            show_note(user.id, note)
+    elif state.category_editing:
+        editing_message_id = state.editing_message_id
+        current_category = action_handler.get_note_by_message_id(editing_message_id, account.id).label
         if message.text != '🚫 Cancel' and message.text != current_category:
-            updated_note = action_handler.update_note_category(editing_message_id, message.text)
-            bot.send_message(
+            updated_note = action_handler.update_note_category(editing_message_id, message.text, account.id)
+            if updated_note is None:
+                outbox.send_message(
+                    user.id, "Sorry, the category could not be updated. Please try again.",
+                    reply_markup=default_keyboard,
+                )
+                return
+            rag = rags.get(account.id)
+            rag.update_note(updated_note.id, updated_note.note_text, updated_note.label)
+            rag.add_category(updated_note.label)
+            outbox.send_message(
                 user.id,
                 f'Category of the note "{updated_note.note_text}" updated to "{updated_note.label}".',
                 reply_markup=default_keyboard,
@@ -245,7 +424,7 @@ def get_text_messages(message):
             edited_response_message_text: str = format_response_message(
                 updated_note.note_text, updated_note.label, updated_note.urgency, updated_note.eta
             )
-            bot.edit_message_text(
+            outbox.edit_message_text(
                 edited_response_message_text,
                 user.id,
                 editing_message_id,
@@ -253,44 +432,55 @@ def get_text_messages(message):
                 parse_mode='HTML'
             )
         else:
-            bot.send_message(
+            outbox.send_message(
                 user.id,
                 f'Category of the note has not been changed.',
                 reply_markup=default_keyboard,
             )
-        category_editing = False
-        editing_message_id = None
-    elif query_mode and user.username == ADMIN_USERNAME:
-        rag_output_notes = rag.perform_arbitrary_query(message.text)
-        for note in [rag_output_notes]:  # TODO: return real notes with buttons
-            bot.send_message(
+    else:
+        reply = StreamingReply(user.id, "Looking through your notes...")
+        query_result = rags.get(account.id).perform_arbitrary_query(
+            message.text, on_partial_answer=lambda answer: reply.update(strip_note_ids(answer))
+        )
+        notes = action_handler.get_notes_by_ids(query_result['note_ids'], account.id)
+        if notes:
+            # the notes follow as messages, the answer would only repeat them
+            reply.finish(f"Relevant notes: {len(notes)}")
+        else:
+            reply.finish(strip_note_ids(query_result['answer']), fallback="No relevant notes found.")
+        for note in notes:
+            # without status buttons: a note is found by the message id of its reply, not by these messages
+            outbox.send_message(
                 user.id,
-                note,
+                note.note_text,
                 reply_markup=default_keyboard,
             )
-        query_mode = False
-    else:
-        bot.send_message(
-            user.id,
-            f"You are not authorized to use this bot. Please contact @{ADMIN_USERNAME} to get access.",
-        )
 
 
 # change the status of the note after pressing a button
 @bot.callback_query_handler(func=lambda call: call.data in [
     '#done', '#in_progress', '#not_relevant'
 ])
-def button_update_status(call):
+@instrumented
+@authorized
+def button_update_status(call, account: Account):
     new_status = get_new_note_status(call.data)
     message_id = call.message.message_id
-    note = action_handler.update_note_status(message_id, new_status)
-    bot.send_message(
+    note = action_handler.update_note_status(message_id, new_status, account.id)
+    if note is None:
+        outbox.send_message(
+            call.message.chat.id,
+            "Sorry, the note of this message could not be found, its status has not been changed.",
+            reply_markup=default_keyboard,
+        )
+        return
+    outbox.send_message(
         call.message.chat.id,
         f'Status of the note "{note.note_text}" updated to "{note.status}".',
         reply_markup=default_keyboard,
     )
     response_message_text: str = format_response_message(note.note_text, note.label, note.urgency, note.eta)
-    bot.edit_message_text(
+    outbox.edit_message_text(
         response_message_text,
         call.message.chat.id,
         message_id,
@@ -300,18 +490,16 @@ def button_update_status(call):
 
 
 @bot.callback_query_handler(func=lambda call: call.data == '#edit_category')
-def button_edit_category(call):
-    global category_editing
-    global editing_message_id
-    global candidate_categories
-    category_editing = True
-    editing_message_id = call.message.message_id
+@instrumented
+@authorized
+def button_edit_category(call, account: Account):
+    state = chat_states.update(call.message.chat.id, category_editing=True, editing_message_id=call.message.message_id)
     keyboard = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     row_width = 1  # number of buttons in each row
     keyboard.row_width = row_width
-    buttons = [telebot.types.KeyboardButton(category) for category in candidate_categories] + [telebot.types.KeyboardButton('🚫 Cancel')]
+    buttons = [telebot.types.KeyboardButton(category) for category in state.candidate_categories] + [telebot.types.KeyboardButton('🚫 Cancel')]
     keyboard.add(*buttons)
-    bot.send_message(
+    outbox.send_message(
         call.message.chat.id,
         "Choose a new category from the list or type a new one:",
         reply_markup=keyboard,
@@ -319,19 +507,14 @@ def button_edit_category(call):
 
 
 @bot.callback_query_handler(func=lambda call: call.data == '#query')
-def button_query(call):
-    user = call.from_user
-    if user.username == ADMIN_USERNAME:
-        bot.send_message(
-            user.id,
-            f"Write a query to your notes.",
-            reply_markup=default_keyboard,
-        )
-    else:
-        bot.send_message(
-            user.id,
-            f"You are not authorized to use this bot. Please contact @{ADMIN_USERNAME} to get access.",
-        )
+@instrumented
+@authorized
+def button_query(call, account: Account):
+    outbox.send_message(
+        call.from_user.id,
+        f"Write a query to your notes.",
+        reply_markup=default_keyboard,
+    )
 
 
 def get_new_note_status(callback_data: str):
@@ -347,4 +530,55 @@ def get_new_note_status(callback_data: str):
 
 
 if __name__ == '__main__':
-    bot.polling(none_stop=True, interval=0)
+    args = argparse.ArgumentParser()
+    args.add_argument('--runtime', choices=['polling', 'async', 'webhook'], default='polling',
+                      help="'async' receives updates with the async bot and runs handlers in bounded executors, "
+                           "'webhook' receives them on a local HTTP server (WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_PORT)")
+    args.add_argument('--fast-workers', type=int, default=4)
+    args.add_argument('--slow-workers', type=int, default=2)
+    parsed_args = args.parse_args()
+    if parsed_args.runtime == 'webhook':
+        missing = [name for name in ('WEBHOOK_URL', 'WEBHOOK_SECRET') if not environ.get(name)]
+        if missing:
+            args.error(f"--runtime webhook requires {' and '.join(missing)} to be set")
+
+    # the admin can always use the bot, further users are added with /adduser
+    if ADMIN_USERNAME and action_handler.get_user(ADMIN_USERNAME) is None:
+        action_handler.add_user(ADMIN_USERNAME, None, None, True)
+    admin = users.get(ADMIN_USERNAME)
+    if admin is not None:
+        rags[admin.id].warm_up()
+        trees[admin.id].warm_up()
+    else:
+        logger.error(
+            f"No admin user: ADMIN_USERNAME is {'not set' if not ADMIN_USERNAME else 'not in the user table'}, "
+            f"nobody can add users with /adduser"
+        )
+    classification_queue.start()
+    # the metrics endpoint is opt-in, there is no default port that is sure to be free
+    if environ.get('METRICS_PORT'):
+        try:
+            MetricsServer(metrics, port=int(environ['METRICS_PORT'])).start()
+        except OSError as e:
+            logger.error(f"Metrics server could not listen on port {environ['METRICS_PORT']}: {e}")
+    metrics.log_summary_every(float(environ.get('METRICS_LOG_INTERVAL', 300)))
+    log_phase("startup until polling", startup_started_at)
+    if parsed_args.runtime == 'async':
+        import async_runtime
+        async_runtime.run(bot, TOKEN, fast_workers=parsed_args.fast_workers, slow_workers=parsed_args.slow_workers)
+    elif parsed_args.runtime == 'webhook':
+        from webhook_server import WebhookServer
+        webhook_server = WebhookServer(
+            bot,
+            secret_token=environ['WEBHOOK_SECRET'],
+            host=environ.get('WEBHOOK_HOST', '127.0.0.1'),
+            port=int(environ.get('WEBHOOK_PORT', 8443)),
+            # the proxy in front of the server is expected to forward the path of the public URL unchanged
+            path=urlsplit(environ['WEBHOOK_URL']).path or '/',
+            workers=parsed_args.fast_workers,
+        )
+        metrics.register_gauge("queue_depth", webhook_server.queue_depth, queue="webhook")
+        bot.set_webhook(url=environ['WEBHOOK_URL'], secret_token=environ['WEBHOOK_SECRET'])
+        webhook_server.serve_forever()
+    else:
+        bot.polling(none_stop=True, interval=0)
@@ -1,63 +1,91 @@
-from typing import List, Dict
+import threading
+from typing import Dict, List, Optional
+
 import pandas as pd
 
 
 class CategoryTree:
+    """
+    Category tree with todos, rendered to a collapsible HTML document.
+    Every node caches its rendered HTML fragment; a change only clears the fragments on the path from the root to
+    the changed node, so rendering after a change re-renders that path and reuses everything else.
+    """
     def __init__(self):
         self.tree = {}
+        self.lock = threading.RLock()
+        self.document: Optional[bytes] = None
+
+    @staticmethod
+    def new_node() -> dict:
+        # 'html' is the cached fragment of the node and 'html_id' the element id it was rendered with
+        return {'subcategories': {}, 'todos': [], 'html': None, 'html_id': None}
 
     def parse_categories(self, categories: List[str]) -> None:
-        for category in categories:
-            parts = category.split(" > ")
-            current_level = self.tree
-            for part in parts:
-                if part not in current_level:
-                    current_level[part] = {'subcategories': {}, 'todos': []}
-                current_level = current_level[part]['subcategories']
+        with self.lock:
+            for category in categories:
+                self._get_node(category.split(" > "))
 
     def add_todo_to_category(self, category_path: str, todo: str) -> None:
-        parts = category_path.split(" > ")
+        with self.lock:
+            self._get_node(category_path.split(" > "))['todos'].append(todo)
+
+    def _get_node(self, parts: List[str]) -> dict:
+        """Returns the node at the path, creating missing nodes, and marks the whole path as changed."""
+        self.document = None
         current_level = self.tree
-        for part in parts[:-1]:
+        node = None
+        for part in parts:
             if part not in current_level:
-                current_level[part] = {'subcategories': {}, 'todos': []}
-            current_level = current_level[part]['subcategories']
-
-        last_part = parts[-1]
-        if last_part not in current_level:
-            current_level[last_part] = {'subcategories': {}, 'todos': []}
-
-        current_level[last_part]['todos'].append(todo)
-
-    def generate_html_with_todos(self, tree: Dict[str, dict] = None, parent_id: str = '') -> str:
-        if tree is None:
-            tree = self.tree
-
+                current_level[part] = self.new_node()
+            node = current_level[part]
+            node['html'] = None
+            current_level = node['subcategories']
+        return node
+
+    def generate_html_with_todos(self) -> str:
+        return self.get_html_document().decode('utf-8')
+
+    def get_html_document(self) -> bytes:
+        """Returns the rendered document, served from the cache if nothing changed since the last call."""
+        with self.lock:
+            if self.document is None:
+                html_content = self._render_list(self.tree, '')
+                self.document = (
+                    f"<html>\n<head>\n{self.CSS}\n{self.JAVASCRIPT}\n</head>\n<body>\n<div id='myUL'>\n"
+                    f"{html_content}</div>\n</body>\n</html>"
+                ).encode('utf-8')
+            return self.document
+
+    def _render_list(self, tree: Dict[str, dict], parent_id: str) -> str:
         if not tree:
             return ''
-
         html_content = '<ul>\n'
         for idx, (category, data) in enumerate(tree.items()):
             current_id = f"{parent_id}_{idx}" if parent_id else str(idx)
-            has_subcategories_or_todos = bool(data['subcategories']) or bool(data['todos'])
-            collapsible_class = 'collapsible' if has_subcategories_or_todos else ''
-            display_style = 'none' if has_subcategories_or_todos else 'block'
-
-            html_content += f'  <li>\n'
-            html_content += f'    <span class="{collapsible_class}" onclick="toggleVisibility(\'{current_id}\')">{category}</span>\n'
-            html_content += f'    <div id="{current_id}" style="display: {display_style};">\n'
-            html_content += self.generate_html_with_todos(data['subcategories'], current_id)
-            if data['todos']:
-                html_content += f'    <ul>\n'
-                for todo in data['todos']:
-                    html_content += f'      <li style="list-style-type: disc;">{todo}</li>\n'
-                html_content += f'    </ul>\n'
-            html_content += f'    </div>\n'
-            html_content += f'  </li>\n'
+            if data['html'] is None or data['html_id'] != current_id:
+                data['html'] = self._render_node(category, data, current_id)
+                data['html_id'] = current_id
+            html_content += data['html']
         html_content += '</ul>\n'
-
-        html_output_with_todos = f"<html>\n<head>\n{self.CSS}\n{self.JAVASCRIPT}\n</head>\n<body>\n<div id='myUL'>\n{html_content}</div>\n</body>\n</html>"
-        return html_output_with_todos
+        return html_content
+
+    def _render_node(self, category: str, data: dict, current_id: str) -> str:
+        has_subcategories_or_todos = bool(data['subcategories']) or bool(data['todos'])
+        collapsible_class = 'collapsible' if has_subcategories_or_todos else ''
+        display_style = 'none' if has_subcategories_or_todos else 'block'
+
+        html_content = f'  <li>\n'
+        html_content += f'    <span class="{collapsible_class}" onclick="toggleVisibility(\'{current_id}\')">{category}</span>\n'
+        html_content += f'    <div id="{current_id}" style="display: {display_style};">\n'
+        html_content += self._render_list(data['subcategories'], current_id)
+        if data['todos']:
+            html_content += f'    <ul>\n'
+            for todo in data['todos']:
+                html_content += f'      <li style="list-style-type: disc;">{todo}</li>\n'
+            html_content += f'    </ul>\n'
+        html_content += f'    </div>\n'
+        html_content += f'  </li>\n'
+        return html_content
 
     JAVASCRIPT = """
     <script>
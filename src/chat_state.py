@@ -0,0 +1,86 @@
+from dataclasses import asdict, dataclass, field, replace
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+DEFAULT_CANDIDATE_CATEGORIES = ["AI Progress", "Chores", "Beauty > Hair and skin care", "Note", "Plan"]
+
+
+@dataclass(frozen=True)
+class ChatState:
+    category_editing: bool = False
+    query_mode: bool = False
+    editing_message_id: Optional[int] = None
+    candidate_categories: List[str] = field(default_factory=lambda: list(DEFAULT_CANDIDATE_CATEGORIES))
+
+
+Transition = Callable[[ChatState], ChatState]
+
+
+class InMemoryChatStateStore:
+    """Dialog state per chat. A transition reads and replaces the state of a chat atomically."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states: Dict[int, ChatState] = {}
+
+    def get(self, chat_id: int) -> ChatState:
+        with self.lock:
+            return self.states.get(chat_id, ChatState())
+
+    def transition(self, chat_id: int, transition: Transition) -> Tuple[ChatState, ChatState]:
+        """Applies the transition to the current state and returns the previous and the new state."""
+        with self.lock:
+            previous_state = self.states.get(chat_id, ChatState())
+            new_state = transition(previous_state)
+            self.states[chat_id] = new_state
+            return previous_state, new_state
+
+    def update(self, chat_id: int, **changes) -> ChatState:
+        return self.transition(chat_id, lambda state: replace(state, **changes))[1]
+
+
+class SQLiteChatStateStore:
+    """Same as InMemoryChatStateStore, but the states survive restarts and can be shared by several processes."""
+    def __init__(self, path: Path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS chat_state (chat_id INTEGER PRIMARY KEY, state TEXT)")
+
+    def get(self, chat_id: int) -> ChatState:
+        with self.lock:
+            return self._load(chat_id)
+
+    def transition(self, chat_id: int, transition: Transition) -> Tuple[ChatState, ChatState]:
+        with self.lock:
+            # BEGIN IMMEDIATE takes the write lock up front, so other processes can't interleave
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                previous_state = self._load(chat_id)
+                new_state = transition(previous_state)
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO chat_state (chat_id, state) VALUES (?, ?)",
+                    (chat_id, json.dumps(asdict(new_state)))
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            return previous_state, new_state
+
+    def update(self, chat_id: int, **changes) -> ChatState:
+        return self.transition(chat_id, lambda state: replace(state, **changes))[1]
+
+    def _load(self, chat_id: int) -> ChatState:
+        row = self.connection.execute("SELECT state FROM chat_state WHERE chat_id = ?", (chat_id,)).fetchone()
+        return ChatState(**json.loads(row[0])) if row else ChatState()
+
+
+def create_chat_state_store():
+    """SQLite store if CHAT_STATE_DB is set, in-memory store otherwise."""
+    path = os.getenv("CHAT_STATE_DB")
+    if path:
+        return SQLiteChatStateStore(Path(path))
+    return InMemoryChatStateStore()
@@ -0,0 +1,170 @@
+from collections import deque
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+@dataclass(frozen=True)
+class ClassificationJob:
+    id: int
+    note_id: int
+    chat_id: int
+    note_text: str
+    attempts: int
+
+
+class ClassificationQueue:
+    """
+    Durable local job queue for classifying saved notes in the background.
+    Jobs are stored in SQLite, so pending jobs, and jobs that were running when the process stopped, are picked up
+    again on the next start. A job that raises is retried up to max_attempts times and then marked as failed, and
+    on_failed is called with the job and its last error. Finished jobs are deleted, failed ones are kept with their
+    error.
+    """
+    def __init__(
+            self,
+            path: Path,
+            classify: Callable[[ClassificationJob], None],
+            workers: int = 1,
+            max_attempts: int = 3,
+            poll_interval: float = 5.0,
+            on_failed: Optional[Callable[[ClassificationJob, Exception], None]] = None,
+    ):
+        self.classify = classify
+        self.on_failed = on_failed
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.new_jobs = threading.Condition(self.lock)
+        self.stopped = threading.Event()
+        self.threads: List[threading.Thread] = []
+        self.recent_latencies = deque(maxlen=100)  # seconds from enqueue to done
+        self.finished = {"done": 0, "failed": 0}  # since start, the done jobs are no longer in the table
+        self.connection = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS classification_job ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "note_id INTEGER NOT NULL, "
+            "chat_id INTEGER NOT NULL, "
+            "note_text TEXT NOT NULL, "
+            "status TEXT NOT NULL, "  # pending, running or failed
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, "
+            "finished_at REAL, "
+            "error TEXT)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_classification_job_status ON classification_job (status, id)"
+        )
+
+    def enqueue(self, note_id: int, chat_id: int, note_text: str) -> int:
+        with self.new_jobs:
+            cursor = self.connection.execute(
+                "INSERT INTO classification_job (note_id, chat_id, note_text, status, created_at) "
+                "VALUES (?, ?, ?, 'pending', ?)",
+                (note_id, chat_id, note_text, time.time())
+            )
+            self.new_jobs.notify()
+            return cursor.lastrowid
+
+    def start(self) -> None:
+        with self.lock:
+            # jobs that were running when the process stopped
+            self.connection.execute("UPDATE classification_job SET status = 'pending' WHERE status = 'running'")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"classification-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Classification queue started with {self.depth()} pending jobs")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self.stopped.set()
+        with self.new_jobs:
+            self.new_jobs.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM classification_job WHERE status IN ('pending', 'running')"
+            ).fetchone()[0]
+
+    def stats(self) -> Dict[str, float]:
+        # done and failed count the jobs finished since start
+        with self.lock:
+            counts = dict(self.connection.execute(
+                "SELECT status, COUNT(*) FROM classification_job WHERE status IN ('pending', 'running') GROUP BY status"
+            ).fetchall())
+            finished = dict(self.finished)
+            latencies = sorted(self.recent_latencies)
+        return {
+            "pending": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "done": finished["done"],
+            "failed": finished["failed"],
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+    def _claim(self) -> Optional[ClassificationJob]:
+        row = self.connection.execute(
+            "SELECT id, note_id, chat_id, note_text, attempts FROM classification_job "
+            "WHERE status = 'pending' ORDER BY id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            "UPDATE classification_job SET status = 'running', attempts = attempts + 1 WHERE id = ?", (row[0],)
+        )
+        return ClassificationJob(*row[:4], attempts=row[4] + 1)
+
+    def _work(self) -> None:
+        while not self.stopped.is_set():
+            with self.new_jobs:
+                job = self._claim()
+                if job is None:
+                    self.new_jobs.wait(self.poll_interval)
+                    continue
+            try:
+                self.classify(job)
+            except Exception as e:
+                logger.error(f"Classification job {job.id} failed (attempt {job.attempts}): {e}")
+                status = 'failed' if job.attempts >= self.max_attempts else 'pending'
+                with self.lock:
+                    self.connection.execute(
+                        "UPDATE classification_job SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                        (status, str(e), time.time() if status == 'failed' else None, job.id)
+                    )
+                    if status == 'failed':
+                        self.finished["failed"] += 1
+                if status == 'failed' and self.on_failed is not None:
+                    try:
+                        self.on_failed(job, e)
+                    except Exception as callback_error:
+                        logger.error(f"Handling the failure of classification job {job.id} failed: {callback_error}")
+                # back off before the next job, the model or the API is probably down
+                self.stopped.wait(min(2 ** job.attempts, 60))
+                continue
+            finished_at = time.time()
+            with self.lock:
+                created_at = self.connection.execute(
+                    "SELECT created_at FROM classification_job WHERE id = ?", (job.id,)
+                ).fetchone()[0]
+                # nothing reads a finished job, keeping them would only grow the table
+                self.connection.execute("DELETE FROM classification_job WHERE id = ?", (job.id,))
+                self.recent_latencies.append(finished_at - created_at)
+                self.finished["done"] += 1
+                done_count = self.finished["done"]
+            logger.info(
+                f"Classification job {job.id} done in {finished_at - created_at:.2f}s, {done_count} done since start"
+            )
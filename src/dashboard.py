@@ -1,3 +1,7 @@
+import argparse
+from dataclasses import asdict
+from datetime import datetime
+
 import pandas as pd
 import plotly.graph_objs as go
 import plotly.offline as pyo
@@ -10,19 +14,6 @@ def replace_nan_date_completed(x):
     else:
         return x['date_completed']
 
-# Read the CSV file into a DataFrame
-df = pd.read_csv('data/data_dor_dashboard.csv', parse_dates=['date_created', 'date_completed'], na_values=['None'])
-
-# Convert date columns to datetime format
-df['date_created'] = pd.to_datetime(df['date_created'])
-df['date_completed'] = pd.to_datetime(df['date_completed'])
-
-# Replace NaN values in date_completed with date_created
-# df['date_completed'] = df.apply(replace_nan_date_completed, axis=1)
-
-# Create a new column for days taken to complete the task
-df['days_taken'] = (df['date_completed'] - df['date_created']).dt.days
-
 # Define a function to create a scatter plot with status as the color
 def create_scatter_plot(df, x_col, y_col, color_col):
     # get color map by values of color_col column
@@ -48,14 +39,12 @@ def create_scatter_plot(df, x_col, y_col, color_col):
     )
     return fig
 
-# Create scatter plots for different combinations of columns
-scatter_plot_1 = create_scatter_plot(df, 'urgency', 'days_taken', 'status')
-scatter_plot_2 = create_scatter_plot(df, 'label_semantic', 'label_action', 'status')
-scatter_plot_3 = create_scatter_plot(df, 'urgency', 'days_taken', 'label_semantic')
-
 # Define a function to create a bar chart of task counts by label
 def create_bar_chart(df, col):
-    counts = df[col].value_counts()
+    return create_count_bar_chart(df[col].value_counts(), col)
+
+
+def create_count_bar_chart(counts: pd.Series, col):
     color_map = dict(zip(counts.index, [
         'red', 'green', 'blue', 'yellow', 'black', 'orange', 'pink', 'purple', 'brown', 'grey', 'cyan', 'magenta',
         'lime', 'maroon', 'navy', 'olive', 'teal', 'aqua', 'gold', 'indigo', 'violet', 'turquoise', 'tan', 'orchid',
@@ -76,27 +65,79 @@ def create_bar_chart(df, col):
     )
     return fig
 
-# Create bar charts for different columns
-bar_chart_1 = create_bar_chart(df, 'label_semantic')
-bar_chart_2 = create_bar_chart(df, 'label_action')
-
-# Arrange the plots in a grid using subplots
-fig = make_subplots(
-    rows=4,
-    cols=1,
-    specs=[[{'type': 'scatter'}], [{'type': 'scatter'}], [{'type': 'bar'}], [{'type': 'bar'}]],
-    subplot_titles=(
-        "Days taken to complete task", "Label semantic vs label action", "Task counts by label semantic",
-        "Task counts by label action"
-    ),
-)
-fig.add_trace(scatter_plot_1.data[0], row=1, col=1)
-fig.add_trace(scatter_plot_2.data[0], row=2, col=1)
-fig.add_trace(bar_chart_1.data[0], row=3, col=1)
-fig.add_trace(bar_chart_2.data[0], row=4, col=1)
-
-# Update the layout to add titles and adjust the size
-fig.update_layout(height=1800, width=600, title_text="Task Dashboard")
-
-# Show the dashboard in the notebook or save it to an HTML file
-pyo.plot(fig, filename='task_dashboard.html')
+def create_db_dashboard(since: datetime):
+    # counted with GROUP BY in the database, only the aggregated rows are loaded
+    from db_action_handler import DBActionHandler
+    counts = pd.DataFrame(
+        [asdict(count) for count in DBActionHandler().get_note_counts(since, time_bucket='month')],
+        columns=['label', 'status', 'period', 'count'],
+    )
+    fig = make_subplots(
+        rows=3,
+        cols=1,
+        specs=[[{'type': 'bar'}], [{'type': 'bar'}], [{'type': 'bar'}]],
+        subplot_titles=("Task counts by label", "Task counts by status", "Tasks created per month"),
+    )
+    fig.add_trace(create_count_bar_chart(counts.groupby('label')['count'].sum(), 'label').data[0], row=1, col=1)
+    fig.add_trace(create_count_bar_chart(counts.groupby('status')['count'].sum(), 'status').data[0], row=2, col=1)
+    fig.add_trace(create_count_bar_chart(counts.groupby('period')['count'].sum(), 'period').data[0], row=3, col=1)
+    fig.update_layout(height=1350, width=600, title_text="Task Dashboard")
+    pyo.plot(fig, filename='task_dashboard.html')
+
+
+def create_csv_dashboard():
+    # Read the CSV file into a DataFrame
+    df = pd.read_csv('data/data_dor_dashboard.csv', parse_dates=['date_created', 'date_completed'], na_values=['None'])
+
+    # Convert date columns to datetime format
+    df['date_created'] = pd.to_datetime(df['date_created'])
+    df['date_completed'] = pd.to_datetime(df['date_completed'])
+
+    # Replace NaN values in date_completed with date_created
+    # df['date_completed'] = df.apply(replace_nan_date_completed, axis=1)
+
+    # Create a new column for days taken to complete the task
+    df['days_taken'] = (df['date_completed'] - df['date_created']).dt.days
+
+    # Create scatter plots for different combinations of columns
+    scatter_plot_1 = create_scatter_plot(df, 'urgency', 'days_taken', 'status')
+    scatter_plot_2 = create_scatter_plot(df, 'label_semantic', 'label_action', 'status')
+    scatter_plot_3 = create_scatter_plot(df, 'urgency', 'days_taken', 'label_semantic')
+
+    # Create bar charts for different columns
+    bar_chart_1 = create_bar_chart(df, 'label_semantic')
+    bar_chart_2 = create_bar_chart(df, 'label_action')
+
+    # Arrange the plots in a grid using subplots
+    fig = make_subplots(
+        rows=4,
+        cols=1,
+        specs=[[{'type': 'scatter'}], [{'type': 'scatter'}], [{'type': 'bar'}], [{'type': 'bar'}]],
+        subplot_titles=(
+            "Days taken to complete task", "Label semantic vs label action", "Task counts by label semantic",
+            "Task counts by label action"
+        ),
+    )
+    fig.add_trace(scatter_plot_1.data[0], row=1, col=1)
+    fig.add_trace(scatter_plot_2.data[0], row=2, col=1)
+    fig.add_trace(bar_chart_1.data[0], row=3, col=1)
+    fig.add_trace(bar_chart_2.data[0], row=4, col=1)
+
+    # Update the layout to add titles and adjust the size
+    fig.update_layout(height=1800, width=600, title_text="Task Dashboard")
+
+    # Show the dashboard in the notebook or save it to an HTML file
+    pyo.plot(fig, filename='task_dashboard.html')
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--source', choices=['csv', 'db'], default='csv',
+                      help="'db' plots the note counts from the database instead of the exported CSV")
+    args.add_argument('--since', type=datetime.fromisoformat, default=datetime(2023, 1, 1),
+                      help="with --source db, only notes created since this date (YYYY-MM-DD)")
+    parsed_args = args.parse_args()
+    if parsed_args.source == 'db':
+        create_db_dashboard(parsed_args.since)
+    else:
+        create_csv_dashboard()
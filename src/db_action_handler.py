@@ -1,164 +1,441 @@
-from datetime import datetime, timedelta
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
 import logging
-import os
-from typing import List, Optional
+import re
+import threading
+from typing import Dict, List, Optional
 
-from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import extract, literal_column
+from sqlalchemy.orm import Query, Session
 from sqlalchemy.sql.expression import func
 
-from db_entities import Thought, User
-from plot_maker import PlotMaker
+from db_entities import Thought, User, thought_fts
+from db_utils import session_scope
+from metrics import metrics
+from note_sampler import NoteSampler
 
 
-load_dotenv()
-
 logger = logging.getLogger(__name__)
 logging.basicConfig(level = logging.INFO)
 
+# label of the notes that are saved but not classified yet
+PENDING_LABEL = "Pending"
+# label of the notes whose classification failed on every attempt, the user can retry or pick a category
+UNCLASSIFIED_LABEL = "Unclassified"
+# labels that are set by the bot and are not categories
+PLACEHOLDER_LABELS = (PENDING_LABEL, UNCLASSIFIED_LABEL)
+TIME_BUCKETS = ('day', 'week', 'month')
+# sampled ids whose note is gone or done are skipped, this many times at most
+RANDOM_NOTE_ATTEMPTS = 5
+SEARCH_WORD = re.compile(r"\w+")
+
 
 class DBActionHandler:
-    def __init__(self):
-        self.session = self.get_session()
+    """
+    Note queries take an optional user_id. With a user_id they only see the notes of that user, without one they see
+    the notes of all users (scripts and the dashboard).
+    Every method is one unit of work in its own session from the shared connection pool, so a handler can be used from
+    several threads, and a failed query is rolled back instead of breaking the following ones. The returned notes are
+    detached from their session but keep their loaded values.
+    """
+    plot_cache: dict = {}  # user_id -> date range, note counts and PNG of the user's last /plot
+    plot_cache_lock = threading.Lock()
+    note_sampler = NoteSampler()  # candidate ids for get_random_note
+
+    @staticmethod
+    def commit(session: Session):
+        session.commit()
+
+    @staticmethod
+    def notes(session: Session, user_id: Optional[int] = None) -> Query:
+        query = session.query(Thought)
+        if user_id is not None:
+            query = query.filter(Thought.user_id == user_id)
+        return query
 
+    @staticmethod
+    def update_sampler(thought: Thought) -> None:
+        DBActionHandler.note_sampler.update(
+            thought.id, thought.user_id, thought.status, thought.urgency, thought.date_created
+        )
+
+    @metrics.timed("db")
     def add_thought(self, thought):
         try:
-            # TODO try except to decorator? or use context manager? what is context manager?
-            self.session.add(thought)
-            self.session.commit()
+            with session_scope() as session:
+                session.add(thought)
+                self.commit(session)
+            # a new note is in the youngest age bucket whatever its date_created
+            DBActionHandler.note_sampler.update(thought.id, thought.user_id, thought.status, thought.urgency, None)
         except Exception as e:
             logger.error(e)
 
-    def get_note_by_message_id(self, message_id: int) -> Thought:
+    @metrics.timed("db")
+    def get_note_by_message_id(self, message_id: int, user_id: Optional[int] = None) -> Thought:
         try:
-            thought = self.session.query(Thought).filter(Thought.message_id == message_id).first()
-            return thought
+            with session_scope() as session:
+                return self.notes(session, user_id).filter(Thought.message_id == message_id).first()
         except Exception as e:
             logger.error(e)
 
-    def get_random_note(self) -> Thought:
+    @metrics.timed("db")
+    def get_note_by_id(self, note_id: int, user_id: Optional[int] = None) -> Thought:
         try:
-            # return a random note which status is not "done"
-            thought = self.session.query(Thought).filter(Thought.status != "done").order_by(func.random()).first()
-            return thought
+            with session_scope() as session:
+                return self.notes(session, user_id).filter(Thought.id == note_id).first()
         except Exception as e:
             logger.error(e)
 
-    def update_note_status(self, message_id: int, status: Optional[str]) -> Thought:
+    @metrics.timed("db")
+    def get_notes_by_ids(self, note_ids: List[int], user_id: Optional[int] = None) -> List[Thought]:
+        # returns the notes in the order of note_ids, skipping the ids that don't exist
         try:
-            thought = self.session.query(Thought).filter(Thought.message_id == message_id).first()
-            if status is not None and status != thought.status:
-                thought.status = status
-                # TODO: add logic to handle date_completed if the status is "done"
-                # TODO: write some log to track the status change (maybe don't even store any dates in the Thought table)
-                self.session.commit()
-            return thought
+            with session_scope() as session:
+                thoughts = self.notes(session, user_id).filter(Thought.id.in_(note_ids)).all()
+            thoughts_by_id = {thought.id: thought for thought in thoughts}
+            return [thoughts_by_id[note_id] for note_id in note_ids if note_id in thoughts_by_id]
+        except Exception as e:
+            logger.error(e)
+            return []
+
+    @metrics.timed("db")
+    def search_notes(self, text: str, limit: int = 10, user_id: Optional[int] = None) -> List[Thought]:
+        """
+        Notes that contain all words of `text`, also as prefixes ("meet" finds "meeting"), without the LLM.
+        On SQLite the FTS5 index thought_fts finds the notes and ranks them by BM25, best match first; other databases
+        fall back to LIKE on note_text, newest first.
+        """
+        words = SEARCH_WORD.findall(text)
+        if not words:
+            return []
+        try:
+            with session_scope() as session:
+                query = self.notes(session, user_id)
+                if session.bind.dialect.name == 'sqlite':
+                    # every word is quoted, so the user's text can't be read as FTS5 query syntax
+                    match = " ".join(f'"{word}"*' for word in words)
+                    query = query.join(thought_fts, thought_fts.c.rowid == Thought.id).filter(
+                        literal_column('thought_fts').match(match)
+                    ).order_by(thought_fts.c.rank)
+                else:
+                    query = query.filter(
+                        *[Thought.note_text.contains(word, autoescape=True) for word in words]
+                    ).order_by(Thought.id.desc())
+                return query.limit(limit).all()
+        except Exception as e:
+            logger.error(e)
+            return []
+
+    @metrics.timed("db")
+    def get_random_note(self, user_id: Optional[int] = None, weighted: bool = False) -> Thought:
+        """
+        Returns a random note which status is not "done", or None if there is none.
+        The id is sampled from the cached candidate ids and the note is fetched by primary key, so the cost doesn't
+        grow with the table. With weighted=True more urgent and older notes are more likely, see note_sampler.
+        """
+        sampler = DBActionHandler.note_sampler
+        try:
+            if sampler.needs_load(user_id):
+                with session_scope() as session:
+                    rows = self.notes(session, user_id).filter(Thought.status != "done").with_entities(
+                        Thought.id, Thought.urgency, Thought.date_created
+                    ).all()
+                sampler.load(user_id, rows)
+            for _ in range(RANDOM_NOTE_ATTEMPTS):
+                note_id = sampler.sample(user_id, weighted)
+                if note_id is None:
+                    return None
+                with session_scope() as session:
+                    thought = self.notes(session, user_id).filter(Thought.id == note_id).first()
+                if thought is not None and thought.status != "done":
+                    return thought
+                # deleted or changed by another process since the ids were loaded
+                sampler.discard(note_id)
+        except Exception as e:
+            logger.error(e)
+
+    @metrics.timed("db")
+    def update_note_status(
+            self, message_id: int, status: Optional[str], user_id: Optional[int] = None
+    ) -> Optional[Thought]:
+        # None if no note of the user has this message id, e.g. the message isn't the reply to a note
+        try:
+            with session_scope() as session:
+                thought = self.notes(session, user_id).filter(Thought.message_id == message_id).first()
+                if thought is None:
+                    return None
+                if status is not None and status != thought.status:
+                    thought.status = status
+                    # TODO: add logic to handle date_completed if the status is "done"
+                    # TODO: write some log to track the status change (maybe don't even store any dates in the Thought table)
+                    self.commit(session)
+                    self.update_sampler(thought)
+                return thought
         except Exception as e:
-            logger.error("Error updating note status", e)
+            logger.error(f"Error updating note status: {e}")
 
-    def update_note_category(self, message_id: Optional[int], category: str) -> Thought:
+    @metrics.timed("db")
+    def update_note_category(
+            self, message_id: Optional[int], category: str, user_id: Optional[int] = None
+    ) -> Thought:
         # Assumes that the new category comes from telegram and message_id is not None
         try:
-            thought = self.session.query(Thought).filter(Thought.message_id == message_id).first()
-            if category != thought.label:
-                thought.label = category
-                self.session.commit()
-            return thought
+            with session_scope() as session:
+                thought = self.notes(session, user_id).filter(Thought.message_id == message_id).first()
+                if category != thought.label:
+                    thought.label = category
+                    self.commit(session)
+                return thought
+        except Exception as e:
+            logger.error(e)
+
+    @metrics.timed("db")
+    def update_note_message_id(self, note_id: int, message_id: int) -> None:
+        try:
+            with session_scope() as session:
+                thought = session.query(Thought).filter(Thought.id == note_id).first()
+                thought.message_id = message_id
+                self.commit(session)
         except Exception as e:
             logger.error(e)
 
-    def update_note_urgency(self, message_id: Optional[int], urgency: str):
+    @metrics.timed("db")
+    def set_predicted_label(self, note_id: int, label: str) -> Optional[Thought]:
+        """
+        Sets the label of a note that has a placeholder label, in one unit of work. Returns the note, or None if the
+        user has picked a category in the meantime or the note is gone. Errors are raised, so that the classification
+        job is retried.
+        """
+        with session_scope() as session:
+            thought = session.query(Thought).filter(
+                Thought.id == note_id, Thought.label.in_(PLACEHOLDER_LABELS)
+            ).first()
+            if thought is None:
+                return None
+            thought.label = label
+            self.commit(session)
+            return thought
+
+    @metrics.timed("db")
+    def update_note_urgency(self, message_id: Optional[int], urgency: str, user_id: Optional[int] = None):
         if message_id is None:
             return
         try:
-            thought = self.session.query(Thought).filter(Thought.message_id == message_id).first()
-            if urgency != thought.urgency:
-                thought.urgency = urgency
-                self.session.commit()
+            with session_scope() as session:
+                thought = self.notes(session, user_id).filter(Thought.message_id == message_id).first()
+                if urgency != thought.urgency:
+                    thought.urgency = urgency
+                    self.commit(session)
+                    self.update_sampler(thought)
         except Exception as e:
             logger.error(e)
 
-    def update_note_eta(self, message_id: Optional[int], eta: str):
+    @metrics.timed("db")
+    def update_note_eta(self, message_id: Optional[int], eta: str, user_id: Optional[int] = None):
         if message_id is None:
             return
         try:
-            thought = self.session.query(Thought).filter(Thought.message_id == message_id).first()
-            if eta != thought.eta:
-                thought.eta = eta
-                self.session.commit()
+            with session_scope() as session:
+                thought = self.notes(session, user_id).filter(Thought.message_id == message_id).first()
+                if eta != thought.eta:
+                    thought.eta = eta
+                    self.commit(session)
         except Exception as e:
             logger.error(e)
 
-    def show_last_n(self, n=10):
+    @metrics.timed("db")
+    def show_last_n(self, n=10, user_id: Optional[int] = None):
         try:
-            thoughts = self.session.query(Thought).order_by(Thought.id.desc()).limit(n).all()
-            return thoughts
+            with session_scope() as session:
+                return self.notes(session, user_id).order_by(Thought.id.desc()).limit(n).all()
         except Exception as e:
             logger.error(e)
 
-    def get_recent_notes(self, time_frame=10):
+    @metrics.timed("db")
+    def get_recent_notes(self, time_frame=10, user_id: Optional[int] = None):
         # get recent notes (last time_frame days) with the status "Open"
         try:
             start_date = datetime.now() - timedelta(days=time_frame)
-            thoughts = self.session.query(Thought).filter(Thought.date_created > start_date).filter(
-                Thought.status == "open").all()
-            return thoughts
+            with session_scope() as session:
+                return self.notes(session, user_id).filter(Thought.date_created > start_date).filter(
+                    Thought.status == "open").all()
         except Exception as e:
             logger.error(e)
 
-    def get_all_notes(self) -> List:
-        query = self.session.query(Thought)
-        record_count = query.count()
+    @metrics.timed("db")
+    def get_all_notes(self, user_id: Optional[int] = None) -> List:
+        # all classified notes, the RAG indexes every one of them for /query and as examples
+        with session_scope() as session:
+            return self.notes(session, user_id).filter(Thought.label.notin_(PLACEHOLDER_LABELS)).all()
+
+    @metrics.timed("db")
+    def filter_notes(
+            self,
+            label: Optional[str] = None,
+            status: Optional[str] = None,
+            since: Optional[datetime] = None,
+            limit: Optional[int] = None,
+            user_id: Optional[int] = None,
+            after_id: Optional[int] = None,
+    ) -> List[Thought]:
+        # ordered by id; after_id skips the notes up to that id, e.g. the ones an interrupted run has processed
+        try:
+            with session_scope() as session:
+                query = self.notes(session, user_id)
+                if after_id is not None:
+                    query = query.filter(Thought.id > after_id)
+                if label is not None:
+                    query = query.filter(Thought.label == label)
+                if status is not None:
+                    query = query.filter(Thought.status == status)
+                if since is not None:
+                    query = query.filter(Thought.date_created >= since)
+                query = query.order_by(Thought.id)
+                if limit is not None:
+                    query = query.limit(limit)
+                return query.all()
+        except Exception as e:
+            logger.error(e)
+            return []
 
-        if record_count > 1000:
-            query = query.order_by(Thought.id.desc()).limit(1000)
+    @metrics.timed("db")
+    def bulk_update_labels(self, labels: Dict[int, str]) -> None:
+        # labels: note id -> new label, written in one bulk UPDATE; errors are raised, so that the caller knows the
+        # labels were not written
+        with session_scope() as session:
+            session.bulk_update_mappings(
+                Thought, [{'id': note_id, 'label': label} for note_id, label in labels.items()]
+            )
+            self.commit(session)
 
-        return query.all()
+    @metrics.timed("db")
+    def get_note_counts(
+            self,
+            start: datetime,
+            end: Optional[datetime] = None,
+            user_id: Optional[int] = None,
+            time_bucket: Optional[str] = None,
+    ) -> List["NoteCount"]:
+        """
+        Number of notes per label, status and, optionally, time bucket ('day', 'week' or 'month') of date_created, for
+        the notes created in [start, end). The notes are counted with GROUP BY in the database, only the aggregated
+        rows are returned.
+        The buckets are grouped by EXTRACT(year/month/day FROM date_created), which SQLAlchemy renders for every
+        dialect; weeks are summed up from the day rows here.
+        """
+        if time_bucket not in (None,) + TIME_BUCKETS:
+            raise ValueError(f"time_bucket must be one of {TIME_BUCKETS} or None, got {time_bucket!r}")
+        date_parts = []
+        if time_bucket is not None:
+            date_parts = [extract('year', Thought.date_created), extract('month', Thought.date_created)]
+            if time_bucket != 'month':
+                date_parts.append(extract('day', Thought.date_created))
+        with session_scope() as session:
+            query = session.query(Thought.label, Thought.status, *date_parts, func.count(Thought.id)).filter(
+                Thought.date_created >= start
+            )
+            if end is not None:
+                query = query.filter(Thought.date_created < end)
+            if user_id is not None:
+                query = query.filter(Thought.user_id == user_id)
+            rows = query.group_by(Thought.label, Thought.status, *date_parts).all()
+        counts: Dict[tuple, int] = {}
+        for label, status, *parts, count in rows:
+            key = (label, status, get_period(parts, time_bucket))
+            counts[key] = counts.get(key, 0) + count
+        return [NoteCount(label, status, period, count) for (label, status, period), count in counts.items()]
 
-    def send_plots(self):
-        # TODO take two dates as arguments
+    @metrics.timed("db")
+    def send_plots(self, start: Optional[datetime] = None, end: Optional[datetime] = None):
+        # imported here to keep matplotlib out of the bot startup
+        from plot_maker import PlotMaker
         try:
-            # get thoughts with date_created not older than a month
-            thoughts = self.session.execute(
-                "SELECT * FROM thought WHERE date_created > DATE_SUB(NOW(), INTERVAL 2 MONTH)"
-            ).fetchall()
-            filename = PlotMaker.get_plots(thoughts)
+            counts = self.get_note_counts(start or get_plot_start(), end)
+            filename = PlotMaker.get_plots(counts)
             return filename
         except Exception as e:
             logger.error(e)
 
-    def add_user(self, username, password, email, is_admin):
+    @metrics.timed("db")
+    def get_plot_image(
+            self, user_id: Optional[int] = None, start: Optional[datetime] = None, end: Optional[datetime] = None
+    ) -> Optional[bytes]:
+        """
+        Returns the /plot PNG for the notes created in [start, end), the last two months by default, or None if it
+        can't be drawn. The counts are queried on every call, so writes by other processes are seen as well, but the
+        image of the last plot of each user is cached and only rendered again when the date range or the counts change.
+        One entry per user, which replaces the previous one, so the cache doesn't grow as the default range moves.
+        """
+        # imported here to keep matplotlib out of the bot startup
+        from plot_maker import PlotMaker
+        start = start or get_plot_start()
         try:
-            user = User(username=username, password=password, email=email, is_admin=is_admin)
-            self.session.add(user)
-            self.session.commit()
+            # the lock only guards the cache, the query and the rendering of different users run in parallel
+            counts = self.get_note_counts(start, end, user_id)
+            with DBActionHandler.plot_cache_lock:
+                cached = DBActionHandler.plot_cache.get(user_id, {})
+            if cached.get('range') == (start, end) and cached.get('counts') == counts:
+                return cached['png']
+            png = PlotMaker.get_plot_image(counts)
+            with DBActionHandler.plot_cache_lock:
+                DBActionHandler.plot_cache[user_id] = {'range': (start, end), 'counts': counts, 'png': png}
+            return png
         except Exception as e:
             logger.error(e)
 
+    @metrics.timed("db")
+    def add_user(self, username, password, email, is_admin) -> Optional[User]:
+        try:
+            with session_scope() as session:
+                user = User(username=username, password=password, email=email, is_admin=is_admin)
+                session.add(user)
+                self.commit(session)
+                return user
+        except Exception as e:
+            logger.error(e)
+
+    @metrics.timed("db")
     def get_user(self, username):
         try:
-            user = self.session.query(User).filter(User.username == username).first()
-            return user
+            with session_scope() as session:
+                return session.query(User).filter(User.username == username).first()
         except Exception as e:
             logger.error(e)
 
-    def get_all_categories(self):
+    @metrics.timed("db")
+    def get_all_categories(self, user_id: Optional[int] = None):
         try:
-            categories = self.session.query(Thought.label).distinct().all()
+            with session_scope() as session:
+                query = session.query(Thought.label)
+                if user_id is not None:
+                    query = query.filter(Thought.user_id == user_id)
+                categories = query.filter(Thought.label.notin_(PLACEHOLDER_LABELS)).distinct().all()
             return [str(category[0]) for category in categories]
         except Exception as e:
             logger.error(e)
 
-    @staticmethod
-    def get_session():
-        url = os.getenv("DB_URL")
-        engine = create_engine(
-            url,
-            connect_args=dict(host=os.getenv("DB_HOST"), port=3306)
-        )
-        Session = sessionmaker(bind=engine)
-        return Session()
+
+@dataclass(frozen=True)
+class NoteCount:
+    label: Optional[str]
+    status: Optional[str]
+    period: Optional[date]  # first day of the time bucket, None if the counts are not bucketed by time
+    count: int
+
+
+def get_period(date_parts: List[int], time_bucket: Optional[str]) -> Optional[date]:
+    if time_bucket is None:
+        return None
+    if time_bucket == 'month':
+        return date(int(date_parts[0]), int(date_parts[1]), 1)
+    day = date(*(int(part) for part in date_parts))
+    return day - timedelta(days=day.weekday()) if time_bucket == 'week' else day
+
+
+def get_plot_start() -> datetime:
+    # midnight two months ago, so the default range and its cached plot stay the same for the whole day
+    return datetime.combine(date.today() - relativedelta(months=2), datetime.min.time())
 
 
 if __name__ == "__main__":
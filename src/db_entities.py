@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Index, DDL, event
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql import column, table
 from sqlalchemy.sql.expression import func
 
 
@@ -17,6 +18,24 @@ class Thought(Base):
     date_created = Column(DateTime, default=func.now())  # TODO test this
     date_completed = Column(DateTime)
     message_id = Column(Integer)
+    user_id = Column(Integer, ForeignKey('user.id'))  # owner of the note
+
+    # Every bot query is scoped to one user, so user_id leads each index and a user's rows form one index range;
+    # the indexes without user_id serve the scripts and the dashboard, which query all users.
+    # Existing databases get these with `python src/ddl_scripts.py migrate`.
+    __table_args__ = (
+        Index('ix_thought_user_id_id', 'user_id', 'id'),
+        # button callbacks find their note by the message the buttons are attached to;
+        # Telegram message ids are only unique within a chat, i.e. per user
+        Index('uq_thought_user_id_message_id', 'user_id', 'message_id', unique=True),
+        Index('ix_thought_message_id', 'message_id'),
+        # get_all_categories (DISTINCT label)
+        Index('ix_thought_user_id_label', 'user_id', 'label'),
+        Index('ix_thought_label', 'label'),
+        # get_recent_notes, get_random_note (status, then a date_created range)
+        Index('ix_thought_user_id_status_date_created', 'user_id', 'status', 'date_created'),
+        Index('ix_thought_status_date_created', 'status', 'date_created'),
+    )
 
     def __repr__(self):
         thought_col_len = 40
@@ -31,10 +50,32 @@ class Thought(Base):
                f"{self.date_completed}"
 
 
+# Full-text index of the note texts for /search, SQLite only (FTS5). It is an external content table, i.e. it stores
+# only the index and reads the texts from the thought table; the triggers keep it in sync on every insert, update and
+# delete, including bulk inserts. Created with the thought table, existing databases get it with `ddl_scripts migrate`.
+THOUGHT_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS thought_fts USING fts5("
+    "note_text, content='thought', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS thought_fts_insert AFTER INSERT ON thought BEGIN "
+    "INSERT INTO thought_fts(rowid, note_text) VALUES (new.id, new.note_text); END",
+    "CREATE TRIGGER IF NOT EXISTS thought_fts_delete AFTER DELETE ON thought BEGIN "
+    "INSERT INTO thought_fts(thought_fts, rowid, note_text) VALUES ('delete', old.id, old.note_text); END",
+    "CREATE TRIGGER IF NOT EXISTS thought_fts_update AFTER UPDATE OF note_text ON thought BEGIN "
+    "INSERT INTO thought_fts(thought_fts, rowid, note_text) VALUES ('delete', old.id, old.note_text); "
+    "INSERT INTO thought_fts(rowid, note_text) VALUES (new.id, new.note_text); END",
+)
+# rank is the BM25 score of a match, lower is better
+thought_fts = table('thought_fts', column('rowid'), column('rank'))
+
+for statement in THOUGHT_FTS_DDL:
+    event.listen(Thought.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Thought.__table__, 'after_drop', DDL("DROP TABLE IF EXISTS thought_fts").execute_if(dialect='sqlite'))
+
+
 class User(Base):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    username = Column(String(64))
+    username = Column(String(64), index=True)
     password = Column(String(64))
     email = Column(String(64))
     is_admin = Column(Boolean)
@@ -49,6 +90,18 @@ class Category(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     show_category = Column(String(512))
     semantic_category = Column(String(512))
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)  # owner of the category
 
     def __repr__(self):
         return f"<Category(show_category={self.show_category})>"
+
+
+class ImportCheckpoint(Base):
+    # number of rows of a CSV import that are committed, so that an interrupted import can resume after them
+    __tablename__ = 'import_checkpoint'
+    source = Column(String(512), primary_key=True)
+    rows_committed = Column(Integer)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<ImportCheckpoint(source={self.source}, rows_committed={self.rows_committed})>"
@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+import logging
+import os
+import threading
+from typing import Iterator, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from metrics import metrics
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+_engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
+# Objects stay usable after their unit of work is committed and the session is closed
+_session_factory = sessionmaker(expire_on_commit=False)
+
+# set on every new connection of an embedded SQLite database
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),  # readers don't block the writer and the writer doesn't block readers
+    ("synchronous", "NORMAL"),  # with WAL, a commit doesn't wait for an fsync; a crash can't corrupt the file
+    ("busy_timeout", 5000),  # milliseconds to wait for the write lock before 'database is locked'
+    ("foreign_keys", "ON"),
+    ("cache_size", -64000),  # 64 MB of page cache per connection
+    ("temp_store", "MEMORY"),
+    ("mmap_size", 268435456),
+)
+
+
+def get_engine() -> Engine:
+    """The engine of the process, created on first use. All sessions share its connection pool."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_database_engine(get_database_url())
+        return _engine
+
+
+def get_database_url() -> Optional[str]:
+    """DB_URL, or an embedded SQLite database in the file DB_PATH if DB_URL isn't set."""
+    url = os.getenv("DB_URL")
+    if not url and os.getenv("DB_PATH"):
+        url = f"sqlite:///{os.getenv('DB_PATH')}"
+    return url
+
+
+def create_database_engine(url: str) -> Engine:
+    """
+    A MySQL server or an embedded SQLite database, depending on the URL.
+    MySQL connections are checked with a ping before they are handed out and replaced after DB_POOL_RECYCLE seconds,
+    so connections closed by MySQL's wait_timeout are not used.
+    """
+    if make_url(url).get_backend_name() == "sqlite":
+        return create_sqlite_engine(url)
+    return create_engine(
+        url,
+        connect_args=dict(host=os.getenv("DB_HOST"), port=int(os.getenv("DB_PORT", 3306))),
+        pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        pool_pre_ping=True,
+    )
+
+
+def create_sqlite_engine(url: str) -> Engine:
+    """
+    An embedded SQLite database with the SQLITE_PRAGMAS. A database file gets a pool of connections, which the bot's
+    threads share; writes are serialized by SQLite and wait up to busy_timeout for each other.
+    """
+    pool_args = {}
+    if make_url(url).database not in (None, "", ":memory:"):
+        # an in-memory database exists only in its own connection, so it keeps SQLAlchemy's default pool
+        pool_args = dict(
+            poolclass=QueuePool,
+            pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        )
+    engine = create_engine(url, connect_args=dict(check_same_thread=False), **pool_args)
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
+def get_session() -> Session:
+    """A new session on the shared engine; the caller has to close it."""
+    return _session_factory(bind=get_engine())
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """
+    One unit of work: commits at the end of the block, rolls back if the block raises, and always closes the session,
+    which returns its connection to the pool.
+    """
+    session = get_session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        # counted here, since DBActionHandler logs and swallows most errors
+        metrics.inc("db_rollbacks_total")
+        raise
+    finally:
+        session.close()
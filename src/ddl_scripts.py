@@ -1,26 +1,36 @@
 import argparse
 import logging
-import os
+from pathlib import Path
+import time
+from typing import Callable, List, Optional
 
 from dotenv import load_dotenv
-import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
-from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import Integer
-from tqdm import tqdm
+from sqlalchemy import Integer, inspect
+from sqlalchemy.sql.expression import func
 
-from db_entities import Thought, Category
+import db_utils
+from db_entities import THOUGHT_FTS_DDL, Base, Category, ImportCheckpoint, Thought, User
 
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 logging.basicConfig(level = logging.DEBUG)
 
-Base = declarative_base()
+# indexes of earlier schema versions that were replaced, table -> index names
+OBSOLETE_INDEXES = {
+    'thought': ['ix_thought_user_id_message_id', 'ix_thought_user_id_status'],
+}
+THOUGHT_CSV_COLUMNS = ['note_text', 'label', 'urgency', 'status', 'eta', 'date_created', 'date_completed']
+CATEGORY_CSV_COLUMNS = ['show_category', 'semantic_category']
+
+
+def convert_thoughts(df: pd.DataFrame) -> pd.DataFrame:
+    df['eta'] = df['eta'].fillna(0.5)
+    df['date_created'] = pd.to_datetime(df['date_created'], errors='coerce')
+    df['date_completed'] = pd.to_datetime(df['date_completed'], errors='coerce')
+    return df
 
 
 class DB_DDL:
@@ -48,43 +58,89 @@ class DB_DDL:
     def drop_table(self, table: Base):
         table.__table__.drop(self.session.bind)
 
-    def add_thoughts_from_csv(self, csv_file):
+    def import_csv(
+            self,
+            csv_file,
+            model,
+            columns: List[str],
+            convert: Callable[[pd.DataFrame], pd.DataFrame],
+            chunksize: int = 5000,
+            commit_size: int = 20000,
+            resume: bool = True,
+            **constant_values,
+    ) -> int:
+        """
+        Streams a CSV into the table of the model: reads chunksize rows at a time, converts them with convert and
+        writes each chunk with one multi-row INSERT. Commits every commit_size rows, together with a checkpoint of the
+        rows committed so far, so an interrupted import resumes after the last commit when resume is True.
+        :param constant_values: column values for every row, e.g. user_id
+        :return: number of rows imported by this call
+        """
+        source = f"{model.__tablename__}:{Path(csv_file).resolve()}"
+        skip_rows = self.get_checkpoint(source) if resume else 0
+        if skip_rows:
+            logger.info(f"Resuming the import of {csv_file} after {skip_rows} committed rows.")
+        reader = pd.read_csv(
+            csv_file,
+            na_values='none',
+            usecols=lambda column: column in columns,
+            skiprows=range(1, skip_rows + 1),
+            chunksize=chunksize,
+        )
+        started_at = time.monotonic()
+        imported = 0
+        uncommitted = 0
         try:
-            df = pd.read_csv(csv_file, na_values='none')
-            # replace Nan with None
-            df = df.where(pd.notnull(df), None)
-            df['eta'].fillna(0.5, inplace=True)
-            df = df.fillna(np.nan).astype(object).replace({np.nan: None})
-            for _, row in tqdm(df.iterrows(), total=len(df)):
-                thought = Thought(
-                    note_text=row['note_text'],
-                    label=row['label'],
-                    urgency=row['urgency'],
-                    status=row['status'],
-                    eta=row['eta'],
-                    date_created=row['date_created'],
-                    date_completed=row['date_completed']
-                )
-                self.session.add(thought)
-            self.session.commit()
+            for chunk in reader:
+                df = convert(chunk.reindex(columns=columns))
+                for column, value in constant_values.items():
+                    df[column] = value
+                # NaN and NaT to None
+                records = df.astype(object).where(df.notna(), None).to_dict('records')
+                self.session.execute(model.__table__.insert(), records)
+                imported += len(records)
+                uncommitted += len(records)
+                if uncommitted >= commit_size:
+                    self.commit_import(source, skip_rows + imported)
+                    uncommitted = 0
+                    logger.info(
+                        f"Imported {skip_rows + imported} rows into '{model.__tablename__}', "
+                        f"{imported / (time.monotonic() - started_at):.0f} rows/s"
+                    )
+            self.commit_import(source, None)
         except Exception as e:
-            logger.error(e)
+            self.session.rollback()
+            logger.error(f"Import of {csv_file} failed after {skip_rows + imported - uncommitted} committed rows, "
+                         f"run it again to resume: {e}")
+            raise
+        logger.info(
+            f"Imported {imported} rows into '{model.__tablename__}' in {time.monotonic() - started_at:.1f}s, "
+            f"{imported / max(time.monotonic() - started_at, 1e-9):.0f} rows/s"
+        )
+        return imported
 
-    def add_categories_from_csv(self, csv_file):
-        try:
-            df = pd.read_csv(csv_file, na_values='none')
-            # replace Nan with None
-            df = df.where(pd.notnull(df), None)
-            df = df.fillna(np.nan).astype(object).replace({np.nan: None})
-            for _, row in tqdm(df.iterrows(), total=len(df)):
-                category = Category(
-                    show_category=row['show_category'],
-                    semantic_category=row['semantic_category']
-                )
-                self.session.add(category)
-            self.session.commit()
-        except Exception as e:
-            logger.error(e)
+    def get_checkpoint(self, source: str) -> int:
+        ImportCheckpoint.__table__.create(bind=self.session.bind, checkfirst=True)
+        checkpoint = self.session.query(ImportCheckpoint).filter(ImportCheckpoint.source == source).first()
+        return checkpoint.rows_committed if checkpoint else 0
+
+    def commit_import(self, source: str, rows_committed: Optional[int]):
+        # the checkpoint is written in the transaction of the rows it counts; None means that the import is complete
+        if rows_committed is None:
+            self.session.query(ImportCheckpoint).filter(ImportCheckpoint.source == source).delete()
+        else:
+            self.session.merge(ImportCheckpoint(source=source, rows_committed=rows_committed))
+        self.session.commit()
+
+    def add_thoughts_from_csv(self, csv_file, user_id: Optional[int] = None, **kwargs) -> int:
+        return self.import_csv(
+            csv_file, Thought, THOUGHT_CSV_COLUMNS, convert_thoughts, user_id=user_id, **kwargs
+        )
+
+    def add_categories_from_csv(self, csv_file, user_id: Optional[int] = None, **kwargs) -> int:
+        return self.import_csv(
+            csv_file, Category, CATEGORY_CSV_COLUMNS, lambda df: df, user_id=user_id, **kwargs
+        )
 
     def add_column(self, table: Base, column: str, column_type):
         self.session.execute(f"ALTER TABLE {table.__tablename__} ADD COLUMN {column} {column_type().compile(self.session.bind.dialect)}")
@@ -103,6 +159,95 @@ class DB_DDL:
             logger.error(f"Error renaming column: {e}")
             raise
 
+    def migrate(self, owner: Optional[str] = None):
+        """
+        Brings an existing database to the schema declared in db_entities: creates the missing tables and user_id
+        columns, drops the indexes that were replaced and creates the missing indexes, and on SQLite the full-text
+        index of the notes. Safe to run repeatedly.
+        :param owner: username that the notes and categories without an owner are assigned to before the indexes are
+        created, see assign_owner
+        """
+        bind = self.session.bind
+        Base.metadata.create_all(bind)  # only creates the tables that don't exist yet
+        inspector = inspect(bind)
+        for model in (Thought, Category):
+            columns = {column['name'] for column in inspector.get_columns(model.__tablename__)}
+            if 'user_id' not in columns:
+                self.add_column(model, 'user_id', Integer)
+        if owner is not None:
+            self.assign_rows_without_owner(owner)
+
+        for model in (Thought, Category, User):
+            table_name = model.__tablename__
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table_name)}
+            for index_name in OBSOLETE_INDEXES.get(table_name, []):
+                if index_name in existing_indexes:
+                    self.drop_index(table_name, index_name)
+            for index in model.__table__.indexes:
+                if index.name in existing_indexes:
+                    continue
+                if index.unique:
+                    self.check_unique(model, [column.name for column in index.columns])
+                index.create(bind)
+                logger.info(f"Index '{index.name}' created.")
+        if bind.dialect.name == 'sqlite' and 'thought_fts' not in inspector.get_table_names():
+            self.create_full_text_index()
+
+    def create_full_text_index(self):
+        """Creates the FTS5 index of the note texts with its triggers and indexes the existing notes."""
+        for statement in THOUGHT_FTS_DDL:
+            self.session.execute(statement)
+        self.session.execute("INSERT INTO thought_fts(thought_fts) VALUES ('rebuild')")
+        self.session.commit()
+        logger.info("Full-text index 'thought_fts' created.")
+
+    def drop_index(self, table_name: str, index_name: str):
+        if self.session.bind.dialect.name == 'mysql':
+            self.session.execute(f"DROP INDEX {index_name} ON {table_name}")
+        else:
+            self.session.execute(f"DROP INDEX {index_name}")
+        self.session.commit()
+        logger.info(f"Index '{index_name}' dropped.")
+
+    def check_unique(self, model, column_names: List[str]):
+        """Raises if rows would violate a unique index on the columns, listing a few of the duplicates."""
+        columns = [getattr(model, column_name) for column_name in column_names]
+        duplicates = self.session.query(*columns, func.count()).filter(
+            *[column.isnot(None) for column in columns]
+        ).group_by(*columns).having(func.count() > 1).limit(10).all()
+        if duplicates:
+            raise ValueError(
+                f"Can't create a unique index on {model.__tablename__} {column_names}, "
+                f"these values occur more than once (values, count): {duplicates}"
+            )
+        # ends the read transaction, which would block the CREATE INDEX on MySQL
+        self.session.commit()
+
+    def assign_owner(self, username: str):
+        """
+        Migrates a single-user database: runs the migration and assigns the notes and categories without an owner to
+        the given user, who is created as an admin if needed.
+        """
+        self.migrate(owner=username)
+
+    def get_or_create_owner(self, username: str) -> User:
+        """Returns the user with this username, created as an admin if there is none."""
+        user = self.session.query(User).filter(User.username == username).first()
+        if user is None:
+            user = User(username=username, is_admin=True)
+            self.session.add(user)
+            self.session.flush()
+        return user
+
+    def assign_rows_without_owner(self, username: str):
+        user = self.get_or_create_owner(username)
+        for model in (Thought, Category):
+            count = self.session.query(model).filter(model.user_id.is_(None)).update(
+                {model.user_id: user.id}, synchronize_session=False
+            )
+            logger.info(f"Assigned {count} rows of '{model.__tablename__}' to '{username}'.")
+        self.session.commit()
+
     def map_labels(self):
         df = pd.read_csv('data/category_paths.csv')
         mapping_dict = pd.Series(df.show_category.values, index=df.semantic_category).to_dict()
@@ -114,54 +259,84 @@ class DB_DDL:
 
     @staticmethod
     def get_session():
-        # TODO move to utils so that it can be reused in db_action_handler
-        url = os.getenv("DB_URL")
-        engine = create_engine(
-            url,
-            connect_args=dict(host=os.getenv("DB_HOST"), port=3306)
-        )
-        Session = sessionmaker(bind=engine)
-        return Session()
+        return db_utils.get_session()
 
 
-def reload_data(csv_file):
+def reload_data(csv_file, owner: str, resume: bool = False, **import_kwargs):
     """
     Reloads data from csv file to the database. Removes all the data from the database and replaces it with the data
     from the csv file.
     :param csv_file:
+    :param owner: username that the notes are imported for, created as an admin if needed; the bot only shows users
+    their own notes
+    :param resume: continue an interrupted reload instead of dropping the tables again; raises a ValueError if there
+    is no interrupted reload of this file, the tables are never dropped with resume
+    :param import_kwargs: chunksize and commit_size, see DB_DDL.import_csv
     :return:
     """
     db_ddl = DB_DDL()
-    inspector = Inspector.from_engine(db_ddl.session.bind)
+    if resume:
+        if not db_ddl.get_checkpoint(f"{Thought.__tablename__}:{Path(csv_file).resolve()}"):
+            raise ValueError(
+                f"There is no interrupted reload of '{csv_file}' to resume: it has completed, or was started with "
+                f"another path. Nothing was changed."
+            )
+        db_ddl.add_thoughts_from_csv(csv_file, user_id=db_ddl.get_or_create_owner(owner).id, **import_kwargs)
+        return
     # TODO add a check to see if the csv file exists
     # TODO backup the database before dropping the tables
-    tables_before = inspector.get_table_names()
+    tables_before = inspect(db_ddl.session.bind).get_table_names()
     logger.info(f"Tables before drop: {tables_before}")
 
     db_ddl.drop_all_tables()
 
-    # Checking tables after drop
-    tables_after_drop = inspector.get_table_names()
+    # Checking tables after drop, with a new inspector because an inspector caches what it has read
+    tables_after_drop = inspect(db_ddl.session.bind).get_table_names()
     logger.info(f"Tables after drop: {tables_after_drop}")
     db_ddl.create_all_tables()
-    db_ddl.add_thoughts_from_csv(csv_file)
+    user_id = db_ddl.get_or_create_owner(owner).id
+    db_ddl.session.commit()
+    db_ddl.add_thoughts_from_csv(csv_file, user_id=user_id, resume=False, **import_kwargs)
 
 
 if __name__ == '__main__':
-    # TODO create a function for this:
-    # ask the user if they want to reload the data from the csv file
-    # reload = input("Do you want to reload the data from the csv file? "
-    #                "This will remove all current data in the database! (yes/no): ")
-    # args = argparse.ArgumentParser()
-    # args.add_argument('--csv', type=str)
-    # parsed_args = args.parse_args()
-    # if reload == 'yes':
-    #     reload_data(parsed_args.csv)
-    # elif reload == 'no':
-    #     print("Data not reloaded.")
-    # else:
-    #     print("Invalid input. Please type 'yes' or 'no'.")
+    args = argparse.ArgumentParser()
+    args.add_argument('command', nargs='?', default='import-categories',
+                      choices=['import-categories', 'migrate', 'assign-owner', 'reload'],
+                      help="'migrate' applies the tables, columns and indexes declared in db_entities to an existing "
+                           "database, 'assign-owner' also assigns the notes without an owner to --username, "
+                           "'reload' replaces all data with the notes from --csv, owned by --username")
+    args.add_argument('--username', type=str, help="required for 'assign-owner' and 'reload'")
+    args.add_argument('--csv', type=str, help="required for 'reload'")
+    args.add_argument('--resume', action='store_true', help="continue an interrupted reload")
+    args.add_argument('--chunksize', type=int, default=5000, help="rows per INSERT")
+    args.add_argument('--commit-size', type=int, default=20000, help="rows per transaction")
+    parsed_args = args.parse_args()
+
+    if parsed_args.command == 'reload':
+        if not parsed_args.csv or not parsed_args.username:
+            args.error("'reload' requires --csv and --username")
+        reload = 'yes' if parsed_args.resume else input(
+            "Do you want to reload the data from the csv file? "
+            "This will remove all current data in the database! (yes/no): "
+        )
+        if reload == 'yes':
+            try:
+                reload_data(parsed_args.csv, parsed_args.username, resume=parsed_args.resume,
+                            chunksize=parsed_args.chunksize, commit_size=parsed_args.commit_size)
+            except ValueError as e:
+                raise SystemExit(str(e))
+        else:
+            print("Data not reloaded.")
+        raise SystemExit
 
     db_ddl = DB_DDL()
-    db_ddl.create_table_from_model(Category)
-    db_ddl.add_categories_from_csv('data/category_paths.csv')
+    if parsed_args.command == 'migrate':
+        db_ddl.migrate()
+    elif parsed_args.command == 'assign-owner':
+        if not parsed_args.username:
+            args.error("'assign-owner' requires --username")
+        db_ddl.assign_owner(parsed_args.username)
+    else:
+        db_ddl.create_table_from_model(Category)
+        db_ddl.add_categories_from_csv('data/category_paths.csv')
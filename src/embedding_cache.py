@@ -0,0 +1,95 @@
+import hashlib
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+LOGGER = logging.getLogger("embedding_cache")
+LOGGER.setLevel(logging.INFO)
+
+# note ids per SELECT, below SQLite's limit on the number of query parameters
+LOAD_CHUNK_SIZE = 500
+
+
+class EmbeddingCache:
+    """
+    Keeps note embeddings on disk, keyed by note id and a hash of the embedding model name and the embedded text.
+    Only notes that are new or whose text changed since the last run, or all notes after the model changed, go
+    through the embedding model.
+    """
+    def __init__(
+            self,
+            embedding_function,
+            path: Path = Path("./embedding_cache.sqlite"),
+            model_name: Optional[str] = None,
+    ):
+        self.embedding_function = embedding_function
+        self.model_name = model_name if model_name is not None else getattr(embedding_function, "model_name", "")
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS note_embedding ("
+            "note_id INTEGER PRIMARY KEY, "
+            "text_hash TEXT NOT NULL, "
+            "embedding BLOB NOT NULL)"
+        )
+        self.connection.commit()
+
+    def get_embeddings(self, texts: Dict[int, str]) -> Dict[int, np.ndarray]:
+        """
+        Returns an embedding for every note in `texts` (note id -> text to embed), embedding only the cache misses.
+        """
+        text_hashes = {note_id: hash_text(text, self.model_name) for note_id, text in texts.items()}
+        with self.lock:
+            cached = self._load(texts.keys())
+        embeddings = {
+            note_id: vector for note_id, (text_hash, vector) in cached.items() if text_hashes[note_id] == text_hash
+        }
+        missing = [note_id for note_id in texts if note_id not in embeddings]
+        LOGGER.info(f"Embedding cache: {len(embeddings)} hits, {len(missing)} misses")
+        if missing:
+            vectors = self.embedding_function.embed_documents([texts[note_id] for note_id in missing])
+            new_embeddings = {
+                note_id: np.asarray(vector, dtype=np.float32) for note_id, vector in zip(missing, vectors)
+            }
+            with self.lock:
+                self._store({note_id: (text_hashes[note_id], new_embeddings[note_id]) for note_id in missing})
+            embeddings.update(new_embeddings)
+        return embeddings
+
+    def remove(self, note_id: int) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM note_embedding WHERE note_id = ?", (note_id,))
+            self.connection.commit()
+
+    def _load(self, note_ids: Iterable[int]) -> Dict[int, tuple]:
+        # reads only the requested rows, by primary key
+        note_ids = list(note_ids)
+        loaded = {}
+        for start in range(0, len(note_ids), LOAD_CHUNK_SIZE):
+            chunk = note_ids[start:start + LOAD_CHUNK_SIZE]
+            rows = self.connection.execute(
+                "SELECT note_id, text_hash, embedding FROM note_embedding "
+                f"WHERE note_id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            loaded.update(
+                {note_id: (text_hash, np.frombuffer(blob, dtype=np.float32)) for note_id, text_hash, blob in rows}
+            )
+        return loaded
+
+    def _store(self, entries: Dict[int, tuple]) -> None:
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO note_embedding (note_id, text_hash, embedding) VALUES (?, ?, ?)",
+            [(note_id, text_hash, vector.tobytes()) for note_id, (text_hash, vector) in entries.items()]
+        )
+        self.connection.commit()
+
+
+def hash_text(text: str, model_name: str = "") -> str:
+    # a vector is only valid for the model that computed it, so the model name is part of the hash
+    return hashlib.sha256(f"{model_name}\n{text}".encode("utf-8")).hexdigest()
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import logging
+import threading
+import time
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+logger = logging.getLogger("startup")
+logging.basicConfig(level=logging.INFO)
+
+T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
+
+
+class LazyResource(Generic[T]):
+    """
+    A heavy object that is built on first use or by a background warm-up thread, whichever comes first.
+    Concurrent callers of `get` wait for the same build instead of starting their own.
+    """
+    def __init__(self, name: str, factory: Callable[[], T]):
+        self.name = name
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.value: Optional[T] = None
+        self.ready = threading.Event()
+
+    def get(self) -> T:
+        if self.ready.is_set():
+            return self.value
+        with self.lock:
+            if not self.ready.is_set():
+                started_at = time.monotonic()
+                self.value = self.factory()
+                self.ready.set()
+                log_phase(f"load {self.name}", started_at)
+        return self.value
+
+    def warm_up(self) -> threading.Thread:
+        thread = threading.Thread(target=self._warm_up, name=f"warm-up-{self.name}", daemon=True)
+        thread.start()
+        return thread
+
+    def is_ready(self) -> bool:
+        return self.ready.is_set()
+
+    def _warm_up(self) -> None:
+        try:
+            self.get()
+        except Exception as e:
+            # the next `get` will try again and raise in the handler that needs the resource
+            logger.error(f"Warm-up of {self.name} failed: {e}")
+
+
+class LazyResourceRegistry(Generic[K, T]):
+    """
+    One LazyResource per key, e.g. one per user, created on first use.
+    At most max_size resources are kept, the least recently used one is dropped (and built again when it's needed).
+    """
+    def __init__(self, name: str, factory: Callable[[K], T], max_size: Optional[int] = None):
+        self.name = name
+        self.factory = factory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.resources: "OrderedDict[K, LazyResource[T]]" = OrderedDict()
+
+    def __getitem__(self, key: K) -> LazyResource[T]:
+        with self.lock:
+            resource = self.resources.get(key)
+            if resource is None:
+                resource = LazyResource(f"{self.name} {key}", lambda: self.factory(key))
+                self.resources[key] = resource
+            self.resources.move_to_end(key)
+            if self.max_size is not None and len(self.resources) > self.max_size:
+                evicted_key, _ = self.resources.popitem(last=False)
+                logger.info(f"Dropped {self.name} {evicted_key}")
+            return resource
+
+    def get(self, key: K) -> T:
+        return self[key].get()
+
+    def discard(self, key: K) -> None:
+        with self.lock:
+            self.resources.pop(key, None)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.resources)
+
+
+def log_phase(phase: str, started_at: float) -> None:
+    logger.info(f"Startup phase '{phase}' took {time.monotonic() - started_at:.2f}s")
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+LOGGER = logging.getLogger("llm_cache")
+LOGGER.setLevel(logging.INFO)
+
+
+class LLMCache:
+    """
+    Cache of LLM completions keyed by model id, model kwargs and prompt hash.
+    Entries live in an in-memory LRU tier and, if `db_path` is given, in an on-disk SQLite tier that survives
+    restarts. Both tiers expire entries after `ttl_seconds`.
+    Anything with the same `get`/`set` methods can be passed to RAG instead.
+    """
+    def __init__(
+            self,
+            max_entries: int = 512,
+            ttl_seconds: Optional[float] = 7 * 24 * 3600,
+            db_path: Optional[Path] = None,
+            clock: Callable[[], float] = time.time,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.memory: OrderedDict = OrderedDict()  # key -> (created_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if db_path is not None:
+            self.connection = sqlite3.connect(str(db_path), check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_response (key TEXT PRIMARY KEY, created_at REAL, value TEXT)"
+            )
+            self.connection.commit()
+
+    @staticmethod
+    def make_key(model_id: str, model_kwargs: Optional[Dict], prompt: str) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        key_data = json.dumps([model_id, model_kwargs or {}, prompt_hash], sort_keys=True)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            value = self._get_from_memory(key)
+            if value is None and self.connection is not None:
+                value = self._get_from_disk(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        created_at = self.clock()
+        with self.lock:
+            self._set_in_memory(key, created_at, value)
+            if self.connection is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO llm_response (key, created_at, value) VALUES (?, ?, ?)",
+                    (key, created_at, value)
+                )
+                self.connection.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.memory)}
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and self.clock() - created_at > self.ttl_seconds
+
+    def _get_from_memory(self, key: str) -> Optional[str]:
+        entry = self.memory.get(key)
+        if entry is None:
+            return None
+        created_at, value = entry
+        if self._is_expired(created_at):
+            del self.memory[key]
+            return None
+        self.memory.move_to_end(key)
+        return value
+
+    def _get_from_disk(self, key: str) -> Optional[str]:
+        row = self.connection.execute(
+            "SELECT created_at, value FROM llm_response WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        created_at, value = row
+        if self._is_expired(created_at):
+            self.connection.execute("DELETE FROM llm_response WHERE key = ?", (key,))
+            self.connection.commit()
+            return None
+        self._set_in_memory(key, created_at, value)
+        return value
+
+    def _set_in_memory(self, key: str, created_at: float, value: str) -> None:
+        self.memory[key] = (created_at, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import aiohttp
+
+LOGGER = logging.getLogger("llm_client")
+LOGGER.setLevel(logging.INFO)
+
+DEEPINFRA_API_URL = "https://api.deepinfra.com/v1/inference"
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class LLMRequestError(Exception):
+    pass
+
+
+class RetryableError(Exception):
+    pass
+
+
+class DeepInfraClient:
+    """
+    Async client for the DeepInfra inference API.
+    Every call has a deadline covering all its attempts, failed attempts are retried with jittered exponential
+    backoff, and a semaphore caps the number of requests in flight. The requests run on a private event loop in a
+    background thread, so the client can be used both from sync code (`client(prompt)`, as with the LangChain LLMs)
+    and from any other event loop (`await client.acomplete(prompt)`).
+    """
+    def __init__(
+            self,
+            model_id: str,
+            model_kwargs: Optional[Dict] = None,
+            api_token: Optional[str] = None,
+            base_url: str = DEEPINFRA_API_URL,
+            request_timeout: float = 30.0,
+            deadline: float = 90.0,
+            max_retries: int = 3,
+            backoff_base: float = 0.5,
+            backoff_max: float = 8.0,
+            max_concurrency: int = 4,
+    ):
+        self.model_id = model_id
+        self.model_kwargs = model_kwargs or {}
+        self.api_token = api_token or os.getenv("DEEPINFRA_API_TOKEN")
+        self.base_url = base_url.rstrip("/")
+        self.request_timeout = request_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_concurrency = max_concurrency
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def __call__(self, prompt: str, deadline: Optional[float] = None) -> str:
+        return self.complete(prompt, deadline)
+
+    def complete(self, prompt: str, deadline: Optional[float] = None) -> str:
+        return self._submit(self._complete(prompt, deadline)).result()
+
+    async def acomplete(self, prompt: str, deadline: Optional[float] = None) -> str:
+        return await asyncio.wrap_future(self._submit(self._complete(prompt, deadline)))
+
+    def complete_many(self, prompts: List[str], deadline: Optional[float] = None) -> List[str]:
+        """Runs the prompts concurrently, up to the concurrency limit, and returns the outputs in order."""
+        futures = [self._submit(self._complete(prompt, deadline)) for prompt in prompts]
+        return [future.result() for future in futures]
+
+    def stream(self, prompt: str, deadline: Optional[float] = None) -> Iterator[str]:
+        """Yields the completion token by token as the model generates it."""
+        tokens = queue.Queue()
+        end_of_stream = object()
+
+        async def pump():
+            try:
+                async for token in self._astream(prompt):
+                    tokens.put(token)
+            except Exception as e:
+                tokens.put(e)
+            finally:
+                tokens.put(end_of_stream)
+
+        future = self._submit(pump())
+        stop_at = time.monotonic() + (deadline or self.deadline)
+        while True:
+            try:
+                item = tokens.get(timeout=max(stop_at - time.monotonic(), 0))
+            except queue.Empty:
+                future.cancel()
+                raise LLMRequestError(f"LLM stream did not finish within {deadline or self.deadline}s")
+            if item is end_of_stream:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self) -> None:
+        if self._loop is None:
+            return
+        if self._session is not None:
+            self._submit(self._session.close()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop())
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-client-loop", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _ensure_session(self) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+    async def _complete(self, prompt: str, deadline: Optional[float]) -> str:
+        self._ensure_session()
+        # the deadline starts once the call has a slot, time spent queued behind the other calls of a batch doesn't
+        # count; the slot is kept for the retries, as in _astream
+        async with self._semaphore:
+            try:
+                return await asyncio.wait_for(self._complete_with_retries(prompt), deadline or self.deadline)
+            except asyncio.TimeoutError:
+                raise LLMRequestError(f"LLM call did not finish within {deadline or self.deadline}s")
+
+    async def _complete_with_retries(self, prompt: str) -> str:
+        attempt = 0
+        while True:
+            try:
+                return await self._request(prompt)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as e:
+                if attempt >= self.max_retries:
+                    raise LLMRequestError(f"LLM call failed after {attempt + 1} attempts: {e}") from e
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                LOGGER.warning(f"LLM call failed ({e}), retrying in {delay:.2f}s")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _request(self, prompt: str) -> str:
+        async with self._session.post(
+                f"{self.base_url}/{self.model_id}",
+                json={"input": prompt, **self.model_kwargs},
+                headers={"Authorization": f"bearer {self.api_token}"},
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+        ) as response:
+            if response.status in RETRYABLE_STATUSES:
+                raise RetryableError(f"status {response.status}")
+            if response.status != 200:
+                raise LLMRequestError(f"LLM call failed with status {response.status}: {await response.text()}")
+            data = await response.json()
+            return data["results"][0]["generated_text"]
+
+    async def _astream(self, prompt: str) -> AsyncIterator[str]:
+        # Only the connection is retried: once tokens were yielded, a retry would repeat them
+        self._ensure_session()
+        attempt = 0
+        async with self._semaphore:
+            while True:
+                try:
+                    response = await self._session.post(
+                        f"{self.base_url}/{self.model_id}",
+                        json={"input": prompt, "stream": True, **self.model_kwargs},
+                        headers={"Authorization": f"bearer {self.api_token}"},
+                        timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.request_timeout,
+                                                      sock_read=self.request_timeout),
+                    )
+                    if response.status in RETRYABLE_STATUSES:
+                        response.release()
+                        raise RetryableError(f"status {response.status}")
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as e:
+                    if attempt >= self.max_retries:
+                        raise LLMRequestError(f"LLM stream failed after {attempt + 1} attempts: {e}") from e
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                    LOGGER.warning(f"LLM stream failed ({e}), retrying in {delay:.2f}s")
+                    attempt += 1
+                    await asyncio.sleep(delay)
+            async with response:
+                if response.status != 200:
+                    raise LLMRequestError(f"LLM stream failed with status {response.status}: {await response.text()}")
+                async for line in response.content:
+                    token = parse_stream_line(line)
+                    if token:
+                        yield token
+
+
+def parse_stream_line(line: bytes) -> Optional[str]:
+    # Server-sent events of the DeepInfra streaming API: `data: {"token": {"text": ...}, ...}`, then `data: [DONE]`
+    line = line.strip()
+    if not line.startswith(b"data:"):
+        return None
+    payload = line[len(b"data:"):].strip()
+    if payload == b"[DONE]":
+        return None
+    token = json.loads(payload).get("token") or {}
+    if token.get("special"):
+        return None
+    return token.get("text")
@@ -0,0 +1,219 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger("metrics")
+logging.basicConfig(level=logging.INFO)
+
+PREFIX = "thoughtflow"
+# upper bounds in seconds, from a cached lookup to a slow LLM call
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket that holds the q-quantile, the largest value seen for the +Inf bucket."""
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Process-wide counters, gauges and latency histograms.
+    Series are identified by a name and labels. Gauges are functions that are read when the metrics are exported,
+    e.g. the depth of a queue.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.gauges: Dict[str, Dict[Labels, Callable[[], float]]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = _labels(labels)
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def register_gauge(self, name: str, read: Callable[[], float], **labels) -> None:
+        with self.lock:
+            self.gauges.setdefault(name, {})[_labels(labels)] = read
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """Observes the duration of the block in the `name` histogram, and counts it in errors_total if it raises."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("errors_total", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def timed(self, component: str, stage: Optional[str] = None):
+        """Decorator for `timer("stage_seconds", component=component, stage=stage or <function name>)`."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer("stage_seconds", component=component, stage=stage or function.__name__):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stage(self, component: str, stage: str):
+        return self.timer("stage_seconds", component=component, stage=stage)
+
+    def render_prometheus(self) -> str:
+        """All series in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{PREFIX}_{name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{PREFIX}_{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{PREFIX}_{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{PREFIX}_{name}_count{_format_labels(labels)} {histogram.count}")
+            gauges = {name: dict(series) for name, series in self.gauges.items()}
+        # gauges are read outside of the lock, they may take locks of their own
+        for name, series in sorted(gauges.items()):
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            for labels, read in sorted(series.items(), key=lambda item: item[0]):
+                lines.append(f"{PREFIX}_{name}{_format_labels(labels)} {_read_gauge(read)}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """One line per series with the call count, p50/p95/max latency, errors and the current gauge values."""
+        lines = []
+        with self.lock:
+            errors = dict(self.counters.get("errors_total", {}))
+            for name, series in sorted(self.histograms.items()):
+                for labels, histogram in sorted(series.items()):
+                    lines.append(
+                        f"{name}{_format_labels(labels)}: n={histogram.count} "
+                        f"p50={histogram.quantile(0.5):.3f}s p95={histogram.quantile(0.95):.3f}s "
+                        f"max={histogram.max:.3f}s errors={errors.get(labels, 0):g}"
+                    )
+            gauges = {name: dict(series) for name, series in self.gauges.items()}
+        for name, series in sorted(gauges.items()):
+            for labels, read in sorted(series.items(), key=lambda item: item[0]):
+                lines.append(f"{name}{_format_labels(labels)}: {_read_gauge(read)}")
+        return "\n".join(lines)
+
+    def log_summary_every(self, interval_seconds: float) -> threading.Thread:
+        def log_summaries():
+            while True:
+                time.sleep(interval_seconds)
+                logger.info(f"Metrics summary:\n{self.summary()}")
+
+        thread = threading.Thread(target=log_summaries, name="metrics-summary", daemon=True)
+        thread.start()
+        return thread
+
+
+class MetricsServer:
+    """Serves the metrics in the Prometheus text format on GET /metrics. Raises OSError if the port is taken."""
+    def __init__(self, metrics: Metrics, port: int, host: str = "127.0.0.1"):
+        self.metrics = metrics
+        self.server = ThreadingHTTPServer((host, port), self._make_request_handler())
+
+    @property
+    def port(self) -> int:
+        return self.server.server_port
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        thread.start()
+        logger.info(f"Metrics server listening on port {self.port}")
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _make_request_handler(self):
+        metrics_server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = metrics_server.metrics.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return RequestHandler
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _read_gauge(read: Callable[[], float]) -> float:
+    try:
+        return read()
+    except Exception as e:
+        logger.error(f"Reading a gauge failed: {e}")
+        return float("nan")
+
+
+# the metrics of this process
+metrics = Metrics()
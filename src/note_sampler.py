@@ -0,0 +1,153 @@
+from bisect import bisect_right
+from datetime import datetime
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# relative chance of a note to be picked by a weighted sample, by urgency and by age
+URGENCY_WEIGHTS = {"today": 4.0, "day": 4.0, "week": 2.0, "month": 1.0}
+DEFAULT_URGENCY_WEIGHT = 1.0
+AGE_BUCKET_DAYS = (7, 30, 90)  # upper bounds of the age buckets, the last bucket has no bound
+AGE_WEIGHTS = (1.0, 1.5, 2.0, 3.0)  # older open notes come up more often
+
+BucketKey = Tuple[Optional[str], int]  # urgency, age bucket
+
+
+class IdSet:
+    """Ids with O(1) add, remove and uniform random choice."""
+    def __init__(self):
+        self.ids: List[int] = []
+        self.positions: Dict[int, int] = {}
+
+    def add(self, note_id: int) -> None:
+        if note_id not in self.positions:
+            self.positions[note_id] = len(self.ids)
+            self.ids.append(note_id)
+
+    def remove(self, note_id: int) -> None:
+        position = self.positions.pop(note_id)
+        last_id = self.ids.pop()
+        if last_id != note_id:
+            # the last id takes the place of the removed one
+            self.ids[position] = last_id
+            self.positions[last_id] = position
+
+    def choice(self, rng: random.Random) -> int:
+        return self.ids[rng.randrange(len(self.ids))]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class CandidatePool:
+    """The candidate ids of one user (or of all users), in buckets by urgency and age."""
+    def __init__(self, loaded_at: float):
+        self.loaded_at = loaded_at
+        self.buckets: Dict[BucketKey, IdSet] = {}
+        self.bucket_of: Dict[int, BucketKey] = {}
+
+    def add(self, note_id: int, key: BucketKey) -> None:
+        if self.bucket_of.get(note_id) == key:
+            return
+        self.discard(note_id)
+        self.buckets.setdefault(key, IdSet()).add(note_id)
+        self.bucket_of[note_id] = key
+
+    def discard(self, note_id: int) -> None:
+        key = self.bucket_of.pop(note_id, None)
+        if key is not None:
+            self.buckets[key].remove(note_id)
+
+    def sample(self, rng: random.Random, weighted: bool) -> Optional[int]:
+        # the number of buckets doesn't grow with the number of notes, so this is O(1) in the table size
+        buckets = [(bucket, len(bucket) * (bucket_weight(key) if weighted else 1.0))
+                   for key, bucket in self.buckets.items() if len(bucket)]
+        if not buckets:
+            return None
+        point = rng.random() * sum(weight for _, weight in buckets)
+        for bucket, weight in buckets:
+            point -= weight
+            if point < 0:
+                return bucket.choice(rng)
+        return buckets[-1][0].choice(rng)
+
+
+class NoteSampler:
+    """
+    Picks random notes that are not done without sorting the table.
+    The candidate ids of a user are loaded once and then kept in sync through `update` and `discard`; they are loaded
+    again after refresh_seconds to pick up changes by other processes and to move notes into their current age
+    bucket. An id whose note turns out to be gone or done when it is fetched is discarded and the caller samples again.
+    Pools are kept per user id, None is the pool of all users.
+    """
+    def __init__(
+            self,
+            refresh_seconds: float = 3600.0,
+            clock: Callable[[], float] = time.monotonic,
+            rng: Optional[random.Random] = None,
+    ):
+        self.refresh_seconds = refresh_seconds
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.lock = threading.Lock()
+        self.pools: Dict[Optional[int], CandidatePool] = {}
+
+    def needs_load(self, user_id: Optional[int]) -> bool:
+        with self.lock:
+            pool = self.pools.get(user_id)
+            return pool is None or self.clock() - pool.loaded_at > self.refresh_seconds
+
+    def load(self, user_id: Optional[int], rows: Iterable[Tuple[int, Optional[str], Optional[datetime]]]) -> None:
+        """rows: id, urgency and date_created of every candidate note of the user"""
+        now = datetime.now()
+        pool = CandidatePool(self.clock())
+        for note_id, urgency, date_created in rows:
+            pool.add(note_id, (urgency, age_bucket(date_created, now)))
+        with self.lock:
+            self.pools[user_id] = pool
+
+    def sample(self, user_id: Optional[int], weighted: bool = False) -> Optional[int]:
+        with self.lock:
+            pool = self.pools.get(user_id)
+            return pool.sample(self.rng, weighted) if pool is not None else None
+
+    def update(
+            self,
+            note_id: int,
+            user_id: Optional[int],
+            status: Optional[str],
+            urgency: Optional[str],
+            date_created: Optional[datetime],
+    ) -> None:
+        """Adds, moves or removes a note after it was inserted or changed."""
+        if not is_candidate(status):
+            self.discard(note_id)
+            return
+        key = (urgency, age_bucket(date_created, datetime.now()))
+        with self.lock:
+            for pool_user_id in {user_id, None}:
+                pool = self.pools.get(pool_user_id)
+                if pool is not None:
+                    pool.add(note_id, key)
+
+    def discard(self, note_id: int) -> None:
+        with self.lock:
+            for pool in self.pools.values():
+                pool.discard(note_id)
+
+
+def is_candidate(status: Optional[str]) -> bool:
+    # same as the SQL filter status != 'done', which doesn't match NULL either
+    return status is not None and status != "done"
+
+
+def age_bucket(date_created: Optional[datetime], now: datetime) -> int:
+    if date_created is None:
+        return 0
+    return bisect_right(AGE_BUCKET_DAYS, (now - date_created).days)
+
+
+def bucket_weight(key: BucketKey) -> float:
+    urgency, age = key
+    return URGENCY_WEIGHTS.get(urgency, DEFAULT_URGENCY_WEIGHT) * AGE_WEIGHTS[age]
@@ -0,0 +1,221 @@
+from concurrent.futures import Future
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+import telebot
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+        self.paused_until = 0.0  # set from the retry_after of a 429 response
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+class OutboundRequest:
+    def __init__(self, method: str, chat_id: int, args: tuple, kwargs: dict, coalesce_key: Optional[tuple] = None):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+        self.futures: List[Future] = [Future()]
+
+
+class Outbox:
+    """
+    Single dispatcher for everything the bot sends to Telegram.
+    Requests wait for a token from both the global and their chat's token bucket, requests of a chat are sent in
+    order, a 429 response pauses the chat (or everything) for its retry_after and the request is retried, and an edit
+    of a message that still has an edit waiting replaces that edit instead of being sent too.
+    Every call returns a Future with the result of the API call.
+    """
+    def __init__(
+            self,
+            bot: telebot.TeleBot,
+            global_rate: float = 25.0,
+            chat_rate: float = 1.0,
+            chat_burst: float = 5.0,
+            workers: int = 4,
+            max_retries: int = 5,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock())
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.pending: List[OutboundRequest] = []
+        self.chats_in_flight: Set[int] = set()
+        self.threads: List[threading.Thread] = []
+        self.metrics = {"sent": 0, "failed": 0, "retried": 0, "coalesced": 0, "rate_limited": 0}
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> Future:
+        return self._submit(OutboundRequest("send_message", chat_id, (chat_id, text), kwargs))
+
+    def send_photo(self, chat_id: int, photo, **kwargs) -> Future:
+        return self._submit(OutboundRequest("send_photo", chat_id, (chat_id, photo), kwargs))
+
+    def send_document(self, chat_id: int, document, **kwargs) -> Future:
+        return self._submit(OutboundRequest("send_document", chat_id, (chat_id, document), kwargs))
+
+    def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs) -> Future:
+        return self._submit(OutboundRequest(
+            "edit_message_text", chat_id, (text, chat_id, message_id), kwargs, coalesce_key=(chat_id, message_id)
+        ))
+
+    def queue_depth(self) -> int:
+        with self.lock:
+            return len(self.pending)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {**self.metrics, "queue_depth": len(self.pending)}
+
+    def stop(self) -> None:
+        with self.changed:
+            threads, self.threads = self.threads, []
+            self.changed.notify_all()
+        for thread in threads:
+            thread.join()
+
+    def _submit(self, request: OutboundRequest) -> Future:
+        with self.changed:
+            if not self.threads:
+                self._start()
+            if request.coalesce_key is not None:
+                # only an edit that is the newest request of its chat can absorb the new one; merging into an older
+                # edit would send the new text ahead of the requests of the chat that were queued in between
+                newest = next(
+                    (waiting for waiting in reversed(self.pending) if waiting.chat_id == request.chat_id), None
+                )
+                if newest is not None and newest.coalesce_key == request.coalesce_key:
+                    # the newer edit wins, callers of both get its result
+                    newest.args, newest.kwargs = request.args, request.kwargs
+                    newest.futures.extend(request.futures)
+                    self.metrics["coalesced"] += 1
+                    return request.futures[0]
+            self.pending.append(request)
+            self.changed.notify()
+        return request.futures[0]
+
+    def _start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"outbox-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return self.chat_buckets[chat_id]
+
+    def _claim(self) -> tuple:
+        """Returns the next request that can be sent now, or None and how long to wait for one."""
+        now = self.clock()
+        global_wait = self.global_bucket.wait_time(now)
+        if global_wait > 0:
+            return None, global_wait
+        min_wait = None
+        seen_chats = set()
+        for i, request in enumerate(self.pending):
+            if request.chat_id in seen_chats or request.chat_id in self.chats_in_flight:
+                continue  # only the oldest request of a chat may go, and only one at a time
+            seen_chats.add(request.chat_id)
+            chat_bucket = self._chat_bucket(request.chat_id, now)
+            wait = chat_bucket.wait_time(now)
+            if wait == 0:
+                del self.pending[i]
+                chat_bucket.take(now)
+                self.global_bucket.take(now)
+                self.chats_in_flight.add(request.chat_id)
+                return request, 0
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, min_wait
+
+    def _work(self) -> None:
+        current_thread = threading.current_thread()
+        while True:
+            with self.changed:
+                if current_thread not in self.threads:
+                    return
+                request, wait = self._claim()
+                if request is None:
+                    self.changed.wait(wait)
+                    continue
+            try:
+                with metrics.stage("telegram", request.method):
+                    result = getattr(self.bot, request.method)(*request.args, **request.kwargs)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429 and request.attempts < self.max_retries:
+                    request.attempts += 1
+                    self._retry_later(request, e)
+                    continue
+                self._finish(request, exception=e)
+            except Exception as e:
+                self._finish(request, exception=e)
+            else:
+                self._finish(request, result=result)
+
+    def _retry_later(self, request: OutboundRequest, error: telebot.apihelper.ApiTelegramException) -> None:
+        retry_after = (error.result_json.get("parameters") or {}).get("retry_after", 1)
+        logger.warning(f"Rate limited by Telegram in chat {request.chat_id}, retrying in {retry_after}s")
+        with self.changed:
+            now = self.clock()
+            # a 429 in a private chat is about that chat; otherwise assume the bot as a whole is over its limit
+            bucket = self._chat_bucket(request.chat_id, now) if request.chat_id > 0 else self.global_bucket
+            bucket.paused_until = now + retry_after
+            # the failed attempt has read the uploaded files, the retry has to send them from the start again
+            for arg in (*request.args, *request.kwargs.values()):
+                if hasattr(arg, "seek"):
+                    arg.seek(0)
+            self.pending.insert(0, request)
+            self.chats_in_flight.discard(request.chat_id)
+            self.metrics["rate_limited"] += 1
+            self.metrics["retried"] += 1
+            self.changed.notify_all()
+
+    def _finish(self, request: OutboundRequest, result=None, exception: Optional[Exception] = None) -> None:
+        with self.changed:
+            self.chats_in_flight.discard(request.chat_id)
+            self.metrics["failed" if exception else "sent"] += 1
+            self.changed.notify_all()
+        if exception is not None:
+            logger.error(f"{request.method} to chat {request.chat_id} failed: {exception}")
+        for future in request.futures:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
@@ -1,10 +1,15 @@
+from dataclasses import asdict
+import io
 from pathlib import Path
 from typing import List
 
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from metrics import metrics
+
 plt.switch_backend('Agg') # for running on server without X11
 
 
@@ -13,28 +18,39 @@ class PlotMaker():
     PLOTS_DIR.mkdir(exist_ok=True)
 
     @staticmethod
-    def get_plots(thoughts: List) -> str:
+    @metrics.timed("plot")
+    def get_plots(counts: List) -> str:
         print("Plotting...")
-        # transform database objects to pandas dataframe and parse the dates
-        df = pd.DataFrame(thoughts)
-        df['date_created'] = pd.to_datetime(df['date_created'])
-        df['date_completed'] = pd.to_datetime(df['date_completed'])
-        df_nn = df[df.status.notna()]
-        return PlotMaker.plot_value_counts(df_nn)
+        plot_path = PlotMaker.PLOTS_DIR / 'value_counts_done_2.png'
+        plot_path.write_bytes(PlotMaker.get_plot_image(counts))
+        return plot_path.as_posix()
 
+    @staticmethod
+    @metrics.timed("plot")
+    def get_plot_image(counts: List) -> bytes:
+        """Bar chart of opened and done notes per label from the NoteCount rows of DBActionHandler.get_note_counts."""
+        df = pd.DataFrame([asdict(count) for count in counts], columns=['label', 'status', 'period', 'count'])
+        df = df[df.status.notna()]
+        opened = df.groupby('label')['count'].sum()
+        done = df[df.status == "done"].groupby('label')['count'].sum()
+        return PlotMaker.render_bars(pd.DataFrame({'opened': opened, 'done': done}, index=opened.index))
 
     @staticmethod
-    def plot_value_counts(df: pd.DataFrame) -> str:
-        plot_path = PlotMaker.PLOTS_DIR / 'value_counts_done_2.png'
-        uniq_labels = df.label.unique()
-        colors = plt.cm.Paired(np.arange(uniq_labels.shape[0]))
-        vc_all = df.label.value_counts()
-        vc_done = df[df.status == "done"].label.value_counts()  # TODO plot done according to date_completed
-        df_for_plot = pd.DataFrame({'opened': vc_all, 'done': vc_done}, index=uniq_labels)
-        df_for_plot.sort_values(by="opened").plot.barh(color=colors)
-        plt.tight_layout()
-        plt.savefig(plot_path)
-        return plot_path.as_posix()
+    @metrics.timed("plot")
+    def render_bars(df_for_plot: pd.DataFrame) -> bytes:
+        # A standalone Figure instead of pyplot: it isn't kept in pyplot's global registry, so it is freed after
+        # rendering, and rendering from several threads doesn't share pyplot's current figure
+        figure = Figure()
+        ax = figure.subplots()
+        if df_for_plot.empty:
+            ax.text(0.5, 0.5, "No notes in this period", ha='center', va='center')
+        else:
+            colors = plt.cm.Paired(np.arange(df_for_plot.shape[0]))
+            df_for_plot.sort_values(by="opened").plot.barh(color=colors, ax=ax)
+        figure.tight_layout()
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png')
+        return buffer.getvalue()
 
     @staticmethod
     def plot_each_label(df) -> str:
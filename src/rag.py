@@ -1,37 +1,93 @@
+from functools import lru_cache
 import logging
+import os
 from pathlib import Path
 import re
-from typing import List, Dict, Union
+from typing import Callable, Dict, Iterator, List, Optional, Union
 
 from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.llms import Ollama, DeepInfra
+from langchain.llms import Ollama
 from langchain.prompts import PromptTemplate, FewShotPromptTemplate
 from langchain.prompts.example_selector import SemanticSimilarityExampleSelector
 from langchain.vectorstores import Chroma
+import numpy as np
 
 from db_action_handler import DBActionHandler
+from embedding_cache import EmbeddingCache
+from llm_cache import LLMCache
+from llm_client import DeepInfraClient
+from metrics import metrics
+from vector_index import VectorIndex
 
 LOGGER = logging.getLogger("rag")
 LOGGER.setLevel(logging.INFO)
 
 
-class RAG:
-    def __init__(self):
-        self.model_name = "mistral"  # orca2 is best
-        # self.llm = Ollama(model=self.model_name)
-        self.llm = DeepInfra(model_id="mistralai/Mixtral-8x22B-Instruct-v0.1")
-        self.llm.model_kwargs = {
+# The model, the LLM client and the caches are shared by the RAG instances of all users
+@lru_cache(maxsize=None)
+def get_embedding_function() -> HuggingFaceEmbeddings:
+    return HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")  # TODO experiment with other embeddings
+
+
+@lru_cache(maxsize=None)
+def get_embedding_cache() -> EmbeddingCache:
+    embedding_function = get_embedding_function()
+    return EmbeddingCache(embedding_function, model_name=embedding_function.model_name)
+
+
+@lru_cache(maxsize=None)
+def get_llm() -> DeepInfraClient:
+    return DeepInfraClient(
+        model_id="mistralai/Mixtral-8x22B-Instruct-v0.1",
+        model_kwargs={
             "temperature": 0.5,
             "repetition_penalty": 1.2,
             "max_new_tokens": 250,
             "top_p": 0.9,
-        }
-        embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")  # TODO experiment with other embeddings
+        },
+    )
+
+
+@lru_cache(maxsize=None)
+def get_llm_cache() -> LLMCache:
+    llm_cache_path = os.getenv("LLM_CACHE_PATH")
+    return LLMCache(db_path=Path(llm_cache_path) if llm_cache_path else None)
+
+
+class RAG:
+    def __init__(
+            self,
+            user_id: Optional[int] = None,
+            llm_cache: Optional[LLMCache] = None,
+            fast_path_k: int = 7,
+            fast_path_min_agreement: float = 0.8,
+            fast_path_min_similarity: float = 0.75,
+    ):
+        """
+        :param user_id: the user whose notes and categories are used as examples and candidates, all users if None
+        :param fast_path_k: number of labeled neighbour notes that vote on the category of a new note
+        :param fast_path_min_agreement: share of the (similarity weighted) votes the winning category needs to skip
+        the LLM; a value above 1 disables the fast path
+        :param fast_path_min_similarity: mean similarity of the notes voting for the winning category needed to skip
+        the LLM
+        """
+        self.user_id = user_id
+        self.fast_path_k = fast_path_k
+        self.fast_path_min_agreement = fast_path_min_agreement
+        self.fast_path_min_similarity = fast_path_min_similarity
+        self.prediction_count = 0
+        self.fast_path_count = 0
+        self.model_name = "mistral"  # orca2 is best
+        # self.llm = Ollama(model=self.model_name)
+        self.llm = get_llm()
+        self.llm_cache = llm_cache if llm_cache is not None else get_llm_cache()
+        self.embedding_function = get_embedding_function()
+        self.embedding_cache = get_embedding_cache()
         self.db_action_handler = DBActionHandler()
 
         # Load data and categories
-        self.data = self.db_action_handler.get_all_notes()  # TODO just store data in vectors
-        categories = self.db_action_handler.get_all_categories()
+        self.data = self.db_action_handler.get_all_notes(user_id)  # TODO just store data in vectors
+        categories = self.db_action_handler.get_all_categories(user_id)
 
         self.examples = [
             {
@@ -43,19 +99,12 @@ class RAG:
             input_variables=["input", "output"],
             template="Example input: {input},\nExample output: {output}"
         )
-        self.example_selector = SemanticSimilarityExampleSelector.from_examples(
-            self.examples,
-            embeddings=embedding_function,
-            vectorstore_cls=Chroma,
+        self.example_selector = SemanticSimilarityExampleSelector(
+            vectorstore=self.build_example_store(),
             k=5
         )
-        # Load the vector store
-        db_directory = Path("./chroma_categories")
-        if db_directory.exists():
-            self.db = Chroma(persist_directory=str(db_directory), embedding_function=embedding_function)
-        else:
-            db_directory.mkdir(parents=True, exist_ok=True)
-            self.db = Chroma.from_texts(categories, embedding_function, persist_directory=str(db_directory))
+        # The category set is small, so it is held in memory and embedded in a single forward pass
+        self.category_index = VectorIndex.from_embeddings(categories, self.embed_texts(categories))
 
         prefix_categorize = (
             "I want you to categorize my todo notes according to high-level goals and corresponding activities. "
@@ -74,36 +123,212 @@ class RAG:
             input_variables=["note", "candidate_categories"]
         )
 
+    def build_example_store(self) -> Chroma:
+        # Chroma collections of one process share a client, so each user needs their own collection name
+        collection_name = "note_examples" if self.user_id is None else f"note_examples_{self.user_id}"
+        vectorstore = Chroma(collection_name=collection_name, embedding_function=self.embedding_function)
+        # a RAG that is built again, e.g. after it was dropped from the registry of loaded users, would find the
+        # collection of the previous one, with notes that were deleted or changed since; it starts from scratch
+        vectorstore.delete_collection()
+        vectorstore = Chroma(collection_name=collection_name, embedding_function=self.embedding_function)
+        self.note_labels = {}
+        embeddings = self._upsert_examples(
+            vectorstore, [(row.id, example) for row, example in zip(self.data, self.examples)]
+        )
+        # Note-level index for /query retrieval, sharing the cached example embeddings
+        self.note_index = VectorIndex.from_embeddings(list(embeddings), list(embeddings.values()))
+        return vectorstore
+
+    def _upsert_examples(self, vectorstore: Chroma, examples: List[tuple]) -> Dict[int, np.ndarray]:
+        # Notes are embedded by their text alone, like the messages they are compared with in predict_many and
+        # retrieve_notes; the label is kept in the metadata. The embeddings come from the disk cache.
+        example_texts = {note_id: example['input'] for note_id, example in examples}
+        if not example_texts:
+            return {}
+        embeddings = self.embedding_cache.get_embeddings(example_texts)
+        note_ids = list(example_texts)
+        vectorstore._collection.upsert(
+            ids=[str(note_id) for note_id in note_ids],
+            embeddings=[embeddings[note_id].tolist() for note_id in note_ids],
+            documents=[example_texts[note_id] for note_id in note_ids],
+            metadatas=[example for _, example in examples],
+        )
+        self.note_labels.update({note_id: example['output'] for note_id, example in examples})
+        return embeddings
+
+    def add_note(self, note_id: int, note_text: str, label: str) -> None:
+        """Adds a labeled note to the few-shot example store, or replaces it if the note is already there."""
+        embeddings = self._upsert_examples(
+            self.example_selector.vectorstore, [(note_id, {'input': note_text, 'output': label})]
+        )
+        self.note_index.add(note_id, embeddings[note_id])
+
+    def update_note(self, note_id: int, note_text: str, label: str) -> None:
+        self.add_note(note_id, note_text, label)
+
+    def remove_note(self, note_id: int) -> None:
+        self.example_selector.vectorstore.delete(ids=[str(note_id)])
+        self.note_index.remove(note_id)
+        self.note_labels.pop(note_id, None)
+        self.embedding_cache.remove(note_id)
+
+    def add_category(self, category: str) -> None:
+        if category in self.category_index:
+            return
+        self.category_index.add(category, self.embed_texts([category])[0])
+
+    def remove_category(self, category: str) -> None:
+        self.category_index.remove(category)
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+
+    def search_categories(self, queries: List[str], k: int) -> List[List[str]]:
+        """Returns the k closest existing categories for each query, embedding all queries in one forward pass."""
+        results = self.category_index.search(self.embed_texts(queries), k)
+        return [[category for category, _ in result] for result in results]
+
     def predict(self, message: str) -> Dict[str, Union[str, float]]:
-        # Returns twice the same category, that's why there's a set: if k=40, it returns 20
-        candidate_categories = deduplicate_with_order_preservation(
-            [doc.page_content for doc in self.db.similarity_search(message, k=40)]
+        return self.predict_many([message])[0]
+
+    def predict_many(
+            self, messages: List[str], note_ids: Optional[List[int]] = None
+    ) -> List[Dict[str, Union[str, set]]]:
+        """
+        Classifies a batch of notes. Each lookup stage embeds the whole batch in one forward pass and searches it
+        with one matrix multiply, and the LLM calls of the batch run concurrently up to the client's limit.
+        :param note_ids: ids of notes that are already in the database (when reclassifying them), so that a note
+        doesn't vote for its own current label
+        """
+        if not messages:
+            return []
+        self.prediction_count += len(messages)
+        with metrics.stage("rag", "embed"):
+            message_vectors = self.embed_texts(messages)
+        with metrics.stage("rag", "note_search"):
+            neighbours = self.note_index.search(message_vectors, self.fast_path_k + 1)
+        predictions = []
+        for i, message_neighbours in enumerate(neighbours):
+            own_note_id = note_ids[i] if note_ids else None
+            message_neighbours = [neighbour for neighbour in message_neighbours if neighbour[0] != own_note_id]
+            predictions.append(self.predict_from_neighbours(message_neighbours[:self.fast_path_k]))
+        fast_path_hits = sum(prediction is not None for prediction in predictions)
+        self.fast_path_count += fast_path_hits
+        metrics.inc("predictions_total", fast_path_hits, path="fast")
+        metrics.inc("predictions_total", len(messages) - fast_path_hits, path="llm")
+        LOGGER.info(
+            f"Fast path predictions: {fast_path_hits}/{len(messages)}, "
+            f"fast path share: {self.fast_path_count}/{self.prediction_count}"
         )
-        candidate_categories_text = "\n".join(candidate_categories)
-        whole_prompt = self.similar_prompt.format(note=message, candidate_categories=candidate_categories_text)
-        LOGGER.info(whole_prompt)
-        llm_output = self.llm(whole_prompt)
-        LOGGER.info(f"llm output: {llm_output}")
-        llm_output_post_processed = self.post_process_prediction(llm_output, message)
-        LOGGER.info(f"llm output post processed: {llm_output_post_processed}")
-        most_similar_existing_categories = [
-            doc.page_content for doc in self.db.similarity_search(llm_output_post_processed, k=3)
+
+        slow = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if not slow:
+            return predictions
+        with metrics.stage("rag", "category_search"):
+            candidate_results = self.category_index.search(message_vectors[slow], k=20)
+        candidate_categories = [[category for category, _ in result] for result in candidate_results]
+        # the few-shot examples of each prompt are selected from the Chroma example store
+        with metrics.stage("rag", "example_selection"):
+            prompts = [
+                self.similar_prompt.format(note=messages[i], candidate_categories="\n".join(candidates))
+                for i, candidates in zip(slow, candidate_categories)
+            ]
+        for prompt in prompts:
+            LOGGER.info(prompt)
+        with metrics.stage("rag", "llm"):
+            llm_outputs = self.call_llm_many(prompts)
+        LOGGER.info(f"llm outputs: {llm_outputs}")
+        llm_outputs_post_processed = [
+            self.post_process_prediction(llm_output, messages[i]) for i, llm_output in zip(slow, llm_outputs)
         ]
-        most_similar_existing_category = most_similar_existing_categories[0]
-        LOGGER.info(f"Most similar existing category: {most_similar_existing_category}")
-        # Combine the most similar existing category with the candidate categories
-        # to manage two sources of possible errors
-        categories_for_user_selection = self.get_categories_for_user_selection(
-            most_similar_existing_categories, candidate_categories, llm_output_post_processed
-        )
+        LOGGER.info(f"llm outputs post processed: {llm_outputs_post_processed}")
+        # The second lookup depends on the LLM outputs, so it can't share a forward pass with the first one
+        with metrics.stage("rag", "category_lookup"):
+            most_similar_existing_categories = self.search_categories(llm_outputs_post_processed, k=3)
+        for i, candidates, similar_categories, llm_output_post_processed in zip(
+                slow, candidate_categories, most_similar_existing_categories, llm_outputs_post_processed
+        ):
+            LOGGER.info(f"Most similar existing categories: {similar_categories}")
+            # Combine the most similar existing category with the candidate categories
+            # to manage two sources of possible errors
+            predictions[i] = {
+                "category": similar_categories[0],
+                "categories_for_user_selection": self.get_categories_for_user_selection(
+                    similar_categories, candidates, llm_output_post_processed
+                ),
+            }
+        return predictions
 
-        print("most_similar_existing_categories: ", most_similar_existing_categories)
-        print("categories_for_user_selection: ", categories_for_user_selection)
+    def predict_from_neighbours(self, neighbours: List[tuple]) -> Optional[Dict[str, Union[str, set]]]:
+        """
+        kNN vote over the labeled notes closest to a message (note id, similarity). Returns a prediction only if the
+        neighbours agree on an existing category and are similar enough to the message, otherwise None, meaning that
+        the LLM has to decide.
+        """
+        if len(neighbours) < self.fast_path_k:
+            return None
+        votes = {}
+        for note_id, similarity in neighbours:
+            label = self.note_labels.get(note_id)
+            votes.setdefault(label, []).append(similarity)
+        # a vote weighs its similarity; neighbours that are not similar at all (cosine <= 0) don't vote
+        weights = {
+            label: sum(max(similarity, 0.0) for similarity in similarities) for label, similarities in votes.items()
+        }
+        total_weight = sum(weights.values())
+        if total_weight <= 0:
+            return None
+        category = max(weights, key=weights.get)
+        agreement = weights[category] / total_weight
+        mean_similarity = sum(votes[category]) / len(votes[category])
+        if agreement < self.fast_path_min_agreement or mean_similarity < self.fast_path_min_similarity:
+            return None
+        if category not in self.category_index:
+            return None
+        neighbour_categories = deduplicate_with_order_preservation(
+            [self.note_labels[note_id] for note_id, _ in neighbours if self.note_labels.get(note_id)]
+        )
         return {
-            "category": most_similar_existing_category,
-            "categories_for_user_selection": categories_for_user_selection,
+            "category": category,
+            "categories_for_user_selection": self.get_categories_for_user_selection(
+                [category], neighbour_categories, category
+            ),
         }
 
+    def call_llm(self, prompt: str) -> str:
+        key = LLMCache.make_key(self.llm.model_id, self.llm.model_kwargs, prompt)
+        llm_output = self.llm_cache.get(key)
+        if llm_output is not None:
+            LOGGER.info(f"LLM cache hit, stats: {self.llm_cache.stats()}")
+            return llm_output
+        llm_output = self.llm(prompt)
+        self.llm_cache.set(key, llm_output)
+        return llm_output
+
+    def call_llm_many(self, prompts: List[str]) -> List[str]:
+        keys = [LLMCache.make_key(self.llm.model_id, self.llm.model_kwargs, prompt) for prompt in prompts]
+        llm_outputs = [self.llm_cache.get(key) for key in keys]
+        missing = [i for i, llm_output in enumerate(llm_outputs) if llm_output is None]
+        if missing:
+            for i, llm_output in zip(missing, self.llm.complete_many([prompts[i] for i in missing])):
+                self.llm_cache.set(keys[i], llm_output)
+                llm_outputs[i] = llm_output
+        return llm_outputs
+
+    def stream_llm(self, prompt: str) -> Iterator[str]:
+        key = LLMCache.make_key(self.llm.model_id, self.llm.model_kwargs, prompt)
+        llm_output = self.llm_cache.get(key)
+        if llm_output is not None:
+            yield llm_output
+            return
+        tokens = []
+        for token in self.llm.stream(prompt):
+            tokens.append(token)
+            yield token
+        self.llm_cache.set(key, "".join(tokens))
+
     def get_categories_for_user_selection(
             self, most_similar_existing_categories,
             candidate_categories,
@@ -122,35 +347,75 @@ class RAG:
             output_markers = ["Category:", "Output:"]
             return extract_category_from_llm_output(prediction_text, output_markers)
 
-    def perform_arbitrary_query(self, query):
+    @metrics.timed("rag")
+    def retrieve_notes(self, query: str, k: int = 20, token_budget: int = 1500) -> List:
+        """
+        Returns up to k open notes most relevant to the query, most relevant first, whose prompt lines fit into
+        the token budget.
         """
+        # Over-fetch, since notes that are not open anymore are filtered out afterwards
+        results = self.note_index.search(self.embed_texts([query]), k * 3)[0]
+        notes = self.db_action_handler.get_notes_by_ids([note_id for note_id, _ in results], self.user_id)
+        relevant_notes = []
+        used_tokens = 0
+        for note in notes:
+            if note.status != "open":
+                continue
+            note_tokens = estimate_tokens(format_note_for_query(note))
+            if used_tokens + note_tokens > token_budget:
+                break
+            relevant_notes.append(note)
+            used_tokens += note_tokens
+            if len(relevant_notes) == k:
+                break
+        return relevant_notes
+
+    def perform_arbitrary_query(
+            self, query, retrieval: bool = True, k: int = 20, token_budget: int = 1500,
+            on_partial_answer: Optional[Callable[[str], None]] = None,
+    ) -> Dict[str, Union[str, List[int]]]:
+        """
+        Answers a query about the notes. By default only the k open notes most relevant to the query (within the
+        token budget) are sent to the LLM; with retrieval=False all open notes of the last 60 days are sent.
+        If on_partial_answer is given, the answer is streamed and the callback gets the text generated so far
+        after every token.
         TODO:
-        - try with deepinfra
-        - (output a fixed amount of notes)
-        - get ids of the notes and output notes with buttons
         - this should have access to categories, as some notes make sense only for me, and categories might contain some
         feedback from me
-        - keep the comment from the LLM
         :param query:
-        :return:
+        :return: the LLM answer and the ids of the notes it picked, in the order of the answer
         """
-        last_days = 60
-        recent_thoughts = self.db_action_handler.get_recent_notes(time_frame=last_days)
-        if not recent_thoughts:
-            return "No notes found in the last {} days.".format(last_days)
-        concat_recent_thoughts = "\n".join([
-            f"Note: '{thought.note_text}', Category: '{thought.label}'" for thought in recent_thoughts
-        ])
+        if retrieval:
+            thoughts = self.retrieve_notes(query, k=k, token_budget=token_budget)
+            if not thoughts:
+                return {"answer": "No relevant notes found.", "note_ids": []}
+        else:
+            last_days = 60
+            thoughts = self.db_action_handler.get_recent_notes(time_frame=last_days, user_id=self.user_id)
+            if not thoughts:
+                return {"answer": "No notes found in the last {} days.".format(last_days), "note_ids": []}
+        concat_thoughts = "\n".join([format_note_for_query(thought) for thought in thoughts])
         arbitrary_query_prompt = (
             "Please review the following notes and respond with the most relevant ones to the provided query, "
-            "preserving the original formatting of the notes. "
+            "preserving the original formatting of the notes, including the number in square brackets. "
             "If there are no relevant notes, simply respond with 'No relevant notes'. "
             "Respond only with the relevant notes. Here's the query: '{}'\n\n"
             "Notes provided:\n{}\n\n"
-        ).format(query, concat_recent_thoughts)
+        ).format(query, concat_thoughts)
         LOGGER.debug(arbitrary_query_prompt)
-        llm_output = self.llm(arbitrary_query_prompt)
-        return llm_output
+        with metrics.stage("rag", "query_llm"):
+            if on_partial_answer is None:
+                llm_output = self.call_llm(arbitrary_query_prompt)
+            else:
+                llm_output = ""
+                for token in self.stream_llm(arbitrary_query_prompt):
+                    llm_output += token
+                    on_partial_answer(llm_output)
+        provided_note_ids = {thought.id for thought in thoughts}
+        note_ids = deduplicate_with_order_preservation(
+            [int(note_id) for note_id in re.findall(r'\[(\d+)\]', llm_output) if int(note_id) in provided_note_ids]
+        )
+        return {"answer": llm_output, "note_ids": note_ids}
 
 
 def extract_category_from_orca_output(text: str, triggers: List[str]) -> str:
@@ -170,6 +435,15 @@ def extract_category_from_llm_output(text: str, triggers: List[str]) -> str:
     return text
 
 
+def format_note_for_query(thought) -> str:
+    return f"[{thought.id}] Note: '{thought.note_text}', Category: '{thought.label}'"
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough estimate for English text, good enough to keep the prompt within a budget
+    return len(text) // 4 + 1
+
+
 def deduplicate_with_order_preservation(seq):
     seen = set()
     seen_add = seen.add
@@ -0,0 +1,95 @@
+import argparse
+from datetime import datetime
+import logging
+from typing import Optional
+
+from db_action_handler import DBActionHandler
+from rag import RAG
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+def reclassify(
+        label=None,
+        status=None,
+        since=None,
+        limit=None,
+        batch_size: int = 32,
+        dry_run: bool = False,
+        username: Optional[str] = None,
+        after_id: Optional[int] = None,
+) -> int:
+    """
+    Reclassifies the notes matching the filters with RAG.predict_many and writes the changed labels back in bulk,
+    one batch at a time, in the order of their ids. Returns the number of notes whose label changed.
+    A batch that can't be predicted or written stops the run with the error; the log says where to resume.
+    :param username: only the notes of this user, classified with the user's own examples and categories
+    :param after_id: resumes an interrupted run after the last note id it logged
+    """
+    action_handler = DBActionHandler()
+    user_id = None
+    if username is not None:
+        user = action_handler.get_user(username)
+        if user is None:
+            raise ValueError(f"Unknown user '{username}'")
+        user_id = user.id
+    rag = RAG(user_id=user_id)
+    notes = action_handler.filter_notes(
+        label=label, status=status, since=since, limit=limit, user_id=user_id, after_id=after_id
+    )
+    logger.info(f"Reclassifying {len(notes)} notes")
+    changed_count = 0
+    for start in range(0, len(notes), batch_size):
+        batch = notes[start:start + batch_size]
+        try:
+            predictions = rag.predict_many([note.note_text for note in batch], note_ids=[note.id for note in batch])
+        except Exception as e:
+            # stops instead of moving on, so that resuming from the last logged id doesn't skip the failed batch
+            resume_after_id = notes[start - 1].id if start else after_id
+            logger.error(
+                f"Batch starting at note {batch[0].id} failed: {e}. {changed_count} labels changed so far"
+                + (f", resume with --after-id {resume_after_id}" if resume_after_id is not None else "")
+            )
+            raise
+        new_labels = {
+            note.id: prediction['category']
+            for note, prediction in zip(batch, predictions) if prediction['category'] != note.label
+        }
+        for note in batch:
+            if note.id in new_labels:
+                logger.info(f"{note.note_text!r}: {note.label!r} -> {new_labels[note.id]!r}")
+        if new_labels and not dry_run:
+            action_handler.bulk_update_labels(new_labels)
+            for note in batch:
+                if note.id in new_labels:
+                    rag.update_note(note.id, note.note_text, new_labels[note.id])
+        changed_count += len(new_labels)
+        logger.info(
+            f"Processed {start + len(batch)}/{len(notes)} notes up to id {batch[-1].id} (resume with --after-id), "
+            f"{changed_count} labels changed"
+        )
+    return changed_count
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description="Reclassify notes from the thought table and update their labels.")
+    args.add_argument('--user', type=str, help="only notes of this user (telegram username)")
+    args.add_argument('--label', type=str, help="only notes with this label")
+    args.add_argument('--status', type=str, help="only notes with this status")
+    args.add_argument('--since', type=datetime.fromisoformat, help="only notes created since this date (YYYY-MM-DD)")
+    args.add_argument('--limit', type=int)
+    args.add_argument('--batch-size', type=int, default=32)
+    args.add_argument('--dry-run', action='store_true', help="log the new labels without writing them")
+    args.add_argument('--after-id', type=int, help="only notes after this id, to resume an interrupted run")
+    parsed_args = args.parse_args()
+    reclassify(
+        label=parsed_args.label,
+        status=parsed_args.status,
+        since=parsed_args.since,
+        limit=parsed_args.limit,
+        batch_size=parsed_args.batch_size,
+        dry_run=parsed_args.dry_run,
+        username=parsed_args.user,
+        after_id=parsed_args.after_id,
+    )
@@ -0,0 +1,58 @@
+from dataclasses import dataclass
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from db_entities import User
+
+
+@dataclass(frozen=True)
+class Account:
+    """The fields of a User that handlers need, detached from the database session."""
+    id: int
+    username: str
+    is_admin: bool
+
+
+class UserDirectory:
+    """
+    Cached lookup of the bot's users by Telegram username, used to authorize every update.
+    Known users are cached for ttl_seconds and unknown usernames for negative_ttl_seconds, so handlers don't query the
+    user table, and messages from strangers don't reach the database every time.
+    """
+    def __init__(
+            self,
+            lookup: Callable[[str], Optional[User]],
+            ttl_seconds: float = 300.0,
+            negative_ttl_seconds: float = 30.0,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.lookup = lookup
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.accounts: Dict[str, Tuple[Optional[Account], float]] = {}  # username -> account and expiry time
+
+    def get(self, username: Optional[str]) -> Optional[Account]:
+        if not username:
+            return None
+        now = self.clock()
+        with self.lock:
+            cached = self.accounts.get(username)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+        user = self.lookup(username)
+        account = Account(id=user.id, username=user.username, is_admin=bool(user.is_admin)) if user else None
+        ttl = self.ttl_seconds if account else self.negative_ttl_seconds
+        with self.lock:
+            self.accounts[username] = (account, now + ttl)
+        return account
+
+    def invalidate(self, username: Optional[str] = None) -> None:
+        """Drops one username, or all of them, from the cache, e.g. after adding a user."""
+        with self.lock:
+            if username is None:
+                self.accounts.clear()
+            else:
+                self.accounts.pop(username, None)
@@ -0,0 +1,80 @@
+import threading
+from typing import Dict, Hashable, List, Sequence, Tuple
+
+import numpy as np
+
+
+class VectorIndex:
+    """
+    In-memory exact nearest neighbour index: a matrix of L2-normalized embeddings with one unique key per row.
+    A lookup for a batch of queries is a single matrix multiply followed by a partial sort.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys: List[Hashable] = []
+        self.positions: Dict[Hashable, int] = {}
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+
+    @classmethod
+    def from_embeddings(cls, keys: Sequence[Hashable], vectors) -> 'VectorIndex':
+        index = cls()
+        unique_rows = {}
+        for key, vector in zip(keys, vectors):
+            unique_rows.setdefault(key, vector)
+        if unique_rows:
+            index.keys = list(unique_rows)
+            index.positions = {key: position for position, key in enumerate(index.keys)}
+            index.matrix = normalize(np.asarray(list(unique_rows.values()), dtype=np.float32))
+        return index
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.positions
+
+    def add(self, key: Hashable, vector) -> None:
+        """Adds a vector, replacing the existing one if the key is already in the index."""
+        row = normalize(np.asarray(vector, dtype=np.float32).reshape(1, -1))
+        with self.lock:
+            if key in self.positions:
+                matrix = self.matrix.copy()
+                matrix[self.positions[key]] = row[0]
+                self.matrix = matrix
+                return
+            matrix = row if not self.keys else np.vstack([self.matrix, row])
+            self.positions = {**self.positions, key: len(self.keys)}
+            self.keys = self.keys + [key]
+            self.matrix = matrix
+
+    def remove(self, key: Hashable) -> None:
+        with self.lock:
+            if key not in self.positions:
+                return
+            position = self.positions[key]
+            keys = self.keys[:position] + self.keys[position + 1:]
+            self.matrix = np.delete(self.matrix, position, axis=0)
+            self.keys = keys
+            self.positions = {key: position for position, key in enumerate(keys)}
+
+    def search(self, query_vectors, k: int) -> List[List[Tuple[Hashable, float]]]:
+        """Returns the k most similar keys with their cosine similarity for each query vector."""
+        with self.lock:
+            keys, matrix = self.keys, self.matrix  # writers replace both instead of mutating them in place
+        queries = normalize(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        if not keys:
+            return [[] for _ in range(len(queries))]
+        k = min(k, len(keys))
+        scores = queries @ matrix.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for query_scores, candidates in zip(scores, top):
+            ordered = candidates[np.argsort(-query_scores[candidates])]
+            results.append([(keys[i], float(query_scores[i])) for i in ordered])
+        return results
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
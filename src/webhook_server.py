@@ -0,0 +1,120 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hmac
+import json
+import logging
+import queue
+import threading
+from typing import List, Optional
+
+import telebot
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Local HTTP server for Telegram webhook updates.
+    Requests without the right secret token are rejected. Accepted updates go into a bounded queue that handler
+    workers consume. When the queue is full the server answers 503, so Telegram backs off and redelivers the update
+    later instead of the process buffering without limit.
+    """
+    def __init__(
+            self,
+            bot: telebot.TeleBot,
+            secret_token: str,
+            host: str = "127.0.0.1",
+            port: int = 8443,
+            path: str = "/webhook",
+            queue_size: int = 100,
+            workers: int = 4,
+    ):
+        self.bot = bot
+        self.secret_token = secret_token
+        self.path = path
+        self.workers = workers
+        self.updates: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.threads: List[threading.Thread] = []
+        self.server = ThreadingHTTPServer((host, port), self._make_request_handler())
+
+    @property
+    def port(self) -> int:
+        return self.server.server_port
+
+    def start(self) -> None:
+        # handlers run inline in the webhook workers
+        self.bot.threaded = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"webhook-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        server_thread = threading.Thread(target=self.server.serve_forever, name="webhook-server", daemon=True)
+        server_thread.start()
+        self.threads.append(server_thread)
+        logger.info(f"Webhook server listening on port {self.port}")
+
+    def serve_forever(self) -> None:
+        self.start()
+        for thread in self.threads:
+            thread.join()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        for _ in range(self.workers):
+            self.updates.put(None)
+
+    def queue_depth(self) -> int:
+        return self.updates.qsize()
+
+    def accept(self, secret_token: Optional[str], body: bytes) -> int:
+        """Validates and enqueues one webhook request, returns the HTTP status for Telegram."""
+        if secret_token is None or not hmac.compare_digest(secret_token, self.secret_token):
+            return 403
+        try:
+            update = telebot.types.Update.de_json(json.loads(body))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # not JSON, or JSON that is not shaped like an update
+            return 400
+        if update is None:
+            # a JSON null; None is also the stop signal of the workers
+            return 400
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            logger.warning(f"Update queue is full, rejecting update {update.update_id}")
+            return 503
+        return 200
+
+    def _work(self) -> None:
+        while True:
+            update = self.updates.get()
+            if update is None:
+                return
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"Handler for update {update.update_id} failed: {e}")
+
+    def _make_request_handler(self):
+        webhook_server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != webhook_server.path:
+                    self._respond(404)
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._respond(webhook_server.accept(self.headers.get(SECRET_TOKEN_HEADER), body))
+
+            def _respond(self, status: int) -> None:
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return RequestHandler
@@ -0,0 +1,26 @@
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+# add src to path
+sys.path.append('src')
+
+import db_utils
+from db_entities import Base
+
+
+@pytest.fixture
+def empty_engine(monkeypatch):
+    # an in-memory SQLite database without tables, used by every session of db_utils instead of the configured one
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    monkeypatch.setattr(db_utils, "_engine", engine)
+    return engine
+
+
+@pytest.fixture
+def db_engine(empty_engine):
+    # the same database with the tables of db_entities
+    Base.metadata.create_all(empty_engine)
+    return empty_engine
@@ -0,0 +1,75 @@
+import asyncio
+import sys
+import threading
+import time
+
+import telebot
+
+# add src to path
+sys.path.append('src')
+
+from async_runtime import AsyncRuntime
+
+
+class RecordingBot:
+    """Stands in for the sync bot: records when each update was handled."""
+    def __init__(self, slow_texts):
+        self.threaded = True
+        self.slow_texts = slow_texts
+        self.lock = threading.Lock()
+        self.handled = []
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            if update.message.text in self.slow_texts:
+                time.sleep(0.3)
+            with self.lock:
+                self.handled.append(update.message.text)
+
+
+def make_update(update_id, chat_id, text):
+    return telebot.types.Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+            'text': text,
+        },
+    })
+
+
+def process(runtime, updates):
+    async def run():
+        await runtime.process_new_updates(updates)
+        while runtime.tasks or runtime.chat_lanes or len(runtime.sync_bot.handled) < len(updates):
+            await asyncio.sleep(0.01)
+    asyncio.run(run())
+
+
+def test_updates_of_a_chat_keep_their_order():
+    sync_bot = RecordingBot(slow_texts={'slow note'})
+    runtime = AsyncRuntime(sync_bot, 'token')
+    process(runtime, [make_update(1, 10, 'slow note'), make_update(2, 10, '/new'), make_update(3, 10, 'next note')])
+    assert sync_bot.handled == ['slow note', '/new', 'next note']
+    assert not sync_bot.threaded
+    runtime.shutdown()
+
+
+def test_quick_commands_do_not_wait_for_classification():
+    sync_bot = RecordingBot(slow_texts={'slow note'})
+    runtime = AsyncRuntime(sync_bot, 'token')
+    process(runtime, [make_update(1, 10, 'slow note'), make_update(2, 20, '/new'), make_update(3, 10, '/random')])
+    assert sync_bot.handled[-1] == 'slow note'
+    runtime.shutdown()
+
+
+def test_in_flight_updates_are_capped_and_released():
+    sync_bot = RecordingBot(slow_texts={'slow note'})
+    runtime = AsyncRuntime(sync_bot, 'token', max_in_flight=1)
+    # with a single slot, the quick command of another chat waits for the slow note
+    process(runtime, [make_update(1, 10, 'slow note'), make_update(2, 20, '/random')])
+    assert sync_bot.handled == ['slow note', '/random']
+    assert not runtime.tasks
+    runtime.shutdown()
@@ -0,0 +1,43 @@
+import sys
+
+# add src to path
+sys.path.append('src')
+
+from categories_to_html import CategoryTree
+
+
+def make_tree():
+    tree = CategoryTree()
+    tree.parse_categories(["Chores > Cleaning", "Broaden knowledge > Read books", "Note"])
+    return tree
+
+
+def test_document_contains_categories_and_todos():
+    tree = make_tree()
+    tree.add_todo_to_category("Broaden knowledge > Read books", "read Sapiens")
+    html = tree.generate_html_with_todos()
+    assert html.count("<html>") == 1
+    assert "toggleVisibility('1_0')\">Read books</span>" in html
+    assert '<li style="list-style-type: disc;">read Sapiens</li>' in html
+
+
+def test_unchanged_tree_is_served_from_cache():
+    tree = make_tree()
+    assert tree.get_html_document() is tree.get_html_document()
+
+
+def test_only_the_changed_path_is_rendered_again():
+    tree = make_tree()
+    tree.get_html_document()
+    chores_html = tree.tree["Chores"]["html"]
+    tree.add_todo_to_category("Broaden knowledge > Read books", "read Sapiens")
+    assert tree.tree["Broaden knowledge"]["html"] is None
+    assert tree.tree["Broaden knowledge"]["subcategories"]["Read books"]["html"] is None
+    html = tree.get_html_document().decode()
+    assert tree.tree["Chores"]["html"] is chores_html
+    assert "read Sapiens" in html
+
+    # same as rendering everything from scratch
+    fresh_tree = make_tree()
+    fresh_tree.add_todo_to_category("Broaden knowledge > Read books", "read Sapiens")
+    assert html == fresh_tree.generate_html_with_todos()
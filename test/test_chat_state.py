@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+import sys
+
+import pytest
+
+# add src to path
+sys.path.append('src')
+
+from chat_state import ChatState, InMemoryChatStateStore, SQLiteChatStateStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return InMemoryChatStateStore()
+    return SQLiteChatStateStore(tmp_path / "chat_state.sqlite")
+
+
+def test_states_are_separate_per_chat(store):
+    store.update(1, category_editing=True, editing_message_id=42)
+    assert store.get(1).category_editing
+    assert store.get(1).editing_message_id == 42
+    assert store.get(2) == ChatState()
+
+
+def test_transition_returns_previous_state(store):
+    store.update(1, query_mode=True, candidate_categories=["Chores"])
+    previous_state, new_state = store.transition(1, lambda state: replace(state, query_mode=False))
+    assert previous_state.query_mode
+    assert not new_state.query_mode
+    assert store.get(1).candidate_categories == ["Chores"]
+
+
+def test_transitions_are_atomic(store):
+    store.update(1, query_mode=True)
+
+    def consume_query_mode(_):
+        previous_state, _ = store.transition(1, lambda state: replace(state, query_mode=False))
+        return previous_state.query_mode
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        consumed = list(executor.map(consume_query_mode, range(50)))
+    assert consumed.count(True) == 1
+
+
+def test_sqlite_store_survives_restart(tmp_path):
+    path = tmp_path / "chat_state.sqlite"
+    SQLiteChatStateStore(path).update(1, editing_message_id=7)
+    assert SQLiteChatStateStore(path).get(1).editing_message_id == 7
@@ -0,0 +1,52 @@
+import sys
+import threading
+
+# add src to path
+sys.path.append('src')
+
+from classification_queue import ClassificationQueue
+
+
+def wait_until(condition, timeout=5.0):
+    event = threading.Event()
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return True
+        event.wait(0.01)
+    return False
+
+
+def test_pending_jobs_survive_restart(tmp_path):
+    path = tmp_path / "queue.sqlite"
+    ClassificationQueue(path, classify=lambda job: None).enqueue(1, 10, "buy milk")
+
+    classified = []
+    queue = ClassificationQueue(path, classify=classified.append, poll_interval=0.05)
+    assert queue.depth() == 1
+    queue.start()
+    assert wait_until(lambda: queue.depth() == 0)
+    queue.stop()
+    assert [(job.note_id, job.chat_id, job.note_text) for job in classified] == [(1, 10, "buy milk")]
+    assert queue.stats()["done"] == 1
+    # finished jobs are deleted
+    assert queue.connection.execute("SELECT COUNT(*) FROM classification_job").fetchone()[0] == 0
+
+
+def test_failed_job_is_retried_then_marked_failed(tmp_path):
+    attempts = []
+
+    def classify(job):
+        attempts.append(job.attempts)
+        raise RuntimeError("LLM is down")
+
+    failed = []
+    queue = ClassificationQueue(
+        tmp_path / "queue.sqlite", classify=classify, max_attempts=2, poll_interval=0.05,
+        on_failed=lambda job, error: failed.append((job.note_id, str(error))),
+    )
+    queue.enqueue(1, 10, "buy milk")
+    queue.start()
+    assert wait_until(lambda: queue.stats()["failed"] == 1)
+    assert wait_until(lambda: failed == [(1, "LLM is down")])
+    queue.stop()
+    assert attempts == [1, 2]
@@ -0,0 +1,230 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import pytest
+
+# add src to path
+sys.path.append('src')
+
+import db_utils
+from db_action_handler import PENDING_LABEL, UNCLASSIFIED_LABEL, DBActionHandler, NoteCount
+from db_entities import Thought
+from note_sampler import NoteSampler
+
+
+@pytest.fixture
+def action_handler(db_engine):
+    return DBActionHandler()
+
+
+def add_note(action_handler, text, message_id, user_id=1):
+    note = Thought(note_text=text, label="Chores", urgency="week", status="open", message_id=message_id,
+                   user_id=user_id)
+    action_handler.add_thought(note)
+    return note
+
+
+def test_session_scope_rolls_back_on_error(action_handler):
+    with pytest.raises(RuntimeError):
+        with db_utils.session_scope() as session:
+            session.add(Thought(note_text="never saved", status="open"))
+            session.flush()
+            raise RuntimeError("handler failed")
+    with db_utils.session_scope() as session:
+        assert session.query(Thought).count() == 0
+
+
+def test_failed_update_does_not_break_the_next_queries(action_handler):
+    add_note(action_handler, "buy milk", message_id=10)
+    # no note with this message id: the update fails inside its unit of work
+    assert action_handler.update_note_status(999, "done") is None
+    note = action_handler.update_note_status(10, "done")
+    assert note.status == "done"
+
+
+def test_returned_notes_are_usable_after_the_session_is_closed(action_handler):
+    note = add_note(action_handler, "buy milk", message_id=10)
+    assert note.id is not None
+    fetched = action_handler.get_note_by_message_id(10, user_id=1)
+    assert fetched.note_text == "buy milk"
+    assert action_handler.get_note_by_message_id(10, user_id=2) is None
+
+
+def test_handler_can_be_used_from_several_threads(action_handler):
+    for i in range(20):
+        add_note(action_handler, f"note {i}", message_id=i)
+    with ThreadPoolExecutor(4) as executor:
+        notes = list(executor.map(lambda i: action_handler.get_note_by_message_id(i), range(20)))
+    assert [note.note_text for note in notes] == [f"note {i}" for i in range(20)]
+
+
+def test_random_note_skips_done_notes_and_follows_status_changes(action_handler, monkeypatch):
+    monkeypatch.setattr(DBActionHandler, "note_sampler", NoteSampler())
+    add_note(action_handler, "buy milk", message_id=1)
+    add_note(action_handler, "read Sapiens", message_id=2)
+    action_handler.update_note_status(1, "done")
+    assert {action_handler.get_random_note(user_id=1).note_text for _ in range(10)} == {"read Sapiens"}
+    add_note(action_handler, "call mom", message_id=3)
+    assert "call mom" in {action_handler.get_random_note(user_id=1).note_text for _ in range(30)}
+    action_handler.update_note_status(2, "done")
+    action_handler.update_note_status(3, "done")
+    assert action_handler.get_random_note(user_id=1) is None
+
+
+def test_random_note_skips_ids_of_notes_deleted_by_another_process(action_handler, monkeypatch):
+    monkeypatch.setattr(DBActionHandler, "note_sampler", NoteSampler())
+    add_note(action_handler, "buy milk", message_id=1)
+    assert action_handler.get_random_note(user_id=1).note_text == "buy milk"
+    add_note(action_handler, "read Sapiens", message_id=2)
+    with db_utils.session_scope() as session:
+        session.query(Thought).filter(Thought.message_id == 1).delete()
+    assert {action_handler.get_random_note(user_id=1).note_text for _ in range(10)} == {"read Sapiens"}
+
+
+def test_note_counts_are_grouped_in_the_database(action_handler):
+    for text, label, status, created in [
+        ("a", "Chores", "open", datetime(2024, 1, 1, 9)),  # Monday
+        ("b", "Chores", "done", datetime(2024, 1, 3, 9)),
+        ("c", "Chores", "open", datetime(2024, 1, 10, 9)),
+        ("d", "Books", "open", datetime(2024, 2, 1, 9)),
+        ("e", "Books", "open", datetime(2023, 12, 1, 9)),  # before the range
+    ]:
+        action_handler.add_thought(Thought(note_text=text, label=label, status=status, date_created=created,
+                                           user_id=1))
+    counts = action_handler.get_note_counts(datetime(2024, 1, 1), user_id=1)
+    assert sorted(counts, key=str) == sorted([
+        NoteCount("Chores", "open", None, 2), NoteCount("Chores", "done", None, 1), NoteCount("Books", "open", None, 1)
+    ], key=str)
+    by_week = action_handler.get_note_counts(datetime(2024, 1, 1), datetime(2024, 2, 1), time_bucket='week')
+    assert sorted((c.period, c.status, c.count) for c in by_week) == [
+        (date(2024, 1, 1), "done", 1), (date(2024, 1, 1), "open", 1), (date(2024, 1, 8), "open", 1)
+    ]
+    by_month = action_handler.get_note_counts(datetime(2024, 1, 1), time_bucket='month', user_id=2)
+    assert by_month == []
+    with pytest.raises(ValueError):
+        action_handler.get_note_counts(datetime(2024, 1, 1), time_bucket='year')
+
+
+def test_plot_image_is_rendered_from_counts_and_cached(action_handler):
+    action_handler.add_thought(Thought(note_text="a", label="Chores", status="open", user_id=1))
+    png = action_handler.get_plot_image(user_id=1)
+    assert png.startswith(b'\x89PNG')
+    assert action_handler.get_plot_image(user_id=1) is png
+
+
+def test_plot_cache_keeps_one_image_per_user(action_handler, monkeypatch):
+    monkeypatch.setattr(DBActionHandler, "plot_cache", {})
+    action_handler.add_thought(Thought(note_text="a", label="Chores", status="open", user_id=1))
+    # the default range starts a day later every day
+    for day in range(1, 4):
+        action_handler.get_plot_image(user_id=1, start=datetime(2024, 1, day))
+    action_handler.get_plot_image(user_id=2, start=datetime(2024, 1, 1))
+    assert set(DBActionHandler.plot_cache) == {1, 2}
+    assert DBActionHandler.plot_cache[1]['range'] == (datetime(2024, 1, 3), None)
+
+
+def test_search_ranks_matching_notes_and_follows_updates(action_handler):
+    add_note(action_handler, "call the plumber about the kitchen sink", message_id=1)
+    add_note(action_handler, "kitchen: buy a new kettle for the kitchen", message_id=2)
+    add_note(action_handler, "kitchen sink for user two", message_id=3, user_id=2)
+    assert [note.message_id for note in action_handler.search_notes("kitchen", user_id=1)] == [2, 1]
+    # every word has to match, also as a prefix, and query syntax in the text is taken literally
+    assert [note.message_id for note in action_handler.search_notes('"plumb" (sink*', user_id=1)] == [1]
+    assert action_handler.search_notes("?!", user_id=1) == []
+
+    action_handler.update_note_category(1, "Home", user_id=1)
+    with db_utils.session_scope() as session:
+        session.query(Thought).filter(Thought.message_id == 2).update({"note_text": "buy a new kettle"})
+    assert [note.message_id for note in action_handler.search_notes("kitchen", user_id=1)] == [1]
+    assert [note.message_id for note in action_handler.search_notes("kettle", user_id=1)] == [2]
+
+
+def test_sqlite_file_database_uses_wal(tmp_path):
+    engine = db_utils.create_database_engine(f"sqlite:///{tmp_path / 'thoughtflow.db'}")
+    try:
+        with engine.connect() as connection:
+            assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+            assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+            assert connection.exec_driver_sql("PRAGMA foreign_keys").scalar() == 1
+    finally:
+        engine.dispose()
+
+
+def test_predicted_label_does_not_overwrite_a_category_picked_by_the_user(action_handler):
+    pending = Thought(note_text="buy milk", label=PENDING_LABEL, status="open", message_id=1, user_id=1)
+    picked = Thought(note_text="read Sapiens", label=PENDING_LABEL, status="open", message_id=2, user_id=1)
+    action_handler.add_thought(pending)
+    action_handler.add_thought(picked)
+    action_handler.update_note_category(2, "Books", user_id=1)
+
+    assert action_handler.set_predicted_label(pending.id, UNCLASSIFIED_LABEL).label == UNCLASSIFIED_LABEL
+    # a retried job may still classify an unclassified note
+    assert action_handler.set_predicted_label(pending.id, "Chores").label == "Chores"
+    assert action_handler.set_predicted_label(picked.id, "Chores") is None
+    assert action_handler.get_note_by_id(picked.id).label == "Books"
+
+
+def test_plot_image_is_rendered_again_after_a_write_by_another_process(action_handler):
+    action_handler.add_thought(Thought(note_text="a", label="Chores", status="open", user_id=1))
+    png = action_handler.get_plot_image(user_id=1)
+    # e.g. the reclassify script, which doesn't go through this handler and doesn't add notes
+    with db_utils.get_engine().begin() as connection:
+        connection.exec_driver_sql("UPDATE thought SET status = 'done'")
+    assert action_handler.get_plot_image(user_id=1) is not png
+
+
+def test_filter_notes(action_handler):
+    for message_id, (label, status, created) in enumerate([
+        ("Chores", "open", datetime(2024, 1, 1)),
+        ("Books", "open", datetime(2024, 2, 1)),
+        ("Chores", "done", datetime(2024, 3, 1)),
+        ("Chores", "open", datetime(2024, 4, 1)),
+    ], 1):
+        action_handler.add_thought(Thought(note_text=f"note {message_id}", label=label, status=status,
+                                           date_created=created, message_id=message_id, user_id=1))
+    action_handler.add_thought(Thought(note_text="other user", label="Chores", status="open", user_id=2))
+
+    def filtered(**filters):
+        return [note.message_id for note in action_handler.filter_notes(user_id=1, **filters)]
+
+    assert filtered() == [1, 2, 3, 4]
+    assert filtered(label="Chores") == [1, 3, 4]
+    assert filtered(label="Chores", status="open") == [1, 4]
+    assert filtered(since=datetime(2024, 2, 1)) == [2, 3, 4]
+    assert filtered(limit=2) == [1, 2]
+    first_two = action_handler.filter_notes(user_id=1, limit=2)
+    assert filtered(after_id=first_two[-1].id) == [3, 4]
+    assert len(action_handler.filter_notes(label="Chores")) == 4
+
+
+def test_bulk_update_labels(action_handler):
+    notes = [add_note(action_handler, f"note {i}", message_id=i) for i in range(3)]
+    action_handler.bulk_update_labels({notes[0].id: "Books", notes[2].id: "Work"})
+    assert [note.label for note in action_handler.filter_notes(user_id=1)] == ["Books", "Chores", "Work"]
+
+
+def test_notes_by_ids_keep_the_order_of_the_ids(action_handler):
+    notes = [add_note(action_handler, f"note {i}", message_id=i) for i in range(3)]
+    other_user_note = add_note(action_handler, "not yours", message_id=3, user_id=2)
+    note_ids = [notes[2].id, 999, notes[0].id, other_user_note.id]
+    assert [note.note_text for note in action_handler.get_notes_by_ids(note_ids, user_id=1)] == ["note 2", "note 0"]
+
+
+def test_all_classified_notes_are_returned(action_handler):
+    with db_utils.session_scope() as session:
+        session.execute(Thought.__table__.insert(), [
+            {"note_text": f"note {i}", "label": "Chores", "status": "open", "user_id": 1} for i in range(1200)
+        ])
+    add_note(action_handler, "waiting", message_id=1)
+    action_handler.add_thought(Thought(note_text="pending", label=PENDING_LABEL, status="open", user_id=1))
+    notes = action_handler.get_all_notes(user_id=1)
+    assert len(notes) == 1201
+    assert "note 0" in {note.note_text for note in notes}
+
+
+def test_status_of_an_unknown_message_is_not_updated(action_handler):
+    add_note(action_handler, "buy milk", message_id=1)
+    assert action_handler.update_note_status(2, "done", user_id=1) is None
+    assert action_handler.update_note_status(1, "done", user_id=2) is None
+    assert action_handler.update_note_status(1, "done", user_id=1).status == "done"
@@ -0,0 +1,134 @@
+import sys
+
+import pytest
+from sqlalchemy import inspect
+
+# add src to path
+sys.path.append('src')
+
+from db_entities import Thought
+from ddl_scripts import DB_DDL, reload_data
+
+OLD_SCHEMA = [
+    "CREATE TABLE thought (id INTEGER PRIMARY KEY AUTOINCREMENT, note_text VARCHAR(512), label VARCHAR(512), "
+    "urgency VARCHAR(16), status VARCHAR(16), eta FLOAT, date_created DATETIME, date_completed DATETIME, "
+    "message_id INTEGER)",
+    "CREATE TABLE category (id INTEGER PRIMARY KEY AUTOINCREMENT, show_category VARCHAR(512), "
+    "semantic_category VARCHAR(512))",
+    "CREATE TABLE user (id INTEGER PRIMARY KEY AUTOINCREMENT, username VARCHAR(64), password VARCHAR(64), "
+    "email VARCHAR(64), is_admin BOOLEAN)",
+    "INSERT INTO thought (note_text, label, status, message_id) VALUES ('buy milk', 'Chores', 'open', 1)",
+    "INSERT INTO thought (note_text, label, status, message_id) VALUES ('read Sapiens', 'Books', 'open', 2)",
+    "INSERT INTO category (show_category) VALUES ('Chores')",
+]
+
+
+@pytest.fixture
+def engine(empty_engine):
+    with empty_engine.begin() as connection:
+        for statement in OLD_SCHEMA:
+            connection.exec_driver_sql(statement)
+    return empty_engine
+
+
+def index_names(engine, table_name):
+    return {index['name'] for index in inspect(engine).get_indexes(table_name)}
+
+
+def test_assign_owner_migrates_a_single_user_database(engine):
+    DB_DDL().assign_owner("alice")
+    assert {'uq_thought_user_id_message_id', 'ix_thought_status_date_created'} <= index_names(engine, 'thought')
+    with engine.connect() as connection:
+        user_id = connection.exec_driver_sql("SELECT id FROM user WHERE username = 'alice'").scalar()
+        owners = connection.exec_driver_sql("SELECT DISTINCT user_id FROM thought").fetchall()
+        assert owners == [(user_id,)]
+        plan = connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT * FROM thought WHERE user_id = 1 AND message_id = 2"
+        ).fetchall()
+        assert "uq_thought_user_id_message_id" in str(plan)
+
+
+def test_migrate_is_idempotent_and_drops_replaced_indexes(engine):
+    DB_DDL().migrate()
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE INDEX ix_thought_user_id_status ON thought (user_id, status)")
+    DB_DDL().migrate()
+    names = index_names(engine, 'thought')
+    assert 'ix_thought_user_id_status' not in names
+    assert 'ix_thought_user_id_status_date_created' in names
+
+
+def test_unique_index_is_not_created_over_duplicates(engine):
+    with engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO thought (note_text, status, message_id) VALUES ('again', 'open', 1)")
+    with pytest.raises(ValueError, match="occur more than once"):
+        DB_DDL().assign_owner("alice")
+
+
+CSV = (
+    "note_text,label,urgency,status,eta,date_created,date_completed,extra\n"
+    + "".join(f"note {i},Chores,week,open,{'' if i % 2 else 1.5},2023-05-0{i % 9 + 1} 10:00:00,none,x\n"
+              for i in range(10))
+)
+
+
+def test_import_in_chunks(db_engine, tmp_path):
+    csv_file = tmp_path / "thoughts.csv"
+    csv_file.write_text(CSV)
+    assert DB_DDL().add_thoughts_from_csv(csv_file, user_id=7, chunksize=3, commit_size=4) == 10
+    with db_engine.connect() as connection:
+        rows = connection.exec_driver_sql(
+            "SELECT note_text, eta, date_created, date_completed, user_id FROM thought ORDER BY id"
+        ).fetchall()
+        checkpoints = connection.exec_driver_sql("SELECT COUNT(*) FROM import_checkpoint").scalar()
+    assert [row[0] for row in rows] == [f"note {i}" for i in range(10)]
+    assert rows[0][1:] == (1.5, "2023-05-01 10:00:00.000000", None, 7)
+    assert rows[1][1] == 0.5
+    assert checkpoints == 0
+
+
+def test_import_resumes_after_the_committed_rows(db_engine, tmp_path):
+    csv_file = tmp_path / "thoughts.csv"
+    csv_file.write_text(CSV)
+    db_ddl = DB_DDL()
+    source = f"thought:{csv_file.resolve()}"
+    # an earlier run committed 6 rows and stopped
+    db_ddl.session.execute(Thought.__table__.insert(), [{"note_text": f"note {i}"} for i in range(6)])
+    db_ddl.commit_import(source, 6)
+    assert db_ddl.add_thoughts_from_csv(csv_file, chunksize=3) == 4
+    with db_engine.connect() as connection:
+        texts = [row[0] for row in connection.exec_driver_sql("SELECT note_text FROM thought ORDER BY id")]
+    assert texts == [f"note {i}" for i in range(10)]
+
+
+def test_reload_imports_the_notes_for_the_owner(db_engine, tmp_path):
+    csv_file = tmp_path / "thoughts.csv"
+    csv_file.write_text(CSV)
+    reload_data(csv_file, "alice", chunksize=3)
+    with db_engine.connect() as connection:
+        user_id, is_admin = connection.exec_driver_sql("SELECT id, is_admin FROM user WHERE username = 'alice'").one()
+        owners = connection.exec_driver_sql("SELECT user_id, COUNT(*) FROM thought GROUP BY user_id").fetchall()
+    assert is_admin
+    assert owners == [(user_id, 10)]
+
+
+def test_resume_without_checkpoint_keeps_the_data(db_engine, tmp_path):
+    csv_file = tmp_path / "thoughts.csv"
+    csv_file.write_text(CSV)
+    with db_engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO thought (note_text) VALUES ('keep me')")
+    with pytest.raises(ValueError):
+        reload_data(csv_file, "alice", resume=True)
+    with db_engine.connect() as connection:
+        texts = [row[0] for row in connection.exec_driver_sql("SELECT note_text FROM thought")]
+    assert texts == ["keep me"]
+
+
+def test_migrate_indexes_existing_notes_for_search(engine):
+    DB_DDL().migrate()
+    with engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO thought (note_text, status) VALUES ('buy oat milk', 'open')")
+        ids = connection.exec_driver_sql(
+            "SELECT rowid FROM thought_fts WHERE thought_fts MATCH 'milk' ORDER BY rank"
+        ).scalars().all()
+    assert sorted(ids) == [1, 3]
@@ -0,0 +1,47 @@
+import sys
+
+# add src to path
+sys.path.append('src')
+
+from embedding_cache import EmbeddingCache
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.embedded_texts = []
+
+    def embed_documents(self, texts):
+        self.embedded_texts.extend(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def test_only_new_or_changed_notes_are_embedded(tmp_path):
+    path = tmp_path / "embeddings.sqlite"
+    embeddings = CountingEmbeddings()
+    EmbeddingCache(embeddings, path).get_embeddings({1: "buy milk", 2: "read Sapiens"})
+    assert embeddings.embedded_texts == ["buy milk", "read Sapiens"]
+
+    embeddings = CountingEmbeddings()
+    vectors = EmbeddingCache(embeddings, path).get_embeddings({1: "buy milk", 2: "read Dune", 3: "call mom"})
+    assert embeddings.embedded_texts == ["read Dune", "call mom"]
+    assert vectors[1].tolist() == [8.0, 1.0]
+    assert vectors[2].tolist() == [9.0, 1.0]
+
+
+def test_another_model_embeds_again(tmp_path):
+    path = tmp_path / "embeddings.sqlite"
+    EmbeddingCache(CountingEmbeddings(), path, model_name="model-a").get_embeddings({1: "buy milk"})
+
+    embeddings = CountingEmbeddings()
+    EmbeddingCache(embeddings, path, model_name="model-b").get_embeddings({1: "buy milk"})
+    assert embeddings.embedded_texts == ["buy milk"]
+
+
+def test_only_requested_notes_are_loaded(tmp_path):
+    path = tmp_path / "embeddings.sqlite"
+    texts = {note_id: f"note {note_id}" for note_id in range(1, 1201)}
+    EmbeddingCache(CountingEmbeddings(), path).get_embeddings(texts)
+
+    cache = EmbeddingCache(CountingEmbeddings(), path)
+    assert set(cache._load([3, 700, 1200, 5000])) == {3, 700, 1200}
+    assert len(cache._load(texts)) == 1200
@@ -0,0 +1,81 @@
+import sys
+import threading
+import time
+
+# add src to path
+sys.path.append('src')
+
+from lazy_resource import LazyResource, LazyResourceRegistry
+
+
+class SlowFactory:
+    """Counts its calls and takes a while, so that concurrent callers overlap."""
+    def __init__(self, delay=0.1):
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, key="resource"):
+        with self.lock:
+            self.calls.append(key)
+        time.sleep(self.delay)
+        return f"{key} #{len(self.calls)}"
+
+
+def test_resource_is_built_on_first_get():
+    factory = SlowFactory(delay=0)
+    resource = LazyResource("model", factory)
+    assert factory.calls == [] and not resource.is_ready()
+    assert resource.get() == "resource #1"
+    assert resource.get() == "resource #1"
+    assert factory.calls == ["resource"] and resource.is_ready()
+
+
+def test_concurrent_gets_wait_for_one_build():
+    factory = SlowFactory()
+    resource = LazyResource("model", factory)
+    start = threading.Barrier(8)
+    values = []
+
+    def get():
+        start.wait()
+        values.append(resource.get())
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    threads.append(resource.warm_up())
+    for thread in threads:
+        thread.join()
+    assert factory.calls == ["resource"]
+    assert values == ["resource #1"] * 8
+
+
+def test_failed_build_is_retried_by_the_next_get():
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("model download failed")
+        return "model"
+
+    resource = LazyResource("model", factory)
+    resource.warm_up().join()
+    assert not resource.is_ready()
+    assert resource.get() == "model"
+    assert len(attempts) == 2
+
+
+def test_registry_drops_the_least_recently_used_resource():
+    factory = SlowFactory(delay=0)
+    registry = LazyResourceRegistry("RAG", factory, max_size=2)
+    assert registry.get(1) == "1 #1"
+    assert registry.get(2) == "2 #2"
+    registry.get(1)
+    assert registry.get(3) == "3 #3"
+    # 2 was used least recently, it is built again when it is needed
+    assert len(registry) == 2
+    assert registry.get(1) == "1 #1"
+    assert registry.get(2) == "2 #4"
+    assert factory.calls == [1, 2, 3, 2]
@@ -0,0 +1,45 @@
+import sys
+
+# add src to path
+sys.path.append('src')
+
+from llm_cache import LLMCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_key_depends_on_model_kwargs_and_prompt():
+    key = LLMCache.make_key("mixtral", {"temperature": 0.5}, "prompt")
+    assert key == LLMCache.make_key("mixtral", {"temperature": 0.5}, "prompt")
+    assert key != LLMCache.make_key("mixtral", {"temperature": 0.1}, "prompt")
+    assert key != LLMCache.make_key("mistral", {"temperature": 0.5}, "prompt")
+    assert key != LLMCache.make_key("mixtral", {"temperature": 0.5}, "other prompt")
+
+
+def test_lru_eviction_and_counters():
+    cache = LLMCache(max_entries=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    assert cache.get("c") == "3"
+    assert cache.stats() == {"hits": 2, "misses": 1, "size": 2}
+
+
+def test_ttl_and_disk_tier(tmp_path):
+    clock = FakeClock()
+    db_path = tmp_path / "llm_cache.sqlite"
+    LLMCache(ttl_seconds=10, db_path=db_path, clock=clock).set("a", "1")
+
+    restarted_cache = LLMCache(ttl_seconds=10, db_path=db_path, clock=clock)
+    assert restarted_cache.get("a") == "1"
+    clock.now = 11
+    assert restarted_cache.get("a") is None
+    assert LLMCache(ttl_seconds=10, db_path=db_path, clock=clock).get("a") is None
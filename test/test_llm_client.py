@@ -0,0 +1,111 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import sys
+import threading
+import time
+
+import pytest
+
+# add src to path
+sys.path.append('src')
+
+from llm_client import DeepInfraClient, LLMRequestError, parse_stream_line
+
+
+class FakeDeepInfra(BaseHTTPRequestHandler):
+    # responses are popped in order; each is (status, delay in seconds)
+    responses = []
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        FakeDeepInfra.requests.append((self.path, body))
+        status, delay = FakeDeepInfra.responses.pop(0) if FakeDeepInfra.responses else (200, 0)
+        time.sleep(delay)
+        if body.get('stream'):
+            events = [{"token": {"text": f" {word}", "special": False}} for word in body['input'].split()]
+            payload = "".join(f"data: {json.dumps(event)}\n\n" for event in events).encode() + b"data: [DONE]\n\n"
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        payload = json.dumps({"results": [{"generated_text": f"echo: {body['input']}"}]}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def base_url():
+    FakeDeepInfra.responses = []
+    FakeDeepInfra.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeDeepInfra)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def make_client(base_url, **kwargs):
+    return DeepInfraClient("test/model", {"temperature": 0.5}, api_token="token", base_url=base_url,
+                           backoff_base=0.01, **kwargs)
+
+
+def test_sync_call_retries_server_errors(base_url):
+    FakeDeepInfra.responses = [(503, 0), (500, 0)]
+    client = make_client(base_url)
+    assert client("hello") == "echo: hello"
+    assert len(FakeDeepInfra.requests) == 3
+    assert FakeDeepInfra.requests[-1] == ("/test/model", {"input": "hello", "temperature": 0.5})
+    client.close()
+
+
+def test_client_error_is_not_retried(base_url):
+    FakeDeepInfra.responses = [(400, 0)]
+    client = make_client(base_url)
+    with pytest.raises(LLMRequestError):
+        client("hello")
+    assert len(FakeDeepInfra.requests) == 1
+    client.close()
+
+
+def test_deadline(base_url):
+    FakeDeepInfra.responses = [(200, 1.0)]
+    client = make_client(base_url)
+    with pytest.raises(LLMRequestError):
+        client.complete("hello", deadline=0.2)
+    client.close()
+
+
+def test_deadline_starts_when_the_call_gets_a_slot(base_url):
+    FakeDeepInfra.responses = [(200, 0.2)] * 3
+    client = make_client(base_url, max_concurrency=1)
+    # the last call waits 0.4s for its slot, only its own 0.2s count against the deadline
+    assert client.complete_many(["a", "b", "c"], deadline=0.35) == ["echo: a", "echo: b", "echo: c"]
+    client.close()
+
+
+def test_complete_many_keeps_order(base_url):
+    client = make_client(base_url, max_concurrency=2)
+    assert client.complete_many(["a", "b", "c"]) == ["echo: a", "echo: b", "echo: c"]
+    client.close()
+
+
+def test_stream_yields_tokens(base_url):
+    FakeDeepInfra.responses = [(503, 0)]
+    client = make_client(base_url)
+    assert list(client.stream("buy some milk")) == [" buy", " some", " milk"]
+    client.close()
+
+
+def test_parse_stream_line():
+    assert parse_stream_line(b'data: {"token": {"text": " Buy", "special": false}}\n') == " Buy"
+    assert parse_stream_line(b'data: {"token": {"text": "</s>", "special": true}}\n') is None
+    assert parse_stream_line(b'data: [DONE]\n') is None
+    assert parse_stream_line(b'\n') is None
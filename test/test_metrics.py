@@ -0,0 +1,71 @@
+import sys
+import urllib.request
+
+import pytest
+
+# add src to path
+sys.path.append('src')
+
+from metrics import Histogram, Metrics, MetricsServer
+
+
+def test_histogram_quantiles_use_bucket_bounds():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in [0.05, 0.05, 0.5, 3.0]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1.0
+    assert histogram.quantile(1.0) == 3.0
+
+
+def test_timer_records_latency_and_errors():
+    metrics = Metrics()
+    with metrics.stage("rag", "embed"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.stage("rag", "embed"):
+            raise ValueError("model not loaded")
+    labels = (("component", "rag"), ("stage", "embed"))
+    assert metrics.histograms["stage_seconds"][labels].count == 2
+    assert metrics.counters["errors_total"][labels] == 1
+    assert "stage_seconds{component=\"rag\",stage=\"embed\"}: n=2" in metrics.summary()
+
+
+def test_timed_uses_the_function_name_as_stage():
+    metrics = Metrics()
+
+    @metrics.timed("db")
+    def get_random_note():
+        return "note"
+
+    assert get_random_note() == "note"
+    assert (("component", "db"), ("stage", "get_random_note")) in metrics.histograms["stage_seconds"]
+
+
+def test_prometheus_text():
+    metrics = Metrics()
+    metrics.observe("handler_seconds", 0.2, handler="show_tree")
+    metrics.inc("predictions_total", 3, path="fast")
+    metrics.register_gauge("queue_depth", lambda: 7, queue="outbox")
+    text = metrics.render_prometheus()
+    assert "# TYPE thoughtflow_handler_seconds histogram" in text
+    assert 'thoughtflow_handler_seconds_bucket{handler="show_tree",le="0.1"} 0' in text
+    assert 'thoughtflow_handler_seconds_bucket{handler="show_tree",le="0.25"} 1' in text
+    assert 'thoughtflow_handler_seconds_bucket{handler="show_tree",le="+Inf"} 1' in text
+    assert 'thoughtflow_handler_seconds_count{handler="show_tree"} 1' in text
+    assert 'thoughtflow_predictions_total{path="fast"} 3' in text
+    assert 'thoughtflow_queue_depth{queue="outbox"} 7' in text
+
+
+def test_metrics_server():
+    metrics = Metrics()
+    metrics.inc("errors_total", component="telegram", stage="send_message")
+    server = MetricsServer(metrics, port=0)
+    server.start()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+            body = response.read().decode()
+        assert 'thoughtflow_errors_total{component="telegram",stage="send_message"} 1' in body
+    finally:
+        server.stop()
@@ -0,0 +1,68 @@
+from collections import Counter
+from datetime import datetime, timedelta
+import random
+import sys
+
+# add src to path
+sys.path.append('src')
+
+from note_sampler import IdSet, NoteSampler, age_bucket
+
+
+def test_id_set_remove_keeps_the_other_ids():
+    ids = IdSet()
+    for note_id in [1, 2, 3, 4]:
+        ids.add(note_id)
+    ids.remove(2)
+    ids.remove(4)
+    assert sorted(ids.ids) == [1, 3]
+    assert {ids.choice(random.Random(seed)) for seed in range(20)} == {1, 3}
+
+
+def test_sample_only_returns_candidates_of_the_user():
+    sampler = NoteSampler(rng=random.Random(0))
+    sampler.load(1, [(10, "week", None), (11, "month", None)])
+    sampler.load(2, [(20, "week", None)])
+    assert {sampler.sample(1) for _ in range(50)} == {10, 11}
+    assert sampler.sample(2) == 20
+    assert sampler.sample(3) is None
+
+
+def test_updates_keep_the_pools_in_sync():
+    sampler = NoteSampler(rng=random.Random(0))
+    sampler.load(1, [(10, "week", None)])
+    sampler.load(None, [(10, "week", None)])
+    sampler.update(11, 1, "open", "today", None)
+    assert {sampler.sample(1) for _ in range(50)} == {10, 11}
+    assert {sampler.sample(None) for _ in range(50)} == {10, 11}
+    sampler.update(10, 1, "done", "week", None)
+    assert {sampler.sample(1) for _ in range(20)} == {11}
+    sampler.discard(11)
+    assert sampler.sample(1) is None and sampler.sample(None) is None
+
+
+def test_weighted_sample_prefers_urgent_and_old_notes():
+    sampler = NoteSampler(rng=random.Random(0))
+    old = datetime.now() - timedelta(days=200)
+    sampler.load(1, [(1, "month", None), (2, "today", old)])
+    counts = Counter(sampler.sample(1, weighted=True) for _ in range(2000))
+    # weights 1 and 4 * 3
+    assert counts[2] / counts[1] > 8
+
+
+def test_pool_is_loaded_again_after_the_refresh_interval():
+    now = [0.0]
+    sampler = NoteSampler(refresh_seconds=60, clock=lambda: now[0])
+    assert sampler.needs_load(1)
+    sampler.load(1, [])
+    assert not sampler.needs_load(1)
+    now[0] = 61
+    assert sampler.needs_load(1)
+
+
+def test_age_buckets():
+    now = datetime(2024, 1, 31)
+    assert age_bucket(None, now) == 0
+    assert age_bucket(now - timedelta(days=3), now) == 0
+    assert age_bucket(now - timedelta(days=10), now) == 1
+    assert age_bucket(now - timedelta(days=365), now) == 3
@@ -0,0 +1,111 @@
+import io
+import sys
+import threading
+
+import telebot
+
+# add src to path
+sys.path.append('src')
+
+from outbox import Outbox, TokenBucket
+
+
+class FakeBot:
+    def __init__(self, rate_limited_calls=0):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.rate_limited_calls = rate_limited_calls
+        self.release = threading.Event()
+        self.release.set()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.release.wait(5)
+        with self.lock:
+            if self.rate_limited_calls:
+                self.rate_limited_calls -= 1
+                raise telebot.apihelper.ApiTelegramException('sendMessage', None, {
+                    'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0.05}
+                })
+            self.calls.append(('send_message', chat_id, text))
+        return len(self.calls)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        data = photo.read()
+        with self.lock:
+            if self.rate_limited_calls:
+                self.rate_limited_calls -= 1
+                raise telebot.apihelper.ApiTelegramException('sendPhoto', None, {
+                    'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0.05}
+                })
+            self.calls.append(('send_photo', chat_id, data))
+        return len(self.calls)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        with self.lock:
+            self.calls.append(('edit_message_text', chat_id, text))
+        return text
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2.0, capacity=2, now=0.0)
+    bucket.take(0.0)
+    bucket.take(0.0)
+    assert bucket.wait_time(0.0) == 0.5
+    assert bucket.wait_time(0.5) == 0.0
+
+
+def test_messages_of_a_chat_keep_their_order():
+    bot = FakeBot()
+    outbox = Outbox(bot, chat_rate=100, chat_burst=100)
+    futures = [outbox.send_message(1, str(i)) for i in range(5)]
+    for future in futures:
+        future.result(5)
+    assert [text for _, _, text in bot.calls] == ['0', '1', '2', '3', '4']
+    outbox.stop()
+
+
+def test_rate_limited_message_is_retried():
+    bot = FakeBot(rate_limited_calls=1)
+    outbox = Outbox(bot)
+    assert outbox.send_message(1, 'hello').result(5) == 1
+    assert outbox.stats()['retried'] == 1
+    outbox.stop()
+
+
+def test_rate_limited_upload_is_retried_with_the_whole_file():
+    bot = FakeBot(rate_limited_calls=1)
+    outbox = Outbox(bot)
+    outbox.send_photo(1, io.BytesIO(b'PNGDATA')).result(5)
+    assert bot.calls == [('send_photo', 1, b'PNGDATA')]
+    outbox.stop()
+
+
+def test_repeated_edits_are_merged():
+    bot = FakeBot()
+    bot.release.clear()
+    outbox = Outbox(bot, workers=1)
+    sent = outbox.send_message(1, 'placeholder')  # keeps the only worker busy
+    first_edit = outbox.edit_message_text('partial', 1, 10)
+    last_edit = outbox.edit_message_text('partial answer', 1, 10)
+    bot.release.set()
+    sent.result(5)
+    assert first_edit.result(5) == last_edit.result(5) == 'partial answer'
+    assert bot.calls == [('send_message', 1, 'placeholder'), ('edit_message_text', 1, 'partial answer')]
+    assert outbox.stats()['coalesced'] == 1
+    outbox.stop()
+
+
+def test_edit_is_not_merged_ahead_of_a_later_message():
+    bot = FakeBot()
+    bot.release.clear()
+    outbox = Outbox(bot, workers=1, chat_rate=100, chat_burst=100)
+    sent = outbox.send_message(1, 'placeholder')  # keeps the only worker busy
+    outbox.edit_message_text('first edit', 1, 10)
+    outbox.send_message(1, 'in between')
+    last_edit = outbox.edit_message_text('second edit', 1, 10)
+    bot.release.set()
+    sent.result(5)
+    assert last_edit.result(5) == 'second edit'
+    assert [text for _, _, text in bot.calls] == ['placeholder', 'first edit', 'in between', 'second edit']
+    assert outbox.stats()['coalesced'] == 0
+    outbox.stop()
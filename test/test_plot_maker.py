@@ -0,0 +1,27 @@
+import sys
+
+import matplotlib.pyplot as plt
+
+# add src to path
+sys.path.append('src')
+
+from db_action_handler import NoteCount
+from plot_maker import PlotMaker
+
+COUNTS = [
+    NoteCount('Chores', 'done', None, 3),
+    NoteCount('Chores', 'open', None, 2),
+    NoteCount('Note', 'open', None, 1),
+    NoteCount('Note', None, None, 4),
+]
+
+
+def test_plot_is_rendered_in_memory_without_leaking_figures():
+    open_figures = plt.get_fignums()
+    png = PlotMaker.get_plot_image(COUNTS)
+    assert png.startswith(b'\x89PNG')
+    assert plt.get_fignums() == open_figures
+
+
+def test_empty_period_is_rendered():
+    assert PlotMaker.get_plot_image([]).startswith(b'\x89PNG')
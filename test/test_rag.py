@@ -0,0 +1,241 @@
+from pathlib import Path
+import re
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+# add src to path
+sys.path.append('src')
+
+from db_action_handler import DBActionHandler
+from db_entities import Thought
+from embedding_cache import EmbeddingCache
+from llm_cache import LLMCache
+from rag import RAG
+from vector_index import VectorIndex
+
+CATEGORIES = ["Chores", "Books", "Work"]
+# texts in a tiny embedding space with one axis per category
+VECTORS = {
+    "Chores": [1.0, 0.0, 0.0],
+    "Books": [0.0, 1.0, 0.0],
+    "Work": [0.0, 0.0, 1.0],
+    "wash the dishes": [1.0, 0.1, 0.0],
+    "quarterly report": [0.0, 0.0, 1.0],
+    "Groceries": [0.6, 0.0, 0.8],
+    "buy milk": [0.7, 0.0, 0.7],
+    "read Dune": [0.0, 1.0, 0.1],
+}
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.embedded_texts = []
+
+    def embed_documents(self, texts):
+        self.embedded_texts.extend(texts)
+        return [VECTORS[text] for text in texts]
+
+
+class FakeCollection:
+    """The part of a Chroma collection that the example store uses."""
+    def __init__(self):
+        self.documents = {}
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        for id_, document, metadata in zip(ids, documents, metadatas):
+            self.documents[id_] = (document, metadata)
+
+
+class FakeVectorStore:
+    def __init__(self):
+        self._collection = FakeCollection()
+
+    def delete(self, ids):
+        for id_ in ids:
+            self._collection.documents.pop(id_, None)
+
+
+class FakeLLM:
+    model_id = "fake-llm"
+    model_kwargs = {"temperature": 0.5}
+
+    def __init__(self, output="Category: Work"):
+        self.output = output
+        self.prompts = []
+
+    def __call__(self, prompt):
+        self.prompts.append(prompt)
+        return self.output
+
+    def complete_many(self, prompts):
+        self.prompts.extend(prompts)
+        return [self.output for _ in prompts]
+
+    def stream(self, prompt):
+        self.prompts.append(prompt)
+        yield from re.findall(r"\S+\s*", self.output)
+
+
+class FakePrompt:
+    def format(self, note, candidate_categories):
+        return f"{note}\n{candidate_categories}"
+
+
+def make_rag(note_labels, fast_path_k=3, note_vectors=None):
+    # a RAG with fakes for the model, the LLM and the prompt, and the real in-memory indexes
+    rag = RAG.__new__(RAG)
+    rag.user_id = 1
+    rag.fast_path_k = fast_path_k
+    rag.fast_path_min_agreement = 0.8
+    rag.fast_path_min_similarity = 0.75
+    rag.prediction_count = 0
+    rag.fast_path_count = 0
+    rag.model_name = "mistral"
+    rag.embedding_function = FakeEmbeddings()
+    rag.llm = FakeLLM()
+    rag.llm_cache = LLMCache()
+    rag.similar_prompt = FakePrompt()
+    rag.embedding_cache = EmbeddingCache(rag.embedding_function, Path(":memory:"))
+    rag.example_selector = SimpleNamespace(vectorstore=FakeVectorStore())
+    rag.db_action_handler = DBActionHandler()
+    rag.note_labels = dict(note_labels)
+    note_vectors = note_vectors or {}
+    rag.note_index = VectorIndex.from_embeddings(list(note_vectors), list(note_vectors.values()))
+    rag.category_index = VectorIndex.from_embeddings(CATEGORIES, np.eye(len(CATEGORIES)))
+    return rag
+
+
+def test_agreeing_neighbours_skip_the_llm():
+    rag = make_rag({1: "Chores", 2: "Chores", 3: "Chores"})
+    prediction = rag.predict_from_neighbours([(1, 0.9), (2, 0.85), (3, 0.8)])
+    assert prediction["category"] == "Chores"
+    assert "Chores" in prediction["categories_for_user_selection"]
+
+
+def test_split_neighbours_go_to_the_llm():
+    rag = make_rag({1: "Chores", 2: "Books", 3: "Chores"})
+    assert rag.predict_from_neighbours([(1, 0.9), (2, 0.9), (3, 0.9)]) is None
+
+
+def test_dissimilar_neighbours_do_not_vote():
+    rag = make_rag({1: "Chores", 2: "Chores", 3: "Books"})
+    # the Books note points away from the message, it neither adds to nor takes from the agreement
+    assert rag.predict_from_neighbours([(1, 0.9), (2, 0.85), (3, -0.5)])["category"] == "Chores"
+    # no neighbour is similar at all: the LLM decides, instead of dividing by a zero total
+    assert rag.predict_from_neighbours([(1, -0.2), (2, 0.0), (3, -0.4)]) is None
+    assert rag.predict_from_neighbours([(1, 0.5), (2, -0.5), (3, 0.0)]) is None
+
+
+def test_too_few_neighbours_or_unknown_category_go_to_the_llm():
+    rag = make_rag({1: "Chores", 2: "Chores", 3: "Groceries", 4: "Groceries", 5: "Groceries"})
+    assert rag.predict_from_neighbours([(1, 0.9), (2, 0.9)]) is None
+    assert rag.predict_from_neighbours([(3, 0.9), (4, 0.9), (5, 0.9)]) is None
+
+
+def test_predict_many_sends_only_undecided_notes_to_the_llm():
+    chores = {1: [1.0, 0.0, 0.0], 2: [0.9, 0.1, 0.0], 3: [1.0, 0.0, 0.1]}
+    rag = make_rag({note_id: "Chores" for note_id in chores}, note_vectors=chores)
+    predictions = rag.predict_many(["wash the dishes", "quarterly report"])
+    assert [prediction["category"] for prediction in predictions] == ["Chores", "Work"]
+    assert len(rag.llm.prompts) == 1 and rag.llm.prompts[0].startswith("quarterly report")
+    assert (rag.fast_path_count, rag.prediction_count) == (1, 2)
+
+
+def test_note_does_not_vote_for_its_own_label():
+    chores = {1: [1.0, 0.1, 0.0], 2: [0.9, 0.1, 0.0], 3: [1.0, 0.0, 0.1]}
+    rag = make_rag({note_id: "Chores" for note_id in chores}, note_vectors=chores)
+    # without note 1 there are only two neighbours left, too few to skip the LLM
+    assert rag.predict_many(["wash the dishes"], note_ids=[1])[0]["category"] == "Work"
+    assert len(rag.llm.prompts) == 1
+
+
+def test_call_llm_many_completes_only_uncached_prompts():
+    rag = make_rag({})
+    rag.llm_cache.set(LLMCache.make_key(rag.llm.model_id, rag.llm.model_kwargs, "cached"), "Category: Books")
+    assert rag.call_llm_many(["cached", "new"]) == ["Category: Books", "Category: Work"]
+    assert rag.llm.prompts == ["new"]
+    assert rag.call_llm_many(["new"]) == ["Category: Work"]
+    assert rag.llm.prompts == ["new"]
+
+
+def test_notes_are_added_updated_and_removed_in_every_index():
+    rag = make_rag({})
+    documents = rag.example_selector.vectorstore._collection.documents
+    rag.add_note(7, "buy milk", "Chores")
+    assert documents["7"] == ("buy milk", {"input": "buy milk", "output": "Chores"})
+    assert rag.note_labels[7] == "Chores"
+    assert rag.note_index.search([VECTORS["buy milk"]], 1)[0][0][0] == 7
+
+    rag.update_note(7, "read Dune", "Books")
+    assert documents["7"][1]["output"] == "Books"
+    assert rag.note_labels[7] == "Books"
+    note_id, similarity = rag.note_index.search([VECTORS["Books"]], 1)[0][0]
+    assert note_id == 7 and similarity == pytest.approx(0.995, abs=1e-3)
+    assert len(rag.note_index) == 1
+
+    rag.remove_note(7)
+    assert documents == {} and 7 not in rag.note_labels and 7 not in rag.note_index
+    # the cached embedding is gone as well, the note is embedded again if it comes back
+    rag.embedding_function.embedded_texts.clear()
+    rag.add_note(7, "read Dune", "Books")
+    assert rag.embedding_function.embedded_texts == ["read Dune"]
+
+
+def test_categories_are_added_and_removed():
+    rag = make_rag({})
+    rag.add_category("Groceries")
+    assert rag.search_categories(["buy milk"], k=1) == [["Groceries"]]
+    rag.embedding_function.embedded_texts.clear()
+    rag.add_category("Groceries")
+    assert rag.embedding_function.embedded_texts == []
+    rag.remove_category("Groceries")
+    assert "Groceries" not in rag.category_index
+    assert rag.search_categories(["buy milk"], k=1) != [["Groceries"]]
+
+
+@pytest.fixture
+def notes(db_engine):
+    action_handler = DBActionHandler()
+    notes = {}
+    for text, label, status in [("buy milk", "Chores", "open"), ("read Dune", "Books", "open"),
+                                ("quarterly report", "Work", "done"), ("wash the dishes", "Chores", "open")]:
+        note = Thought(note_text=text, label=label, status=status, user_id=1)
+        action_handler.add_thought(note)
+        notes[text] = note.id
+    return notes
+
+
+def make_rag_with_notes(notes):
+    vectors = {note_id: VECTORS[text] for text, note_id in notes.items()}
+    return make_rag({}, note_vectors=vectors)
+
+
+def test_retrieve_notes_returns_open_notes_by_relevance(notes):
+    rag = make_rag_with_notes(notes)
+    retrieved = rag.retrieve_notes("Chores", k=3)
+    # the done note is skipped
+    assert [note.note_text for note in retrieved] == ["wash the dishes", "buy milk", "read Dune"]
+    # every prompt line is about 12 tokens
+    assert [note.note_text for note in rag.retrieve_notes("Chores", token_budget=15)] == ["wash the dishes"]
+
+
+def test_query_answer_is_matched_to_the_provided_notes(notes):
+    rag = make_rag_with_notes(notes)
+    rag.llm.output = f"[{notes['buy milk']}] Note: 'buy milk'\n[{notes['quarterly report']}] Note: 'report'\n[999]"
+    result = rag.perform_arbitrary_query("Chores", k=2)
+    assert result["answer"] == rag.llm.output
+    # the done note and the unknown id were not in the prompt
+    assert result["note_ids"] == [notes["buy milk"]]
+    assert f"[{notes['wash the dishes']}] Note: 'wash the dishes', Category: 'Chores'" in rag.llm.prompts[0]
+
+
+def test_query_answer_can_be_streamed(notes):
+    rag = make_rag_with_notes(notes)
+    rag.llm.output = f"You should [{notes['buy milk']}]"
+    partial_answers = []
+    result = rag.perform_arbitrary_query("Chores", on_partial_answer=partial_answers.append)
+    assert partial_answers == ["You ", "You should ", f"You should [{notes['buy milk']}]"]
+    assert result["note_ids"] == [notes["buy milk"]]
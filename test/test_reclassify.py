@@ -0,0 +1,91 @@
+import sys
+
+import pytest
+
+# add src to path
+sys.path.append('src')
+
+import reclassify
+from db_action_handler import DBActionHandler
+from db_entities import Thought
+
+PREDICTIONS = {"buy milk": "Groceries", "read Sapiens": "Books", "call mom": "Family", "fix the sink": "Chores"}
+
+
+class FakeRAG:
+    """Predicts from PREDICTIONS and records the notes that are updated in the example store."""
+    instances = []
+
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+        self.updated = []
+        FakeRAG.instances.append(self)
+
+    failing_message = None
+
+    def predict_many(self, messages, note_ids=None):
+        if FakeRAG.failing_message in messages:
+            raise TimeoutError("LLM call did not finish within 90s")
+        return [{"category": PREDICTIONS[message]} for message in messages]
+
+    def update_note(self, note_id, note_text, label):
+        self.updated.append((note_text, label))
+
+
+@pytest.fixture
+def action_handler(db_engine, monkeypatch):
+    monkeypatch.setattr(reclassify, "RAG", FakeRAG)
+    FakeRAG.instances = []
+    FakeRAG.failing_message = None
+    action_handler = DBActionHandler()
+    for text, label in [("buy milk", "Chores"), ("read Sapiens", "Books"), ("call mom", "Chores"),
+                        ("fix the sink", "Chores")]:
+        action_handler.add_thought(Thought(note_text=text, label=label, status="open", user_id=1))
+    return action_handler
+
+
+def labels(action_handler):
+    return {note.note_text: note.label for note in action_handler.filter_notes()}
+
+
+def test_changed_labels_are_written_in_batches(action_handler):
+    assert reclassify.reclassify(batch_size=3) == 2
+    assert labels(action_handler) == PREDICTIONS
+    assert FakeRAG.instances[0].updated == [("buy milk", "Groceries"), ("call mom", "Family")]
+
+
+def test_dry_run_writes_nothing(action_handler):
+    assert reclassify.reclassify(label="Chores", dry_run=True) == 2
+    assert labels(action_handler)["buy milk"] == "Chores"
+    assert FakeRAG.instances[0].updated == []
+
+
+def test_resume_after_the_last_processed_note(action_handler):
+    second_note = action_handler.filter_notes(limit=2)[-1]
+    assert reclassify.reclassify(after_id=second_note.id) == 1
+    assert labels(action_handler) == {**PREDICTIONS, "buy milk": "Chores"}
+
+
+def test_unknown_user_is_rejected(action_handler):
+    with pytest.raises(ValueError):
+        reclassify.reclassify(username="nobody")
+
+
+def test_failed_batch_stops_the_run(action_handler, caplog):
+    FakeRAG.failing_message = "call mom"
+    with pytest.raises(TimeoutError):
+        reclassify.reclassify(batch_size=2)
+    # the first batch is written, nothing after the failed one
+    assert labels(action_handler) == {**PREDICTIONS, "call mom": "Chores", "fix the sink": "Chores"}
+    second_note = action_handler.filter_notes(limit=2)[-1]
+    assert f"resume with --after-id {second_note.id}" in caplog.text
+
+
+def test_failed_write_is_not_counted(action_handler, monkeypatch):
+    def fail(self, labels):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(DBActionHandler, "bulk_update_labels", fail)
+    with pytest.raises(RuntimeError):
+        reclassify.reclassify()
+    assert FakeRAG.instances[0].updated == []
@@ -0,0 +1,80 @@
+import sys
+
+# add src to path
+sys.path.append('src')
+
+from db_entities import User
+from lazy_resource import LazyResourceRegistry
+from user_directory import UserDirectory
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_directory(users):
+    lookups = []
+
+    def lookup(username):
+        lookups.append(username)
+        return users.get(username)
+
+    clock = FakeClock()
+    directory = UserDirectory(lookup, ttl_seconds=300, negative_ttl_seconds=30, clock=clock)
+    return directory, lookups, clock
+
+
+def test_known_user_is_looked_up_once():
+    directory, lookups, _ = make_directory({"alice": User(id=1, username="alice", is_admin=True)})
+    account = directory.get("alice")
+    assert account.id == 1 and account.is_admin
+    assert directory.get("alice") == account
+    assert lookups == ["alice"]
+
+
+def test_unknown_user_is_cached_for_a_shorter_time():
+    directory, lookups, clock = make_directory({})
+    assert directory.get("mallory") is None
+    assert directory.get("mallory") is None
+    assert lookups == ["mallory"]
+    clock.now = 31
+    directory.get("mallory")
+    assert lookups == ["mallory", "mallory"]
+
+
+def test_invalidate_makes_a_new_user_visible():
+    users = {}
+    directory, _, _ = make_directory(users)
+    assert directory.get("bob") is None
+    users["bob"] = User(id=2, username="bob", is_admin=False)
+    directory.invalidate("bob")
+    assert directory.get("bob").id == 2
+
+
+def test_missing_username_is_not_authorized():
+    directory, lookups, _ = make_directory({})
+    assert directory.get(None) is None
+    assert lookups == []
+
+
+def test_registry_builds_one_resource_per_key_and_drops_the_least_recently_used():
+    built = []
+
+    def factory(key):
+        built.append(key)
+        return f"resource {key}"
+
+    registry = LazyResourceRegistry("test", factory, max_size=2)
+    assert registry.get(1) == "resource 1"
+    assert registry.get(1) == "resource 1"
+    registry.get(2)
+    registry.get(1)
+    registry.get(3)  # drops 2, which was used least recently
+    assert len(registry) == 2
+    registry.get(1)
+    registry.get(2)
+    assert built == [1, 2, 3, 2]
@@ -0,0 +1,29 @@
+import sys
+
+# add src to path
+sys.path.append('src')
+
+from vector_index import VectorIndex
+
+
+def test_search_returns_unique_keys_by_similarity():
+    index = VectorIndex.from_embeddings(
+        ["Chores", "Note", "Chores", "Plan"],
+        [[1.0, 0.0], [0.0, 1.0], [1.0, 0.1], [0.7, 0.7]],
+    )
+    assert len(index) == 3
+    results = index.search([[1.0, 0.0], [0.0, 2.0]], k=2)
+    assert [key for key, _ in results[0]] == ["Chores", "Plan"]
+    assert [key for key, _ in results[1]] == ["Note", "Plan"]
+    assert abs(results[0][0][1] - 1.0) < 1e-6
+
+
+def test_add_replace_and_remove():
+    index = VectorIndex()
+    index.add("Chores", [1.0, 0.0])
+    index.add("Note", [0.0, 1.0])
+    index.add("Chores", [0.0, -1.0])
+    assert index.search([[0.0, -1.0]], k=1)[0][0][0] == "Chores"
+    index.remove("Chores")
+    assert "Chores" not in index
+    assert index.search([[0.0, -1.0]], k=5) == [[("Note", -1.0)]]
@@ -0,0 +1,86 @@
+import json
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+# add src to path
+sys.path.append('src')
+
+from webhook_server import SECRET_TOKEN_HEADER, WebhookServer
+
+RECORDED_UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 5,
+        'date': 0,
+        'chat': {'id': 10, 'type': 'private'},
+        'from': {'id': 10, 'is_bot': False, 'first_name': 'user'},
+        'text': '/random',
+    },
+}
+
+
+class RecordingBot:
+    def __init__(self):
+        self.threaded = True
+        self.handled = threading.Event()
+        self.updates = []
+
+    def process_new_updates(self, updates):
+        self.updates.extend(updates)
+        self.handled.set()
+
+
+def post(server, update, secret_token='secret'):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{server.port}/webhook",
+        data=json.dumps(update).encode(),
+        headers={SECRET_TOKEN_HEADER: secret_token, 'Content-Type': 'application/json'},
+    )
+    try:
+        return urllib.request.urlopen(request).status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+@pytest.fixture
+def bot():
+    return RecordingBot()
+
+
+def test_recorded_update_reaches_handlers(bot):
+    server = WebhookServer(bot, 'secret', port=0)
+    server.start()
+    assert post(server, RECORDED_UPDATE) == 200
+    assert bot.handled.wait(5)
+    assert bot.updates[0].message.text == '/random'
+    server.stop()
+
+
+def test_wrong_secret_is_rejected(bot):
+    server = WebhookServer(bot, 'secret', port=0)
+    server.start()
+    assert post(server, RECORDED_UPDATE, secret_token='wrong') == 403
+    server.stop()
+    assert not bot.updates
+
+
+def test_full_queue_applies_backpressure(bot):
+    server = WebhookServer(bot, 'secret', port=0, queue_size=1, workers=0)
+    server.start()
+    assert post(server, RECORDED_UPDATE) == 200
+    assert post(server, dict(RECORDED_UPDATE, update_id=2)) == 503
+    assert server.queue_depth() == 1
+    server.stop()
+
+
+@pytest.mark.parametrize("body", [[], {"message": 1}, {"update_id": 1, "message": 1}, None, 1])
+def test_malformed_update_is_rejected(bot, body):
+    server = WebhookServer(bot, 'secret', port=0)
+    server.start()
+    assert post(server, body) == 400
+    assert server.queue_depth() == 0
+    server.stop()